@@ -0,0 +1,246 @@
+"""
+End-to-end load test of the webhook server.
+
+Starts the FastAPI `app` of `main.py` in-process, pointed at the local fakes of the Telegram Bot API and
+the OpenAI chat endpoint, the in-memory Datastore stand-in and a local Redis, and replays synthetic private
+and group chat updates to `/webhook` at the target rate. The latency of an update is measured from posting it
+to the moment its final reply reaches the fake Telegram. It runs fully offline, given a local Redis and
+the tokenizer files cached in `TIKTOKEN_CACHE_DIR`. Run it from the `core` directory:
+
+    python -m benchmarks.load_test --rate 50 --duration 30 --openai-latency 0.5
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import logging
+import os
+import random
+import statistics
+import time
+import typing as t
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.load_test.fakes import FakeTelegram, FakeOpenAI, InMemoryDatastoreClient, WORDS
+
+BOT_USERNAME = "load_test_bot"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=20, help="updates per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of sending the updates")
+    parser.add_argument("--private-chats", type=int, default=200)
+    parser.add_argument("--group-chats", type=int, default=20)
+    parser.add_argument("--group-share", type=float, default=0.3, help="share of the updates sent to the groups")
+    parser.add_argument("--openai-latency", type=float, default=0.5, help="seconds to the first token")
+    parser.add_argument("--completion-tokens", type=int, default=50)
+    parser.add_argument("--token-interval", type=float, default=0.01, help="seconds between the streamed tokens")
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--stream", choices=("on", "off"), default="on", help="stream the OpenAI responses")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="seconds to wait for the last replies")
+    parser.add_argument("--redis-db", type=int, default=15, help="the Redis database, flushed before the run")
+    parser.add_argument("--port", type=int, default=18080, help="the webhook server port")
+    parser.add_argument("--telegram-port", type=int, default=18081)
+    parser.add_argument("--openai-port", type=int, default=18082)
+    return parser.parse_args()
+
+
+def configure_environment(args: argparse.Namespace):
+    """Points the settings at the fakes, must be called before any `core` module is imported."""
+    os.environ.update({
+        "OPEN_AI_API_KEY": "load-test",
+        "OPEN_AI_API_BASE": f"http://127.0.0.1:{args.openai_port}/v1",
+        "OPEN_AI_STREAM_RESPONSES": "true" if args.stream == "on" else "false",
+        "TELEGRAM_BOT_API_TOKEN": "123456:load-test",
+        "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{args.telegram_port}/bot",
+        "TELEGRAM_WEBHOOK_URL": "None",
+        "BOT_USERNAME": BOT_USERNAME,
+        "GOOGLE_CLOUD_PROJECT": "load-test",
+        "ADMIN_CHAT_ID": "1",
+        "MEMORYSTORE_DB": str(args.redis_db),
+        "UPDATE_STREAM_ENABLED": "false",
+    })
+
+
+class UpdateFactory:
+    """Builds the synthetic updates, the group messages mention the bot so they are answered."""
+
+    def __init__(self, private_chats: int, group_chats: int, group_share: float):
+        self.private_chats = private_chats
+        self.group_chats = group_chats
+        self.group_share = group_share
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def build(self) -> t.Tuple[int, dict]:
+        is_group = self.group_chats and random.random() < self.group_share
+        if is_group:
+            chat = {"id": -1_000_000 - random.randrange(self.group_chats), "type": "supergroup", "title": "Group"}
+            user_id = 10_000 + random.randrange(self.private_chats)
+            text = f"@{BOT_USERNAME} {' '.join(random.choices(WORDS, k=15))}"
+        else:
+            user_id = 10_000 + random.randrange(self.private_chats)
+            chat = {"id": user_id, "type": "private", "first_name": "John"}
+            text = " ".join(random.choices(WORDS, k=15))
+        update = {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": chat,
+                "from": {"id": user_id, "is_bot": False, "first_name": "John", "last_name": "Doe",
+                         "username": f"user{user_id}"},
+                "text": text,
+            },
+        }
+        return chat["id"], update
+
+
+class LatencyTracker:
+    """Matches the replies to the updates, the updates of one chat are answered in order."""
+
+    def __init__(self):
+        self.sent_at: t.Dict[int, t.Deque[float]] = collections.defaultdict(collections.deque)
+        self.latencies: t.List[float] = []
+        self.failed = 0
+        self.last_reply_at = 0.0
+        self.all_replied = asyncio.Event()
+
+    @property
+    def pending_num(self) -> int:
+        return sum(len(sent) for sent in self.sent_at.values())
+
+    def sent(self, chat_id: int):
+        self.all_replied.clear()
+        self.sent_at[chat_id].append(time.perf_counter())
+
+    def replied(self, chat_id: int, is_successful: bool):
+        if not self.sent_at[chat_id]:
+            return  # a reply which is not matched to any update, e.g. an error after a timed out reply
+        self.last_reply_at = time.perf_counter()
+        sent_at = self.sent_at[chat_id].popleft()
+        if is_successful:
+            self.latencies.append(self.last_reply_at - sent_at)
+        else:
+            self.failed += 1
+        if not self.pending_num:
+            self.all_replied.set()
+
+
+async def measure_loop_lag(lags: t.List[float], interval: float = 0.01):
+    loop = asyncio.get_running_loop()
+    while True:
+        started_at = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - started_at - interval)
+
+
+async def get_redis_calls(redis_client) -> t.Counter[str]:
+    stats = await redis_client.info("commandstats")
+    return collections.Counter({name.removeprefix("cmdstat_"): value["calls"] for name, value in stats.items()})
+
+
+async def start_site(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def percentile(values: t.List[float], share: float) -> float:
+    return sorted(values)[min(int(len(values) * share), len(values) - 1)] if values else float("nan")
+
+
+async def run(args: argparse.Namespace):
+    import uvicorn
+    import main
+    from core import datastore as datastore_module
+    from core.redis_tools import redis_client
+
+    for logger_name in ("httpx", "openai"):
+        logging.getLogger(logger_name).setLevel(logging.WARNING)  # every request is logged otherwise
+    fake_telegram = FakeTelegram(bot_username=BOT_USERNAME, latency=args.telegram_latency)
+    fake_open_ai = FakeOpenAI(latency=args.openai_latency, completion_tokens=args.completion_tokens,
+                              token_interval=args.token_interval)
+    datastore_client = InMemoryDatastoreClient(project="load-test")
+    datastore_module.get_datastore_client = lambda: datastore_client
+    tracker = LatencyTracker()
+    fake_telegram.on_reply = tracker.replied
+    runners = [await start_site(fake_telegram.build_app(), args.telegram_port),
+               await start_site(fake_open_ai.build_app(), args.openai_port)]
+
+    await redis_client.flushdb()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    lags: t.List[float] = []
+    lag_task = asyncio.create_task(measure_loop_lag(lags))
+    redis_calls_before = await get_redis_calls(redis_client)
+    factory = UpdateFactory(args.private_chats, args.group_chats, args.group_share)
+    webhook_url = f"http://127.0.0.1:{args.port}/webhook"
+    posts, rejected = [], 0
+
+    async with aiohttp.ClientSession() as session:
+        async def post(chat_id: int, update: dict):
+            nonlocal rejected
+            tracker.sent(chat_id)
+            async with session.post(webhook_url, json=update) as response:
+                if response.status != 200:
+                    rejected += 1
+                    tracker.replied(chat_id, is_successful=False)
+
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        perf_started_at = time.perf_counter()
+        for number in range(int(args.rate * args.duration)):
+            delay = started_at + number / args.rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            posts.append(asyncio.create_task(post(*factory.build())))
+        await asyncio.gather(*posts)
+        try:
+            await asyncio.wait_for(tracker.all_replied.wait(), timeout=args.drain_timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    redis_calls = await get_redis_calls(redis_client) - redis_calls_before
+    lag_task.cancel()
+    server.should_exit = True
+    await server_task
+    for runner in runners:
+        await runner.cleanup()
+
+    updates_num = len(posts)
+    latencies = tracker.latencies
+    elapsed = (tracker.last_reply_at or time.perf_counter()) - perf_started_at
+    redis_calls.pop("info", None)
+    print(f"Updates sent: {updates_num} at {args.rate}/s, answered: {len(latencies)}, failed: {tracker.failed}, "
+          f"rejected: {rejected}, unanswered: {tracker.pending_num}")
+    print(f"Throughput: {len(latencies) / elapsed:.1f} updates/s")
+    print(f"End-to-end latency: p50 {percentile(latencies, 0.5) * 1000:.0f} ms, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms, p99 {percentile(latencies, 0.99) * 1000:.0f} ms")
+    if lags:
+        print(f"Event loop lag: mean {statistics.mean(lags) * 1000:.1f} ms, p99 {percentile(lags, 0.99) * 1000:.1f} ms, "
+              f"max {max(lags) * 1000:.1f} ms")
+    print(f"Redis commands per update: {sum(redis_calls.values()) / updates_num:.1f} "
+          f"({', '.join(f'{name} {calls / updates_num:.1f}' for name, calls in redis_calls.most_common(8))})")
+    print(f"Datastore RPCs per update: {sum(datastore_client.ops.values()) / updates_num:.2f} "
+          f"({', '.join(f'{name} {calls / updates_num:.2f}' for name, calls in datastore_client.ops.most_common())})")
+    print(f"OpenAI requests per update: {fake_open_ai.requests / updates_num:.2f}, Telegram calls per update: "
+          f"{', '.join(f'{name} {calls / updates_num:.2f}' for name, calls in fake_telegram.calls.most_common())}")
+
+
+def main():
+    args = parse_args()
+    random.seed(42)
+    configure_environment(args)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Local stand-ins of the external services used by the load test.
+"""
+import asyncio
+import collections
+import contextlib
+import itertools
+import json
+import random
+import threading
+import time
+import typing as t
+
+from aiohttp import web
+from google.cloud import datastore
+
+RESPONSE_END = "[end]"  # the fake completions end with it, so the final reply of an update can be recognized
+WORDS = ("the model answer context token chat user system message telegram python redis list history "
+         "response request balance price consultant knowledge question explain example because however").split()
+
+
+class FakeTelegram:
+    """Fake Telegram Bot API, which records the moments the replies to the updates are sent."""
+
+    def __init__(self, bot_username: str, latency: float):
+        self.bot_username = bot_username
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.calls: t.Counter[str] = collections.Counter()
+        self.on_reply: t.Optional[t.Callable[[int, bool], None]] = None  # called with the chat id and the success
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"ok": True, "result": self.get_result(method, params)})
+
+    def get_result(self, method: str, params: dict) -> t.Any:
+        match method:
+            case "getMe":
+                return {"id": 1, "is_bot": True, "first_name": "Load Test", "username": self.bot_username}
+            case "getWebhookInfo":
+                return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+            case "getChatMember":
+                return {"status": "member", "user": {"id": int(params["user_id"]), "is_bot": False,
+                                                     "first_name": "John"}}
+            case "sendMessage" | "editMessageText":
+                chat_id, text = int(params["chat_id"]), params["text"]
+                if method == "sendMessage" and text != "...":  # the streaming placeholder is not a reply
+                    self.reply(chat_id, is_successful=text.endswith(RESPONSE_END))
+                elif method == "editMessageText" and text.endswith(RESPONSE_END):
+                    self.reply(chat_id, is_successful=True)
+                return {"message_id": int(params.get("message_id") or next(self.message_ids)), "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}, "text": text}
+        return True
+
+    def reply(self, chat_id: int, is_successful: bool):
+        if self.on_reply is not None:
+            self.on_reply(chat_id, is_successful)
+
+
+class FakeOpenAI:
+    """Fake OpenAI chat completions endpoint, streaming the response token by token when asked to."""
+
+    def __init__(self, latency: float, completion_tokens: int, token_interval: float):
+        self.latency = latency  # the time to the first token
+        self.completion_tokens = completion_tokens
+        self.token_interval = token_interval
+        self.requests = 0
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        params = await request.json()
+        tokens = [f"{random.choice(WORDS)} " for _ in range(self.completion_tokens - 1)] + [RESPONSE_END]
+        await asyncio.sleep(self.latency)
+        if not params.get("stream"):
+            await asyncio.sleep(self.token_interval * len(tokens))
+            return web.json_response({
+                "id": "chatcmpl-load-test", "object": "chat.completion", "created": int(time.time()),
+                "model": params["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 100, "completion_tokens": len(tokens), "total_tokens": 100 + len(tokens)},
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for token in tokens:
+            chunk = {"id": "chatcmpl-load-test", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": params["model"],
+                     "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            if self.token_interval:
+                await asyncio.sleep(self.token_interval)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+class FakeQueryIterator:
+    def __init__(self, entities: t.List[datastore.Entity], offset: int, limit: t.Optional[int]):
+        end = len(entities) if limit is None else offset + limit
+        self.page = entities[offset:end]
+        self.next_page_token = end if end < len(entities) else None
+
+    def __iter__(self) -> t.Iterator[datastore.Entity]:
+        return iter(self.page)
+
+    @property
+    def pages(self) -> t.Iterator[t.List[datastore.Entity]]:
+        return iter([self.page])
+
+
+class FakeQuery:
+    def __init__(self, client: "InMemoryDatastoreClient", kind: str, ancestor: t.Optional[datastore.Key] = None):
+        self.client = client
+        self.kind = kind
+        self.ancestor = ancestor
+        self.filters = []
+        self.min_key_id = None
+        self.order = []
+
+    def add_filter(self, property_name: str, operator: str, value: t.Any):
+        self.filters.append((property_name, value))  # only the equality filters are used
+
+    def key_filter(self, key: datastore.Key, operator: str):
+        self.min_key_id = key.id  # only the lower bound (">=") is used
+
+    def fetch(self, limit: t.Optional[int] = None, start_cursor: t.Optional[int] = None) -> FakeQueryIterator:
+        self.client.count("query")
+        with self.client.lock:
+            entities = [entity for key, entity in self.client.entities.items()
+                        if key.kind == self.kind and (self.ancestor is None or key.parent == self.ancestor)
+                        and (self.min_key_id is None or key.id >= self.min_key_id)
+                        and all(entity.get(name) == value for name, value in self.filters)]
+        if "-__key__" in self.order:
+            entities.sort(key=lambda entity: entity.key.id, reverse=True)
+        return FakeQueryIterator(entities, start_cursor or 0, limit)
+
+
+class InMemoryDatastoreClient:
+    """In-memory stand-in of the Datastore client, counting the RPCs it would have made."""
+
+    def __init__(self, project: str):
+        self.project = project
+        self.entities: t.Dict[datastore.Key, datastore.Entity] = {}
+        self.lock = threading.Lock()  # the client is called from the Datastore thread pool
+        self.ops: t.Counter[str] = collections.Counter()
+
+    def count(self, operation: str):
+        with self.lock:
+            self.ops[operation] += 1
+
+    def key(self, *path_args, parent: t.Optional[datastore.Key] = None) -> datastore.Key:
+        return datastore.Key(*path_args, parent=parent, project=self.project)
+
+    def get(self, key: datastore.Key) -> t.Optional[datastore.Entity]:
+        self.count("lookup")
+        with self.lock:
+            return self.entities.get(key)
+
+    def get_multi(self, keys: t.List[datastore.Key]) -> t.List[datastore.Entity]:
+        self.count("lookup")
+        with self.lock:
+            return [self.entities[key] for key in keys if key in self.entities]
+
+    def put(self, entity: datastore.Entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities: t.List[datastore.Entity]):
+        self.count("commit")
+        with self.lock:
+            for entity in entities:
+                self.entities[entity.key] = entity
+
+    def query(self, kind: str, ancestor: t.Optional[datastore.Key] = None) -> FakeQuery:
+        return FakeQuery(self, kind, ancestor)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.count("transaction")
+        yield self
@@ -0,0 +1,67 @@
+"""
+Benchmark of the session payload codecs on realistic chats.
+
+Compares the payload size and the encode/decode time of the plain JSON payloads (the previous format) with
+the versioned codecs. Run it from the `core` directory:
+
+    python -m benchmarks.session_codec
+"""
+import json
+import random
+import timeit
+
+from core.codec import SessionCodec, JsonCodec, MsgPackCodec
+from core.constants import BASIC_INTRODUCTION
+from core.models import Chat, Message
+
+WORDS = ("the model answer context token chat user system message telegram python redis list history "
+         "response request balance price consultant knowledge question explain example because however").split()
+ITERATIONS = 200
+
+
+def make_text(words_num: int) -> str:
+    return " ".join(random.choice(WORDS) for _ in range(words_num))
+
+
+def make_chat(messages_num: int, reply_words: int) -> dict:
+    messages = []
+    for index in range(messages_num):
+        if index % 2:
+            messages.append(Message(role="assistant", content=make_text(reply_words), token_count=reply_words,
+                                    token_encoding="cl100k_base"))
+        else:
+            messages.append(Message(role="user", content=f"John Doe says:{make_text(20)}", token_count=25,
+                                    token_encoding="cl100k_base"))
+    return Chat(chat_id=-100123456789, system_message=Message(content=BASIC_INTRODUCTION), messages=messages).dict()
+
+
+def measure(name: str, encode, decode, data):
+    payload = encode(data)
+    encode_time = timeit.timeit(lambda: encode(data), number=ITERATIONS) / ITERATIONS * 1_000_000
+    decode_time = timeit.timeit(lambda: decode(payload), number=ITERATIONS) / ITERATIONS * 1_000_000
+    print(f"  {name:<24} {len(payload):>9} B {encode_time:>10.1f} us {decode_time:>10.1f} us")
+
+
+def main():
+    random.seed(42)
+    codecs = {
+        "msgpack": SessionCodec(MsgPackCodec(), compression_threshold=1024, compression_level=1),
+        "msgpack (no compression)": SessionCodec(MsgPackCodec(), compression_threshold=2 ** 31, compression_level=1),
+        "json (versioned)": SessionCodec(JsonCodec(), compression_threshold=1024, compression_level=1),
+    }
+    scenarios = {
+        "private chat, short replies": make_chat(messages_num=10, reply_words=40),
+        "private chat, long replies": make_chat(messages_num=20, reply_words=400),
+        "group chat, long history": make_chat(messages_num=100, reply_words=150),
+        "single long assistant reply": make_chat(messages_num=2, reply_words=800)["messages"][1],
+    }
+    for scenario, data in scenarios.items():
+        print(f"{scenario}:")
+        print(f"  {'codec':<24} {'size':>11} {'encode':>13} {'decode':>13}")
+        measure("json (legacy)", lambda value: json.dumps(value).encode(), json.loads, data)
+        for name, codec in codecs.items():
+            measure(name, codec.encode, codec.decode, data)
+
+
+if __name__ == "__main__":
+    main()
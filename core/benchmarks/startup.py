@@ -0,0 +1,121 @@
+"""
+Benchmark of the cold start of the webhook server.
+
+Measures the time to import `main` in a fresh interpreter, and the time from spawning the uvicorn server
+to the first successful `/healthcheck` (the process is alive) and `/readiness` (the process is warmed up)
+replies. The server talks to the fake Telegram Bot API of the load test, started in this process, and to
+a local Redis. It runs fully offline, given the tokenizer files cached in `TIKTOKEN_CACHE_DIR`. Run it from
+the `core` directory:
+
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+import typing as t
+
+import aiohttp
+from aiohttp import web
+
+from benchmarks.load_test.fakes import FakeTelegram
+
+BOT_USERNAME = "startup_bot"
+IMPORT_SCRIPT = "import time; started_at = time.perf_counter(); import main; print(time.perf_counter() - started_at)"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the server to be ready")
+    parser.add_argument("--port", type=int, default=18090, help="the webhook server port")
+    parser.add_argument("--telegram-port", type=int, default=18091)
+    return parser.parse_args()
+
+
+def build_environment(args: argparse.Namespace) -> t.Dict[str, str]:
+    return {
+        **os.environ,
+        "OPEN_AI_API_KEY": "startup",
+        "TELEGRAM_BOT_API_TOKEN": "123456:startup",
+        "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{args.telegram_port}/bot",
+        "TELEGRAM_WEBHOOK_URL": "None",
+        "BOT_USERNAME": BOT_USERNAME,
+        "GOOGLE_CLOUD_PROJECT": "startup",
+        "ADMIN_CHAT_ID": "1",
+    }
+
+
+def measure_import(env: t.Dict[str, str]) -> float:
+    output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], env=env, check=True, capture_output=True,
+                            text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+async def wait_for(session: aiohttp.ClientSession, url: str, deadline: float) -> float:
+    """Polls the endpoint until it replies with 200, returns the moment it did."""
+    while time.perf_counter() < deadline:
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.01)
+    raise TimeoutError(f"{url} did not reply in time.")
+
+
+async def measure_server(args: argparse.Namespace, env: t.Dict[str, str]) -> t.Tuple[float, float]:
+    """Returns the seconds from spawning the server to it being alive and to it being ready."""
+    base_url = f"http://127.0.0.1:{args.port}"
+    started_at = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(args.port),
+        "--log-level", "warning", env=env)
+    try:
+        async with aiohttp.ClientSession() as session:
+            deadline = started_at + args.timeout
+            alive_at = await wait_for(session, f"{base_url}/healthcheck", deadline)
+            ready_at = await wait_for(session, f"{base_url}/readiness", deadline)
+    finally:
+        if process.returncode is None:
+            process.terminate()
+        await process.wait()
+    return alive_at - started_at, ready_at - started_at
+
+
+def describe(name: str, values: t.List[float]) -> str:
+    return f"{name}: median {statistics.median(values) * 1000:.0f} ms, " \
+           f"min {min(values) * 1000:.0f} ms, max {max(values) * 1000:.0f} ms"
+
+
+async def run(args: argparse.Namespace):
+    env = build_environment(args)
+    import_times = [measure_import(env) for _ in range(args.runs)]
+    print(describe("Import of main", import_times))
+
+    fake_telegram = FakeTelegram(bot_username=BOT_USERNAME, latency=0)
+    runner = web.AppRunner(fake_telegram.build_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.telegram_port).start()
+    try:
+        alive_times, ready_times = [], []
+        for _ in range(args.runs):
+            alive_time, ready_time = await measure_server(args, env)
+            alive_times.append(alive_time)
+            ready_times.append(ready_time)
+    finally:
+        await runner.cleanup()
+    print(describe("Spawn to /healthcheck", alive_times))
+    print(describe("Spawn to /readiness", ready_times))
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
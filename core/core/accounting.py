@@ -0,0 +1,172 @@
+"""
+This module holds the accounting of the user balance and the token usage in the Memorystore (Redis).
+
+The balance and the per model token counters of the user live in the `user_session:{<id>}:balance` hash, apart
+from the user account document, and are only changed by the server side scripts. So the concurrent requests
+of one user, e.g. from several group chats, never lose each other's updates. A request reserves the price of
+its prompt before calling OpenAI and settles the real price afterwards, or releases the reservation on a failure.
+
+The hash is seeded from the user account document by the first script touching it, and it is persisted to
+the Datastore and removed alongside with the document by the listener.
+"""
+import json
+import typing as t
+
+from redis.asyncio.client import Pipeline
+from redis.commands.core import AsyncScript
+
+from core.constants import ChatModel
+from core.exceptions import UnsupportedModelException
+from core.models import UserAccount
+from core.redis_tools import redis_client, dirty_sessions, execute_with_scripts, get_preload_marker_key, \
+    get_shadow_key, get_user_balance_key, schedule_flush
+from core.usage_stats import record_usage
+
+BALANCE_FIELD = "current_balance"
+
+# Every script is called with the balance hash, the shadow key and the preload marker of the user session
+# as the keys and the seed of the hash as the first argument
+SEED_FUNCTION = """
+if redis.call('exists', KEYS[1]) == 0 then
+    redis.call('hset', KEYS[1], unpack(cjson.decode(ARGV[1])))
+end
+"""
+
+# Deducts the amount (the second argument) only if the balance covers it
+RESERVE_SCRIPT = SEED_FUNCTION + """
+local amount = tonumber(ARGV[2])
+local balance = redis.call('hget', KEYS[1], 'current_balance')
+if tonumber(balance) < amount then
+    return {0, balance}
+end
+balance = redis.call('hincrbyfloat', KEYS[1], 'current_balance', -amount)
+redis.call('set', KEYS[2], '')
+redis.call('del', KEYS[3])
+return {1, balance}
+"""
+
+# Adds the amount (the second argument) to the balance and the rest of the arguments to the token counters,
+# the amount is negative if the price exceeds the reservation
+SETTLE_SCRIPT = SEED_FUNCTION + """
+local balance = redis.call('hincrbyfloat', KEYS[1], 'current_balance', ARGV[2])
+for i = 3, #ARGV, 2 do
+    redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('set', KEYS[2], '')
+redis.call('del', KEYS[3])
+return balance
+"""
+
+# Credits the amount (the second argument), storing the user account document (the third argument) under
+# the fourth key unless the session is already there, so the credit is persisted by the listener
+CREDIT_SCRIPT = SEED_FUNCTION + """
+redis.call('set', KEYS[4], ARGV[3], 'NX')
+local balance = redis.call('hincrbyfloat', KEYS[1], 'current_balance', ARGV[2])
+redis.call('set', KEYS[2], '')
+redis.call('del', KEYS[3])
+return balance
+"""
+
+
+def get_usage_field(model: ChatModel) -> str:
+    """Returns the `ModelTokenUsage` field counting the tokens of the model."""
+    match model:
+        case ChatModel.CHAT_GPT_3_5_TURBO:
+            return "gpt_3_5_turbo"
+        case ChatModel.CHAT_GPT_3_5_TURBO_0301:
+            return "gpt_3_5_turbo_0301"
+        case ChatModel.CHAT_GPT_4:
+            return "gpt_4"
+        case _:
+            raise UnsupportedModelException("That model is unsupported.")
+
+
+def build_balance_fields(user_account: UserAccount) -> t.Dict[str, t.Union[float, int]]:
+    """Returns the hash fields of the balance and the token usage of the user account."""
+    fields = {BALANCE_FIELD: user_account.current_balance}
+    for model_field, counters in user_account.model_token_usage.dict().items():
+        for counter, value in counters.items():
+            fields[f"{model_field}:{counter}"] = value
+    return fields
+
+
+def merge_balance(user_data: dict, fields: t.Dict[bytes, bytes]) -> dict:
+    """Overrides the balance and the token usage of the user account data with the hash fields, if any."""
+    for name, value in fields.items():
+        name = name.decode("utf-8")
+        if name == BALANCE_FIELD:
+            user_data[BALANCE_FIELD] = float(value)
+        else:
+            model_field, counter = name.split(":", 1)
+            user_data["model_token_usage"].setdefault(model_field, {})[counter] = int(value)
+    return user_data
+
+
+class UserBalance:
+    """This class is responsible for the atomic changes of the user balance and the token usage."""
+
+    _reserve = redis_client.register_script(RESERVE_SCRIPT)
+    _settle = redis_client.register_script(SETTLE_SCRIPT)
+    _credit = redis_client.register_script(CREDIT_SCRIPT)
+
+    def __init__(self, user_session_key: str):
+        self.user_session_key = user_session_key
+        self.redis_key = get_user_balance_key(user_session_key)
+        self.keys = [self.redis_key, get_shadow_key(user_session_key), get_preload_marker_key(user_session_key)]
+
+    @staticmethod
+    def _get_seed(user_account: UserAccount) -> str:
+        fields = build_balance_fields(user_account)
+        return json.dumps([str(item) for field in fields.items() for item in field])
+
+    async def _run(self, script: AsyncScript, args: list, keys: t.Optional[t.List[str]] = None) -> t.Any:
+        """Runs the script and schedules the flush of the user session within one round trip."""
+
+        async def build(pipe: Pipeline):
+            await script(keys=keys or self.keys, args=args, client=pipe)
+            schedule_flush(pipe, self.user_session_key)
+
+        result, _ = await execute_with_scripts(build, script)
+        return result
+
+    async def get(self, user_account: UserAccount) -> UserAccount:
+        """Returns the user account with the current balance and token usage."""
+        fields = await redis_client.hgetall(self.redis_key)
+        return UserAccount(**merge_balance(user_account.dict(), fields))
+
+    async def reserve(self, user_account: UserAccount, cents: float) -> t.Tuple[bool, float]:
+        """Deducts the cents if the balance covers them, returns whether they were deducted and the balance."""
+        is_reserved, balance = await self._run(self._reserve, args=[self._get_seed(user_account), cents])
+        if is_reserved:
+            dirty_sessions.add(self.user_session_key)
+        return bool(is_reserved), float(balance)
+
+    async def settle(self, user_account: UserAccount, reserved_cents: float, price_cents: float,
+                     model: ChatModel, usage: t.Optional[dict]) -> float:
+        """Charges the price instead of the reservation and counts the tokens of the model, returns the balance.
+
+        Without the usage only the price is charged, e.g. for a cached response, whose tokens were not consumed.
+        The usage aggregates of the admin reports are incremented afterwards.
+        """
+        model_field = get_usage_field(model)
+        counters = {} if usage is None else \
+            {counter: int(usage[counter]) for counter in user_account.model_token_usage.dict()[model_field]}
+        increments = [item for counter, value in counters.items() for item in (f"{model_field}:{counter}", value)]
+        balance = await self._run(self._settle, args=[self._get_seed(user_account), reserved_cents - price_cents,
+                                                      *increments])
+        dirty_sessions.add(self.user_session_key)
+        await record_usage(user_account.user_id, model_field, counters, price_cents)
+        return float(balance)
+
+    async def release(self, user_account: UserAccount, reserved_cents: float) -> float:
+        """Returns the reservation of the failed request to the balance."""
+        balance = await self._run(self._settle, args=[self._get_seed(user_account), reserved_cents])
+        dirty_sessions.add(self.user_session_key)
+        return float(balance)
+
+    async def credit(self, user_account: UserAccount, cents: float, payload: bytes) -> float:
+        """Adds the cents to the balance, `payload` is the encoded user account stored if the session is missing."""
+        balance = await self._run(self._credit, args=[self._get_seed(user_account), cents, payload],
+                                  keys=[*self.keys, self.user_session_key])
+        dirty_sessions.add(self.user_session_key)
+        return float(balance)
@@ -0,0 +1,101 @@
+"""
+This module builds the Telegram application, shared by the webhook server and the update workers.
+"""
+import typing as t
+
+from pydantic import BaseModel
+from telegram.constants import ParseMode
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, filters, MessageHandler, \
+    CallbackContext, ExtBot, ContextTypes, TypeHandler
+
+from core import commands
+from core.bot_core import SoulAIBot
+from core.dispatcher import get_update_chat_key
+from core.outbound import ChatRateLimiter
+from core.settings import get_settings
+
+settings = get_settings()
+
+
+class WebhookUpdate(BaseModel):
+    """Simple pydantic class to wrap a custom update type"""
+
+    user_id: int
+    payload: str
+
+
+class CustomContext(CallbackContext[ExtBot, dict, dict, dict]):
+    """
+    Custom CallbackContext class that makes `user_data` available for updates of type
+    `WebhookUpdate`.
+    """
+
+    @classmethod
+    def from_update(
+            cls,
+            update: object,
+            application: "Application",
+    ) -> "CustomContext":
+        if isinstance(update, WebhookUpdate):
+            return cls(application=application, user_id=update.user_id)
+        return super().from_update(update, application)  # noqa
+
+
+def get_chat_key(update: object) -> t.Hashable:
+    """Serializes the custom updates per user, alongside with the Telegram updates per chat."""
+    if isinstance(update, WebhookUpdate):
+        return update.user_id
+    return get_update_chat_key(update)
+
+
+async def webhook_update(update: WebhookUpdate, context: CustomContext) -> None:
+    """Callback that handles the custom updates."""
+    chat_member = await context.bot.get_chat_member(chat_id=update.user_id, user_id=update.user_id)
+    payloads = context.user_data.setdefault("payloads", [])
+    payloads.append(update.payload)
+    combined_payloads = "</code>\n• <code>".join(payloads)
+    text = (
+        f"The user {chat_member.user.mention_html()} has sent a new payload. "
+        f"So far they have sent the following payloads: \n\n• <code>{combined_payloads}</code>"
+    )
+    await context.bot.send_message(
+        chat_id=context.bot_data["admin_chat_id"], text=text, parse_mode=ParseMode.HTML
+    )
+
+
+def build_application() -> Application:
+    """Builds the application with all the handlers registered, the application is not initialized yet."""
+    context_types = ContextTypes(context=CustomContext)
+    # Here we set updater to None because we want our custom webhook server to handle the updates
+    # and hence we don't need an Updater instance
+    application = (
+        Application.builder()
+        .token(settings.TELEGRAM_BOT_API_TOKEN)
+        .base_url(settings.TELEGRAM_API_BASE_URL)
+        .connection_pool_size(settings.TELEGRAM_OUTBOUND_SETTINGS.CONNECTION_POOL_SIZE)
+        .pool_timeout(settings.TELEGRAM_OUTBOUND_SETTINGS.POOL_TIMEOUT)
+        .rate_limiter(ChatRateLimiter())
+        .updater(None)
+        .context_types(context_types)
+        .build()
+    )
+    application.bot_data["admin_chat_id"] = settings.ADMIN_CHAT_ID
+    soul_ai_bot = SoulAIBot()
+    application.add_handler(CommandHandler(commands.GET_BALANCE, soul_ai_bot.get_balance))
+    application.add_handler(CommandHandler(commands.GET_TOKEN_USAGE, soul_ai_bot.get_token_usage))
+    application.add_handler(CommandHandler(commands.START, soul_ai_bot.start))
+    application.add_handler(CommandHandler(commands.HELP, soul_ai_bot.help))
+    application.add_handler(CommandHandler(commands.GET_TOKENS_FOR_MESSAGE, soul_ai_bot.get_tokens_for_message))
+    application.add_handler(CommandHandler(commands.SET_MAX_TOKENS, soul_ai_bot.set_max_tokens))
+    application.add_handler(CommandHandler(commands.SET_TEMPERATURE, soul_ai_bot.set_temperature))
+    application.add_handler(CommandHandler(commands.SET_MODEL, soul_ai_bot.set_model))
+    application.add_handler(CommandHandler(commands.SET_SYSTEM_MESSAGE, soul_ai_bot.set_system_message))
+    application.add_handler(CommandHandler(commands.GET_SYSTEM_MESSAGE, soul_ai_bot.get_system_message))
+    application.add_handler(CommandHandler(commands.CLEAR_CONTEXT, soul_ai_bot.clear_context))
+    application.add_handler(CommandHandler(commands.ADD_MONEY, soul_ai_bot.add_money))
+    application.add_handler(CommandHandler(commands.USAGE_REPORT, soul_ai_bot.usage_report))
+    application.add_handler(CallbackQueryHandler(soul_ai_bot.query_handler))
+    application.add_handler(CommandHandler(commands.ASK_KNOWLEDGE_GOD, soul_ai_bot.ask_knowledge_god))
+    application.add_handler(MessageHandler(filters.ALL, soul_ai_bot.ai_dialogue))
+    application.add_handler(TypeHandler(type=WebhookUpdate, callback=webhook_update))
+    return application
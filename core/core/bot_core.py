@@ -1,4 +1,6 @@
 import asyncio
+import bisect
+import itertools
 import logging
 import typing as t
 from functools import wraps
@@ -8,14 +10,20 @@ from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ChatType, ChatAction
 from telegram.ext import ContextTypes
 
-from core.constants import TelegramMessages, ChatModel, OPEN_AI_TIMEOUT, SupportedModels
-from core.datastore import UserAccount, Chat, DatastoreManager
-from core.exceptions import TooManyTokensException, UnsupportedModelException
+from core.compaction import schedule_compaction
+from core.completion_cache import completion_cache
+from core.constants import TelegramMessages, ChatModel, OPEN_AI_TIMEOUT, SupportedModels, OPEN_AI_STREAM_TIMEOUT, \
+    STREAM_EDIT_INTERVAL_PRIVATE, STREAM_EDIT_INTERVAL_GROUP, STREAM_PLACEHOLDER, TELEGRAM_MAX_MESSAGE_LENGTH
+from core.datastore import UserAccount, Chat, get_datastore_gateway
+from core.exceptions import TooManyTokensException
+from core.metrics import track_handler, observe_usage
 from core.models import pydantic_model_per_gpt_model, Message
-from core.sessions import ChatSession, UserSession
+from core.sessions import ChatSession, UserSession, atomic_sessions, get_chat_and_user_account
 from core import commands
-from core.open_ai import generate_response, num_tokens_from_messages, UserTokenManager
-from core.settings import Settings
+from core.outbound import keep_chat_action
+from core.open_ai import generate_response, stream_response, UserTokenManager, tokenizer, REPLY_PRIMING_TOKENS
+from core.settings import get_settings
+from core.usage_stats import build_usage_report, find_user_id
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -23,7 +31,7 @@ logging.basicConfig(
 )  # ToDo: move that to main.py
 
 logger = logging.getLogger(__name__)
-settings = Settings()
+settings = get_settings()
 
 
 class SoulAIBot:
@@ -31,18 +39,19 @@ class SoulAIBot:
 
     @staticmethod
     def send_action(action):
-        """Sends `action` while processing func command."""
+        """Shows `action` while processing func command, the handler does not wait for it to be sent."""
 
         def decorator(func):
             @wraps(func)
             async def command_func(cls, update, context, *args, **kwargs):
-                await context.bot.send_chat_action(chat_id=update.effective_message.chat_id, action=action)
-                return await func(cls, update, context, *args, **kwargs)
+                async with keep_chat_action(context.bot, chat_id=update.effective_message.chat_id, action=action):
+                    return await func(cls, update, context, *args, **kwargs)
 
             return command_func
 
         return decorator
 
+    @track_handler
     @send_action(ChatAction.TYPING)
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Starts the bot."""
@@ -81,6 +90,7 @@ class SoulAIBot:
                                        parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
                                        text=full_start_text)
 
+    @track_handler
     @send_action(ChatAction.TYPING)
     async def help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Shows the help message."""
@@ -88,24 +98,30 @@ class SoulAIBot:
         await context.bot.send_message(chat_id=update.effective_chat.id,
                                        text=TelegramMessages.HELP)
 
+    @track_handler
     @send_action(ChatAction.TYPING)
+    @atomic_sessions
     async def get_balance(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_session = UserSession(entity_id=update.effective_user.id, update=update)
-        user_account: UserAccount = user_session.get()
+        user_account: UserAccount = await user_session.balance.get(await user_session.get())
         await context.bot.send_message(chat_id=update.effective_chat.id,
                                        text=f"Your current balance is {user_account.current_balance} "
                                             f"cents or {user_account.current_balance / 100} dollars")
 
+    @track_handler
     @send_action(ChatAction.TYPING)
+    @atomic_sessions
     async def get_token_usage(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_session = UserSession(entity_id=update.effective_chat.id, update=update)
-        user_account: UserAccount = user_session.get()
+        user_account: UserAccount = await user_session.balance.get(await user_session.get())
         token_usage = user_account.model_token_usage
         await context.bot.send_message(chat_id=update.effective_chat.id,
                                        text=TelegramMessages.TOKEN_USAGE.format(token_usage=token_usage),
                                        parse_mode=telegram.constants.ParseMode.MARKDOWN_V2)
 
+    @track_handler
     @send_action(ChatAction.TYPING)
+    @atomic_sessions
     async def get_tokens_for_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         message = ' '.join(update.effective_message.text.split()[1:])
         if not message:
@@ -115,20 +131,14 @@ class SoulAIBot:
             try:
 
                 chat_session = ChatSession(entity_id=update.effective_chat.id, update=update)
-                chat: Chat = chat_session.get()
+                chat: Chat = await chat_session.get()
                 system_message = chat.system_message
                 current_model = chat.open_ai_config.current_model
 
-                messages = [
-                    {
-                        'role': 'user',
-                        'content': message
-                    }
-                ]
-
-                message_token_number = num_tokens_from_messages(messages=messages, model=current_model)
-                system_message_token_number = num_tokens_from_messages(messages=[system_message.dict()],
-                                                                       model=current_model)
+                user_message = Message(role='user', content=message)
+                message_token_number, system_message_token_number = await tokenizer.acount_messages(
+                    [user_message, system_message], model=current_model)
+                message_token_number += REPLY_PRIMING_TOKENS
                 total_token_number = message_token_number + system_message_token_number
                 message_model = pydantic_model_per_gpt_model[current_model](total_tokens=message_token_number)
                 system_message_model = pydantic_model_per_gpt_model[current_model](
@@ -155,16 +165,19 @@ class SoulAIBot:
                 await context.bot.send_message(chat_id=update.effective_chat.id,
                                                text='Sorry, something went wrong. Please, try again later')
 
+    @track_handler
     @send_action(ChatAction.TYPING)
+    @atomic_sessions
     async def set_max_tokens(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             max_tokens = int(update.effective_message.text.split()[1])
 
             chat_session = ChatSession(entity_id=update.effective_chat.id, update=update)
-            chat: Chat = chat_session.get()
+            chat: Chat = await chat_session.get()
             system_message = chat.system_message
-            system_message_token_number = num_tokens_from_messages(messages=[system_message.dict()],
-                                                                   model=chat.open_ai_config.current_model)
+            system_message_token_number, = await tokenizer.acount_messages([system_message],
+                                                                           model=chat.open_ai_config.current_model)
+            system_message_token_number += REPLY_PRIMING_TOKENS
             if max_tokens / 2 < system_message_token_number:
                 await context.bot.send_message(chat_id=update.effective_chat.id,
                                                text='Sorry, but the number of tokens you want to set is too small. '
@@ -172,7 +185,7 @@ class SoulAIBot:
                                                     f' tokens to proceed')
             else:
                 chat.open_ai_config.max_tokens = max_tokens
-                chat_session.set(chat.dict())
+                await chat_session.set_config(chat)
                 await context.bot.send_message(chat_id=update.effective_chat.id,
                                                text=f'You have successfully set the number of tokens to {max_tokens}')
         except IndexError:
@@ -188,19 +201,21 @@ class SoulAIBot:
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text='Sorry, something went wrong. Please, try again later')
 
+    @track_handler
     @send_action(ChatAction.TYPING)
+    @atomic_sessions
     async def set_temperature(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             temperature = float(update.effective_message.text.split()[1])
 
             chat_session = ChatSession(entity_id=update.effective_chat.id, update=update)
-            chat: Chat = chat_session.get()
+            chat: Chat = await chat_session.get()
             if temperature < 0.0 or temperature > 1.0:
                 await context.bot.send_message(chat_id=update.effective_chat.id,
                                                text='Please, send me a number between 0.0 and 1.0')
             else:
                 chat.open_ai_config.temperature = temperature
-                chat_session.set(chat.dict())
+                await chat_session.set_config(chat)
                 await context.bot.send_message(chat_id=update.effective_chat.id,
                                                text=f'You have successfully set the temperature to {temperature}')
 
@@ -217,6 +232,7 @@ class SoulAIBot:
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text='Sorry, something went wrong. Please, try again later')
 
+    @track_handler
     @send_action(ChatAction.TYPING)
     async def set_model(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
@@ -233,15 +249,17 @@ class SoulAIBot:
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text='Sorry, something went wrong. Please, try again later')
 
+    @track_handler
     @send_action(ChatAction.TYPING)
+    @atomic_sessions
     async def set_model_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
 
             chat_session = ChatSession(entity_id=update.effective_chat.id, update=update)
-            chat: Chat = chat_session.get()
+            chat: Chat = await chat_session.get()
             model = SupportedModels(update.callback_query.data)
             chat.open_ai_config.current_model = ChatModel(model.value)
-            chat_session.set(chat.dict())
+            await chat_session.set_config(chat)
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text=f'You have successfully set the model to '
                                                 f'{chat.open_ai_config.current_model.value}')
@@ -251,7 +269,9 @@ class SoulAIBot:
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text='Sorry, something went wrong. Please, try again later')
 
+    @track_handler
     @send_action(ChatAction.TYPING)
+    @atomic_sessions
     async def set_system_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             system_message = ' '.join(update.effective_message.text.split()[1:])
@@ -259,15 +279,16 @@ class SoulAIBot:
                                      role='system')
 
             chat_session = ChatSession(entity_id=update.effective_chat.id, update=update)
-            system_message_token_number = num_tokens_from_messages(messages=[system_message.dict()],
-                                                                   model=chat_session.get().open_ai_config.current_model)
-            chat: Chat = chat_session.get()
+            chat: Chat = await chat_session.get()
+            system_message_token_number, = await tokenizer.acount_messages([system_message],
+                                                                           model=chat.open_ai_config.current_model)
+            system_message_token_number += REPLY_PRIMING_TOKENS
             if system_message_token_number > 10:
 
                 if system_message_token_number < chat.open_ai_config.max_tokens / 2:
                     # ToDo: get rid of that shitty validation
                     chat.system_message = system_message
-                    chat_session.set(chat.dict())
+                    await chat_session.set_config(chat)
                     await context.bot.send_message(chat_id=update.effective_chat.id,
                                                    text='You have successfully set the system message!')
                 else:
@@ -289,11 +310,13 @@ class SoulAIBot:
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text='Sorry, something went wrong. Please, try again later')
 
+    @track_handler
     @send_action(ChatAction.TYPING)
+    @atomic_sessions
     async def get_system_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             chat_session = ChatSession(entity_id=update.effective_chat.id, update=update)
-            chat: Chat = chat_session.get()
+            chat: Chat = await chat_session.get()
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text=chat.system_message.dict().get('content', 'No system message set'))
 
@@ -302,14 +325,15 @@ class SoulAIBot:
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text='Sorry, something went wrong. Please, try again later')
 
+    @track_handler
     @send_action(ChatAction.TYPING)
+    @atomic_sessions
     async def clear_context(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
 
             chat_session = ChatSession(entity_id=update.effective_chat.id, update=update)
-            chat: Chat = chat_session.get()
-            chat.messages = []
-            chat_session.set(chat.dict())
+            chat: Chat = await chat_session.get()
+            await chat_session.clear_history(chat)
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text='You have successfully cleared the context!')
         except Exception:
@@ -317,6 +341,8 @@ class SoulAIBot:
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text='Sorry, something went wrong. Please, try again later')
 
+    @track_handler
+    @atomic_sessions
     async def add_money(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             user_id = update.effective_user.id
@@ -333,14 +359,16 @@ class SoulAIBot:
                     username = update.effective_message.text[entity.offset:entity.offset + entity.length]
                     mentioned_user = entity.user
                     if not mentioned_user:
-                        datastore_manager = DatastoreManager()
-                        user_account_entity = datastore_manager.get_user_account_by_username(username)
-                        if not user_account_entity:
-                            await context.bot.send_message(chat_id=update.effective_chat.id,
-                                                           text='User not found. Maybe he is not in the chat or hav'
-                                                                'en\`t speak to me yet')
-                            return
-                        mentioned_user_id = user_account_entity.get('user_id')
+                        mentioned_user_id = await find_user_id(username)
+                        if mentioned_user_id is None:
+                            # The users not written since the username index exists are looked up in the Datastore
+                            user_account_entity = await get_datastore_gateway().get_user_account_by_username(username)
+                            if not user_account_entity:
+                                await context.bot.send_message(chat_id=update.effective_chat.id,
+                                                               text='User not found. Maybe he is not in the chat or '
+                                                                    'haven\`t speak to me yet')
+                                return
+                            mentioned_user_id = user_account_entity.get('user_id')
                     else:
                         mentioned_user = context.bot.get_chat_member(chat_id=update.effective_message.chat_id,
                                                                      user_id=mentioned_user.id)
@@ -351,15 +379,18 @@ class SoulAIBot:
                 await context.bot.send_message(chat_id=update.effective_chat.id,
                                                text='Please, mention the user you want to add money to')
                 return
-            datastore_manager = DatastoreManager()
-            if not user_account_entity:
-                user_account_entity, _, _ = datastore_manager.get_or_create_user_account_entity(
+
+            # The Datastore is queried only if the user session is not in Redis
+            async def fetch_user_account_entity() -> dict:
+                if user_account_entity:
+                    return user_account_entity
+                entity, _, _ = await get_datastore_gateway().get_or_create_user_account_entity(
                     data={"user_id": mentioned_user_id,
                           "username": username})
-            user_account: UserAccount = UserAccount(**user_account_entity)
-            user_account.current_balance += 200
+                return entity
+
             user_session = UserSession(entity_id=mentioned_user_id, update=update)
-            user_session.set(user_account.dict())
+            await user_session.credit(cents=200, fetch_entity=fetch_user_account_entity)
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text='Deal!')
         except Exception:
@@ -367,41 +398,85 @@ class SoulAIBot:
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text='Sorry, something went wrong. Please, try again later')
 
+    @track_handler
+    async def usage_report(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            if update.effective_user.id != int(settings.ADMIN_CHAT_ID):
+                await context.bot.send_message(chat_id=update.effective_chat.id,
+                                               text='You are not allowed to do this')
+                return
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=await build_usage_report())
+        except Exception:
+            logging.exception('Error in usage_report')
+            await context.bot.send_message(chat_id=update.effective_chat.id,
+                                           text='Sorry, something went wrong. Please, try again later')
+
+    @track_handler
     @send_action(ChatAction.TYPING)
+    @atomic_sessions
     async def ask_knowledge_god(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
                                 is_replied_to_bot: bool,
                                 bot_message: str):
         try:
             chat_session = ChatSession(entity_id=update.effective_chat.id, update=update)
             user_session = UserSession(entity_id=update.effective_user.id, update=update)
-            chat: Chat = chat_session.get()
-            user_account: UserAccount = user_session.get()
+            chat, user_account = await get_chat_and_user_account(chat_session, user_session)
         except Exception:
             logging.exception('During ask_knowledge_god something went wrong')
             response = "I'm sorry, I have some problems... Please, try again later."
             await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
             return
+        user_manager = UserTokenManager(user_account=user_account, chat=chat)
         try:
-            messages, tokens_count = get_normalized_chat_messages(chat=chat, chat_session=chat_session,
-                                                                  is_replied_to_bot=is_replied_to_bot,
-                                                                  bot_message=bot_message)
+            messages, tokens_count = await get_normalized_chat_messages(chat=chat, chat_session=chat_session,
+                                                                        is_replied_to_bot=is_replied_to_bot,
+                                                                        bot_message=bot_message)
 
-            user_manager = UserTokenManager(user_account=user_account, chat=chat)
-            is_user_allowed_to_talk = user_manager.can_user_ask_ai()
+            is_user_allowed_to_talk = await user_manager.can_user_ask_ai(user_session.balance)
             if is_user_allowed_to_talk:
+                schedule_compaction(chat, prompt_tokens=tokens_count, chat_session=chat_session,
+                                    user_session=user_session, user_account=user_account)
+            is_cacheable = is_user_allowed_to_talk and completion_cache.is_cacheable(chat)
+            cached_completion = await completion_cache.get(chat, messages) if is_cacheable else None
+            if cached_completion is not None:
+                response, usage = cached_completion
+                await post_ai_response_logic(usage=usage,
+                                             response=response,
+                                             chat=chat,
+                                             user_manager=user_manager,
+                                             chat_session=chat_session,
+                                             user_session=user_session,
+                                             is_cached=True)
+            elif is_user_allowed_to_talk and settings.OPEN_AI_SETTINGS.STREAM_RESPONSES:
+                response, usage, is_complete = await stream_ai_response(context=context, chat=chat,
+                                                                        messages=messages, prompt_tokens=tokens_count)
+                if is_cacheable and is_complete:
+                    await completion_cache.set(chat, messages, response=response, usage=usage)
+                await post_ai_response_logic(usage=usage,
+                                             response=response,
+                                             chat=chat,
+                                             user_manager=user_manager,
+                                             chat_session=chat_session,
+                                             user_session=user_session)
+                return
+            elif is_user_allowed_to_talk:
 
                 open_ai_response = await asyncio.wait_for(generate_response(messages=messages,
                                                                             model=chat.open_ai_config.current_model,
                                                                             max_tokens=chat.open_ai_config.max_tokens,
-                                                                            temperature=chat.open_ai_config.temperature),
+                                                                            temperature=chat.open_ai_config.temperature,
+                                                                            prompt_tokens=tokens_count,
+                                                                            is_private=chat.chat_id > 0),
                                                           timeout=OPEN_AI_TIMEOUT)
 
                 logging.info("Response: {}".format(open_ai_response))
                 response = open_ai_response.choices[0].message.content
-                await post_ai_response_logic(open_ai_response=open_ai_response,
+                if is_cacheable:
+                    await completion_cache.set(chat, messages, response=response, usage=open_ai_response['usage'])
+                await post_ai_response_logic(usage=open_ai_response['usage'],
                                              response=response,
                                              chat=chat,
-                                             user_account=user_account,
+                                             user_manager=user_manager,
                                              chat_session=chat_session,
                                              user_session=user_session)
             else:
@@ -413,20 +488,23 @@ class SoulAIBot:
             await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
         except asyncio.TimeoutError:
             logging.exception('During ask_knowledge_god something timeout exception raised')
+            await user_manager.release(user_session.balance)
             response = "Sorry, i was trying to get response from OpenAI, but it took too long. Please, try again later."
-            chat_data = chat.dict()
-            chat_data['messages'].pop()  # get last user message
-            chat_session.set(chat_data)
+            chat.messages.pop()  # get last user message
+            await chat_session.pop_last_message()
             await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
         except TooManyTokensException:
             logging.exception('During ask_knowledge_god something went wrong')
+            await user_manager.release(user_session.balance)
             response = "Sorry, I can't answer that. Too many tokens."
             await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
         except Exception:
             logging.exception('During ask_knowledge_god something went wrong')
+            await user_manager.release(user_session.balance)
             response = "I'm sorry, I have some problems with my brain. Please, try again later."
             await context.bot.send_message(chat_id=update.effective_chat.id, text=response)
 
+    @track_handler
     async def ai_dialogue(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         try:
@@ -454,6 +532,7 @@ class SoulAIBot:
             ...
         return is_replied_to_bot, bot_message
 
+    @track_handler
     async def query_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
 
@@ -475,62 +554,171 @@ class SoulAIBot:
             case commands.SET_SYSTEM_MESSAGE:
                 await self.set_system_message(update, context)  # ToDo: implement
             case commands.ASK_KNOWLEDGE_GOD:
-                update.effective_message.text = f"Hi!"
-                await self.ask_knowledge_god(update, context)
+                await query.answer()
+                await self.ask_knowledge_god(get_greeting_update(update), context, is_replied_to_bot=False,
+                                             bot_message=None)
             case SupportedModels.CHAT_GPT_3_5_TURBO_0301.value:
                 await self.set_model_callback(update, context)
             case _:
                 await update.callback_query.answer(text="Sorry, I don't know what to do with this button")
 
 
-def get_normalized_chat_messages(chat: Chat, chat_session: ChatSession, is_replied_to_bot=False,
-                                 bot_message=None) -> t.Tuple[t.List[dict[t.Any, t.Any]], int]:
+def get_greeting_update(update: Update) -> Update:
+    """Returns the update of the "Hi!" message sent on behalf of the user who pressed the button."""
+    query = update.callback_query
+    message = telegram.Message(message_id=query.message.message_id, date=query.message.date,
+                               chat=query.message.chat, from_user=query.from_user, text="Hi!")
+    greeting_update = Update(update_id=update.update_id, message=message)
+    greeting_update.set_bot(update.get_bot())
+    message.set_bot(update.get_bot())
+    return greeting_update
+
+
+async def get_normalized_chat_messages(chat: Chat, chat_session: ChatSession, is_replied_to_bot=False,
+                                       bot_message=None) -> t.Tuple[t.List[dict[t.Any, t.Any]], int]:
+    """Returns the newest messages of the chat which fit into `max_tokens` alongside with the system message
+    and the summary of the older ones.
+
+    Every message carries its cached token number, so trimming is a binary search over the prefix sums of
+    those numbers and only the messages never counted before go through the tokenizer.
+    """
     if is_replied_to_bot:
         last_message = chat.messages.pop()
         intro, user_message = last_message.content.split(':', 1)
         last_message.content = f"{intro}```{user_message}``` on your message which starts with ```{bot_message[:100]}```"
+        last_message.token_count = None  # the content has changed, so the cached number is stale
         chat.messages.append(last_message)
-    chat_data = chat.dict()
-    chat_messages = chat_data['messages']
     model: ChatModel = chat.open_ai_config.current_model
-    messages_tokens_num = num_tokens_from_messages(chat_messages, model=model)
-    system_message = chat.system_message.dict()
-    system_message_tokens_num = num_tokens_from_messages([system_message], model=model)
-    if system_message_tokens_num > chat.open_ai_config.max_tokens:  # Make sure that infinity loop is impossible
+    max_tokens = chat.open_ai_config.max_tokens
+    context_messages = chat.get_context_messages()
+    tokens = await tokenizer.acount_messages(context_messages + chat.messages, model=model)
+    system_message_tokens_num = sum(tokens[:len(context_messages)]) + REPLY_PRIMING_TOKENS
+    message_tokens = tokens[len(context_messages):]
+    if is_replied_to_bot:
+        await chat_session.set_last_message(chat.messages[-1])
+    if system_message_tokens_num > max_tokens:  # Make sure that infinity loop is impossible
         raise TooManyTokensException(f"System message is too long. {system_message_tokens_num}."
-                                     f" Max input tokens configured for that that is: {chat.open_ai_config.max_tokens}")
-    all_messages_tokens_num = messages_tokens_num + system_message_tokens_num
-    if all_messages_tokens_num > chat.open_ai_config.max_tokens:
+                                     f" Max input tokens configured for that that is: {max_tokens}")
+    prefix_sums = [0, *itertools.accumulate(message_tokens)]
+    excess_tokens_num = prefix_sums[-1] + system_message_tokens_num - max_tokens
+    dropped_messages_num = 0
+    if excess_tokens_num > 0:
+        # The smallest number of the oldest messages, whose tokens cover the excess
+        dropped_messages_num = bisect.bisect_left(prefix_sums, excess_tokens_num)
+        chat.messages = chat.messages[dropped_messages_num:]
+        await chat_session.trim_messages(keep_last=len(chat.messages))
+    all_messages_tokens_num = prefix_sums[-1] - prefix_sums[dropped_messages_num] + system_message_tokens_num
+    messages = [message.to_prompt() for message in context_messages + chat.messages]
+    return messages, all_messages_tokens_num
+
+
+async def stream_ai_response(context: ContextTypes.DEFAULT_TYPE, chat: Chat, messages: t.List[dict],
+                             prompt_tokens: int) -> t.Tuple[str, dict, bool]:
+    """Streams the OpenAI response into a placeholder message, editing it as the content arrives.
+
+    The edits are throttled to the Telegram per-chat limits. If the stream times out after the first token,
+    the partial answer is kept. Returns the response alongside with the usage counted from the streamed tokens
+    and whether the response is complete.
+    """
+    loop = asyncio.get_running_loop()
+    is_private = chat.chat_id > 0  # group chat identifiers are negative
+    edit_interval = STREAM_EDIT_INTERVAL_PRIVATE if is_private else STREAM_EDIT_INTERVAL_GROUP
+    placeholder_task = asyncio.create_task(context.bot.send_message(chat_id=chat.chat_id, text=STREAM_PLACEHOLDER))
+    edit_task: t.Optional[asyncio.Task] = None
+    chunks = []
+    is_complete = True
+    last_edit_at = loop.time()
+    started_at = loop.time()
+
+    async def edit(text: str, max_retries: t.Optional[int] = None):
+        placeholder = await placeholder_task
+        rate_limit_args = None if max_retries is None else {"max_retries": max_retries}  # see `ChatRateLimiter`
         try:
-            while all_messages_tokens_num > chat.open_ai_config.max_tokens:
-                chat_messages.pop(0)
-                all_messages_tokens_num = num_tokens_from_messages(chat_messages,
-                                                                   model=model) + system_message_tokens_num
-        finally:
-            chat_session.set(chat_data)
-    return [system_message] + chat_messages, all_messages_tokens_num
-
-
-async def post_ai_response_logic(open_ai_response, response: str, chat: Chat, user_account: UserAccount,
-                                 chat_session: ChatSession, user_session: UserSession):
-    logging.info("Response: {}".format(open_ai_response))
-    usage: dict = open_ai_response['usage']
+            await context.bot.edit_message_text(chat_id=chat.chat_id, message_id=placeholder.message_id,
+                                                text=text[:TELEGRAM_MAX_MESSAGE_LENGTH],
+                                                rate_limit_args=rate_limit_args)
+        except telegram.error.RetryAfter as exp:
+            logger.debug(f"Skipping the streamed edit, Telegram asks to retry after {exp.retry_after}.")
+        except telegram.error.BadRequest:
+            logger.debug("Skipping the streamed edit, the message is not modified.")
+
+    try:
+        async with asyncio.timeout(OPEN_AI_TIMEOUT) as timeout:
+            async for content in stream_response(messages=messages,
+                                                 model=chat.open_ai_config.current_model,
+                                                 max_tokens=chat.open_ai_config.max_tokens,
+                                                 temperature=chat.open_ai_config.temperature,
+                                                 prompt_tokens=prompt_tokens,
+                                                 is_private=is_private):
+                if not chunks:  # the first token has arrived, so the whole response gets more time
+                    timeout.reschedule(started_at + OPEN_AI_STREAM_TIMEOUT)
+                chunks.append(content)
+                if loop.time() - last_edit_at >= edit_interval and (edit_task is None or edit_task.done()):
+                    # The intermediate edits are skipped rather than retried, the next one is coming anyway
+                    edit_task = asyncio.create_task(edit(''.join(chunks), max_retries=0))
+                    last_edit_at = loop.time()
+    except Exception as exp:
+        if edit_task is not None:
+            await edit_task
+        if chunks and isinstance(exp, TimeoutError):
+            logger.warning("OpenAI stream timed out, keeping the partial response.")
+            is_complete = False
+        else:
+            await discard_placeholder(context=context, chat_id=chat.chat_id, placeholder_task=placeholder_task)
+            raise
+    else:
+        if edit_task is not None:
+            await edit_task
+
+    response = ''.join(chunks)
+    if response:
+        await edit(response)
+        for offset in range(TELEGRAM_MAX_MESSAGE_LENGTH, len(response), TELEGRAM_MAX_MESSAGE_LENGTH):
+            await context.bot.send_message(chat_id=chat.chat_id,
+                                           text=response[offset:offset + TELEGRAM_MAX_MESSAGE_LENGTH])
+    completion_tokens, = tokenizer.count_texts([response], model=chat.open_ai_config.current_model)
+    usage = {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+    }
+    observe_usage(model=chat.open_ai_config.current_model, usage=usage)
+    return response, usage, is_complete
+
+
+async def discard_placeholder(context: ContextTypes.DEFAULT_TYPE, chat_id: int, placeholder_task: asyncio.Task):
+    """Removes the placeholder of the response which has never started streaming."""
+    if not placeholder_task.done():
+        placeholder_task.cancel()
+        return
+    if placeholder_task.cancelled() or placeholder_task.exception() is not None:
+        return
+    try:
+        await context.bot.delete_message(chat_id=chat_id, message_id=placeholder_task.result().message_id)
+    except telegram.error.TelegramError:
+        logger.debug("Could not delete the response placeholder.")
+
+
+async def post_ai_response_logic(usage: dict, response: str, chat: Chat, user_manager: UserTokenManager,
+                                 chat_session: ChatSession, user_session: UserSession, is_cached: bool = False):
+    """Bills the user for the response and saves it to the chat.
+
+    The price replaces the reservation made by `UserTokenManager.can_user_ask_ai`. The cached responses are
+    billed with the price of their original usage, scaled by `HIT_PRICE_SHARE`, without counting their tokens,
+    as none were consumed.
+    """
+    logging.info("Usage: {}".format(usage))
     pd_model = pydantic_model_per_gpt_model[
         chat.open_ai_config.current_model](**usage)
-    match chat.open_ai_config.current_model:
-        case ChatModel.CHAT_GPT_3_5_TURBO:
-            user_account.model_token_usage.gpt_3_5_turbo += pd_model
-        case ChatModel.CHAT_GPT_3_5_TURBO_0301:
-            user_account.model_token_usage.gpt_3_5_turbo_0301 += pd_model
-        case ChatModel.CHAT_GPT_4:
-            user_account.model_token_usage.gpt_4 += pd_model
-        case _:
-            raise UnsupportedModelException("That model is unsupported.")
-    user_account.current_balance -= pd_model.calculate_price() * 100
+    price_cents = pd_model.calculate_price() * 100
+    if is_cached:
+        price_cents *= settings.COMPLETION_CACHE_SETTINGS.HIT_PRICE_SHARE
+    await user_manager.settle(user_session.balance, usage=None if is_cached else usage, price_cents=price_cents)
     assistant_message = {
         'role': 'assistant',
         'content': response,
     }
-    chat.messages.append(Message(**assistant_message))
-    chat_session.set(entity=chat.dict())
-    user_session.set(entity=user_account.dict())
+    assistant_message = Message(**assistant_message)
+    tokenizer.count_messages([assistant_message], model=chat.open_ai_config.current_model)
+    chat.messages.append(assistant_message)
+    await chat_session.append_messages(assistant_message)
@@ -0,0 +1,110 @@
+"""
+This module holds the codecs of the session payloads stored in the Memorystore (Redis).
+
+Every payload starts with a one byte header holding the codec version, so the codec can be changed without
+migrating the stored sessions. The payloads written before the header was introduced are plain JSON and are
+still read transparently.
+"""
+import json
+import typing as t
+import zlib
+
+import msgpack
+
+from core.settings import get_settings
+
+settings = get_settings()
+
+JSON_PAYLOAD_STARTS = (ord("{"), ord("["))  # the payloads written before the codec versioning
+
+
+class Codec:
+    """The base class of the payload codecs."""
+
+    VERSION: int
+
+    def encode(self, data: t.Any) -> bytes:
+        raise NotImplementedError("This method should be implemented in the child class.")
+
+    def decode(self, payload: bytes) -> t.Any:
+        raise NotImplementedError("This method should be implemented in the child class.")
+
+
+class JsonCodec(Codec):
+    VERSION = 1
+
+    def encode(self, data: t.Any) -> bytes:
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+    def decode(self, payload: bytes) -> t.Any:
+        return json.loads(payload)
+
+
+class MsgPackCodec(Codec):
+    VERSION = 2
+
+    def encode(self, data: t.Any) -> bytes:
+        return msgpack.packb(data)
+
+    def decode(self, payload: bytes) -> t.Any:
+        return msgpack.unpackb(payload)
+
+
+class CompressedCodec(Codec):
+    """Compresses the payloads of the wrapped codec, the version is shifted by 100."""
+
+    def __init__(self, codec: Codec, level: int):
+        self.codec = codec
+        self.level = level
+        self.VERSION = codec.VERSION + 100
+
+    def encode(self, data: t.Any) -> bytes:
+        return zlib.compress(self.codec.encode(data), self.level)
+
+    def decode(self, payload: bytes) -> t.Any:
+        return self.codec.decode(zlib.decompress(payload))
+
+
+class SessionCodec:
+    """This class is responsible for encoding and decoding the session payloads.
+
+    The payloads are written with the configured codec and compressed when they are larger than the threshold,
+    while any known codec version is read.
+    """
+
+    def __init__(self, codec: Codec, compression_threshold: int, compression_level: int):
+        self.codec = codec
+        self.compressed_codec = CompressedCodec(codec, level=compression_level)
+        self.compression_threshold = compression_threshold
+        self.codecs: t.Dict[int, Codec] = {}
+        for known_codec in (JsonCodec(), MsgPackCodec()):
+            self.codecs[known_codec.VERSION] = known_codec
+            compressed = CompressedCodec(known_codec, level=compression_level)
+            self.codecs[compressed.VERSION] = compressed
+
+    def encode(self, data: t.Any) -> bytes:
+        payload = self.codec.encode(data)
+        if len(payload) < self.compression_threshold:
+            return bytes([self.codec.VERSION]) + payload
+        return bytes([self.compressed_codec.VERSION]) + zlib.compress(payload, self.compressed_codec.level)
+
+    def decode(self, payload: t.Union[bytes, str]) -> t.Any:
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if payload[0] in JSON_PAYLOAD_STARTS:
+            return json.loads(payload)
+        try:
+            codec = self.codecs[payload[0]]
+        except KeyError:
+            raise ValueError(f"Unknown session codec version: {payload[0]}.")
+        return codec.decode(payload[1:])
+
+
+CODECS_BY_NAME = {
+    "json": JsonCodec,
+    "msgpack": MsgPackCodec,
+}
+
+session_codec = SessionCodec(codec=CODECS_BY_NAME[settings.SESSION_CODEC_SETTINGS.CODEC](),
+                             compression_threshold=settings.SESSION_CODEC_SETTINGS.COMPRESSION_THRESHOLD,
+                             compression_level=settings.SESSION_CODEC_SETTINGS.COMPRESSION_LEVEL)
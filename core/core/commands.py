@@ -15,4 +15,5 @@ SET_TEMPERATURE = "set_temperature"
 GET_SYSTEM_MESSAGE = "get_system_message"
 CLEAR_CONTEXT = "clear_context"
 START = "start"
-ADD_MONEY = "add_money"
\ No newline at end of file
+ADD_MONEY = "add_money"
+USAGE_REPORT = "usage_report"
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""
+This module holds the compaction of the chat history into a rolling summary.
+
+Once the prompt takes more than `THRESHOLD` of the `max_tokens` budget, the oldest messages beyond the newest
+`KEEP_SHARE` of the budget are folded, alongside with the previous summary, into a new summary kept beside
+the system message. So the prompt stays bounded without forgetting the context. The summary is requested
+in the background, off the reply path, through the same OpenAI plumbing and billed to the user who triggered it.
+Its price, the longest summary included, is reserved beforehand, the compaction is skipped if the balance
+does not cover it.
+"""
+import asyncio
+import contextvars
+import logging
+import typing as t
+
+from core.models import Chat, Message, UserAccount, pydantic_model_per_gpt_model
+from core.open_ai import REPLY_PRIMING_TOKENS, UserTokenManager, generate_response, tokenizer
+from core.sessions import ChatSession, UserSession
+from core.settings import get_settings
+
+settings = get_settings()
+compaction_settings = settings.HISTORY_COMPACTION_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_INSTRUCTION = "Summarize the conversation below for yourself, in the language it is held in. " \
+                      "Keep the facts, names, preferences, decisions and open questions needed to continue it. " \
+                      "Reply with the summary only."
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+MIN_FOLDED_MESSAGES = 2
+
+_compacting: t.Set[int] = set()  # the chats being compacted within the process
+_tasks: t.Set[asyncio.Task] = set()
+
+
+def select_folded_messages(chat: Chat) -> t.List[Message]:
+    """Returns the oldest messages beyond the newest ones which fit into `KEEP_SHARE` of the budget."""
+    budget = compaction_settings.KEEP_SHARE * chat.open_ai_config.max_tokens
+    kept_tokens_num = 0
+    kept_messages_num = 0
+    for message in reversed(chat.messages):
+        kept_tokens_num += message.token_count or 0
+        if kept_tokens_num > budget:
+            break
+        kept_messages_num += 1
+    return chat.messages[:len(chat.messages) - kept_messages_num]
+
+
+def schedule_compaction(chat: Chat, prompt_tokens: int, chat_session: ChatSession, user_session: UserSession,
+                        user_account: UserAccount):
+    """Starts the compaction in the background if the prompt is close to the budget."""
+    if not compaction_settings.ENABLED or chat.chat_id in _compacting:
+        return
+    if prompt_tokens <= compaction_settings.THRESHOLD * chat.open_ai_config.max_tokens:
+        return
+    folded = select_folded_messages(chat)
+    if len(folded) < MIN_FOLDED_MESSAGES:
+        return
+    _compacting.add(chat.chat_id)
+    # A fresh context, so the task does not join the unit of work of the handler
+    coroutine = compact_history(chat.copy(exclude={"messages"}, deep=True), folded, chat_session=chat_session,
+                                user_session=user_session, user_account=user_account)
+    task = asyncio.create_task(coroutine, context=contextvars.Context())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def wait_for_compactions(timeout: float):
+    """Waits for the compactions in progress, should be called when the application is about to stop."""
+    if _tasks:
+        await asyncio.wait(_tasks, timeout=timeout)
+
+
+async def compact_history(chat: Chat, folded: t.List[Message], chat_session: ChatSession, user_session: UserSession,
+                          user_account: UserAccount):
+    """Folds the messages into the summary and replaces them with it in the chat history."""
+    model = chat.open_ai_config.current_model
+    # A copy, so the handler's user account is not changed from the background
+    user_manager = UserTokenManager(user_account=user_account.copy(), chat=chat)
+    try:
+        conversation = [chat.summary.content] if chat.summary else []
+        conversation.extend(f"{message.role}: {message.content}" for message in folded)
+        request = [Message(role="system", content=SUMMARY_INSTRUCTION),
+                   Message(role="user", content="\n".join(conversation))]
+        # The whole request is counted, the instruction and the previous summary included
+        prompt_tokens = sum(await tokenizer.acount_messages(request, model=model)) + REPLY_PRIMING_TOKENS
+        reserved_cents = (user_manager.count_tokens_to_dollars(prompt_tokens, is_prompt=True)
+                          + user_manager.count_tokens_to_dollars(compaction_settings.SUMMARY_MAX_TOKENS)) * 100
+        if not await user_manager.reserve(user_session.balance, reserved_cents):
+            logger.debug(f"The balance does not cover the summary of the chat {chat.chat_id}, skipping it.")
+            return
+        open_ai_response = await generate_response(messages=[message.to_prompt() for message in request],
+                                                   model=model,
+                                                   max_tokens=compaction_settings.SUMMARY_MAX_TOKENS,
+                                                   temperature=0,
+                                                   prompt_tokens=prompt_tokens,
+                                                   is_private=chat.chat_id > 0)
+        usage = open_ai_response["usage"]
+        price_cents = pydantic_model_per_gpt_model[model](**usage).calculate_price() * 100
+        await user_manager.settle(user_session.balance, usage=usage, price_cents=price_cents)
+        summary = Message(role="system", content=SUMMARY_PREFIX + open_ai_response.choices[0].message.content)
+        tokenizer.count_messages([summary], model=model)
+        if await chat_session.apply_summary(summary, folded):
+            logger.debug(f"{len(folded)} message(s) of the chat {chat.chat_id} were folded into the summary.")
+        else:
+            logger.debug(f"The history of the chat {chat.chat_id} was changed, the summary is dropped.")
+    except Exception:
+        logger.exception(f"Compacting the history of the chat {chat.chat_id} failed.")
+        await user_manager.release(user_session.balance)
+    finally:
+        _compacting.discard(chat.chat_id)
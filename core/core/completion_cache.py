@@ -0,0 +1,119 @@
+"""
+This module holds the cache of the OpenAI completions in the Memorystore (Redis).
+
+A completion is reused only for the same conversation asked under the same configuration: the model, the temperature,
+the max tokens and the whole trimmed message window, the system message and the summary included, make up the key.
+The user messages are normalized: the "<name> says:" author prefixes are stripped and the case and the whitespace
+are folded, so the same greeting of different users starting a chat hits the same entry. The answers mentioning
+the name of any author of the window are not cached, as they are addressed to that author.
+Only the low temperature prompts are cached, as their answers are close to deterministic. The entries expire after
+`TTL` seconds, while a sorted set of the last access moments keeps the cache within `MAX_SIZE` entries by evicting
+the least recently used ones.
+"""
+import hashlib
+import json
+import logging
+import re
+import time
+import typing as t
+
+from core.codec import session_codec
+from core.metrics import COMPLETION_CACHE_LOOKUPS
+from core.models import Chat
+from core.redis_tools import redis_client
+from core.settings import get_settings
+
+settings = get_settings()
+cache_settings = settings.COMPLETION_CACHE_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+COMPLETION_CACHE_PREFIX = "{completion_cache}"  # the hash tag keeps the entries in the slot of the index
+INDEX_KEY = f"{COMPLETION_CACHE_PREFIX}:index"  # the entries scored by their last access moment
+# The replies to the bot quote the message right after "<name> says", see `get_normalized_chat_messages`
+AUTHOR_PREFIX_PATTERN = re.compile(r"^(?P<author>[^\n]*?) says(?::|(?=```))")
+
+# Stores the entry (the first key) and evicts the least recently used entries beyond the size limit
+STORE_SCRIPT = """
+redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('zadd', KEYS[2], ARGV[3], KEYS[1])
+local excess = redis.call('zcard', KEYS[2]) - tonumber(ARGV[4])
+if excess > 0 then
+    local evicted = redis.call('zrange', KEYS[2], 0, excess - 1)
+    redis.call('del', unpack(evicted))
+    redis.call('zremrangebyrank', KEYS[2], 0, excess - 1)
+end
+return 1
+"""
+
+
+class CompletionCache:
+    """This class is responsible for storing and reusing the completions of the deterministic prompts."""
+
+    def __init__(self):
+        self._store = redis_client.register_script(STORE_SCRIPT)
+
+    @staticmethod
+    def is_cacheable(chat: Chat) -> bool:
+        return cache_settings.ENABLED and chat.open_ai_config.temperature <= cache_settings.MAX_TEMPERATURE
+
+    @staticmethod
+    def get_key(chat: Chat, messages: t.List[dict]) -> str:
+        context_messages_num = len(chat.get_context_messages())
+        window = messages[:context_messages_num] + [
+            {"role": message["role"], "content": normalize_content(message["content"])}
+            for message in messages[context_messages_num:]
+        ]
+        prompt = json.dumps([chat.open_ai_config.current_model, chat.open_ai_config.temperature,
+                             chat.open_ai_config.max_tokens, window], sort_keys=True)
+        return f"{COMPLETION_CACHE_PREFIX}:{hashlib.sha256(prompt.encode('utf-8')).hexdigest()}"
+
+    async def get(self, chat: Chat, messages: t.List[dict]) -> t.Optional[t.Tuple[str, dict]]:
+        """Returns the cached response alongside with its usage, or None on a miss."""
+        key = self.get_key(chat, messages)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.zadd(INDEX_KEY, {key: time.time()}, xx=True)  # refreshes the last access of the existing entry
+            payload, _ = await pipe.execute()
+        COMPLETION_CACHE_LOOKUPS.labels(result="hit" if payload is not None else "miss").inc()
+        if payload is None:
+            return None
+        entry = session_codec.decode(payload)
+        logger.debug(f"Completion cache hit: {key}.")
+        return entry["response"], entry["usage"]
+
+    async def set(self, chat: Chat, messages: t.List[dict], response: str, usage: dict):
+        """Stores the response, unless it mentions an author of the window."""
+        if mentions_authors(response, messages):
+            logger.debug("The response mentions an author, so it is not cached.")
+            return
+        payload = session_codec.encode({
+            "response": response,
+            "usage": {name: int(usage[name]) for name in ("prompt_tokens", "completion_tokens", "total_tokens")},
+        })
+        await self._store(keys=[self.get_key(chat, messages), INDEX_KEY],
+                          args=[payload, cache_settings.TTL, time.time(), cache_settings.MAX_SIZE])
+
+
+def get_author(content: str) -> t.Optional[str]:
+    """Returns the name of the author of the user message, see `ChatSession`."""
+    match = AUTHOR_PREFIX_PATTERN.match(content)
+    return match["author"].strip() if match else None
+
+
+def mentions_authors(response: str, messages: t.List[dict]) -> bool:
+    """Whether the response mentions the full or the first name of any author of the messages, as a whole word."""
+    names = set()
+    for message in messages:
+        author = get_author(message["content"]) if message["role"] == "user" else None
+        if author:
+            names.update((author, author.split(" ", 1)[0]))
+    return any(re.search(rf"(?<!\w){re.escape(name)}(?!\w)", response) for name in names)
+
+
+def normalize_content(content: str) -> str:
+    """Strips the author prefix and folds the case and the whitespace."""
+    return " ".join(AUTHOR_PREFIX_PATTERN.sub("", content, count=1).lower().split())
+
+
+completion_cache = CompletionCache()
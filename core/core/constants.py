@@ -7,7 +7,14 @@ MINUTE = 60
 TWO_MINUTES = 2 * MINUTE
 EXPIRATION_TIME = TWO_MINUTES  # Redis data expiration time in seconds
 OPEN_AI_TIMEOUT = 10  # OpenAI API timeout in seconds
+OPEN_AI_STREAM_TIMEOUT = MINUTE  # OpenAI API timeout for the whole streamed response in seconds
+STREAM_EDIT_INTERVAL_PRIVATE = 1  # Telegram allows about one message per second in a private chat
+STREAM_EDIT_INTERVAL_GROUP = 3  # and about 20 messages per minute in a group
+STREAM_PLACEHOLDER = "..."
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
 DATASTORE_FLOAT_MULTIPLIER = 100_000  # Multiplier for float values in the datastore
+CHAT_HISTORY_WINDOW = 100  # Number of the newest chat messages read from Redis to build the prompt
+CHAT_HISTORY_MAX_LENGTH = 500  # Number of the newest chat messages kept in Redis
 
 
 class SupportedLanguages(str, enum.Enum):
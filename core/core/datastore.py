@@ -1,32 +1,160 @@
 """
 This module holds the functionality, to work with the Datastore in Google Cloud.
 """
+from __future__ import annotations
+
+import asyncio
+import functools
 import logging
 import typing as t
-from sys import getsizeof
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
-from google.cloud import datastore
-from google.cloud.datastore import Key
 from telegram import Update
 
-from core.constants import BASIC_INTRODUCTION, DATASTORE_FLOAT_MULTIPLIER
-from core.models import Chat, Message, UserAccount, ModelTokenUsage
-from core.settings import Settings
+from core.lazy import lazy_import
+from core.constants import BASIC_INTRODUCTION, CHAT_HISTORY_WINDOW, DATASTORE_FLOAT_MULTIPLIER, DEFAULT_MAX_TOKENS
+from core.metrics import DATASTORE_LATENCY, timed
+from core.models import Chat, Message, UserAccount, ModelTokenUsage, number_legacy_messages
+from core.settings import get_settings
+
+if t.TYPE_CHECKING:
+    from google.cloud import datastore
+    from google.cloud.datastore import Key
+else:
+    datastore = lazy_import("google.cloud.datastore")  # executed on the first use of the Datastore
 
-settings = Settings()
+settings = get_settings()
 CHAT_KIND = "Chat"
+CHAT_MESSAGE_KIND = "ChatMessage"  # the messages of the chat, under the chat key with the growing message ids
 USER_ACCOUNT_KIND = "UserAccount"
+CHAT_UNINDEXED_PROPERTIES = ('system_message', 'summary', 'first_message_id', 'persisted_message_id')
+MAX_ENTITIES_PER_COMMIT = 500
+CHAT_MESSAGES_PAGE_SIZE = 20  # the messages read at once, while they fit into the token budget
+LAST_ACTIVE_PROPERTY = "last_active_at"  # set on the sessions persisted by the listener, the preload order
 
 logger = logging.getLogger('datastore: ')
 logger.setLevel(logging.DEBUG)
 
 
+def build_embedded_entity(data: dict) -> datastore.Entity:
+    """Builds the not indexed entity to be embedded into another one."""
+    entity = datastore.Entity(exclude_from_indexes=list(data.keys()))  # noqa
+    entity.update(data)
+    return entity
+
+
+@functools.lru_cache(maxsize=None)
+def get_datastore_client() -> datastore.Client:
+    """Returns the Datastore client shared by the whole process."""
+    return datastore.Client(project=settings.GOOGLE_CLOUD_PROJECT)
+
+
 class DatastoreManager:
     """This class is responsible for working with the Datastore."""
 
-    def __init__(self):
-        self.client = datastore.Client(project=settings.GOOGLE_CLOUD_PROJECT)
+    def __init__(self, client: t.Optional[datastore.Client] = None):
+        self.client = client or get_datastore_client()
+
+    @timed(DATASTORE_LATENCY, operation="put_multi")
+    def put_multi(self, entities: t.List[datastore.Entity]):
+        """Saves the entities in their order, within the commits of up to `MAX_ENTITIES_PER_COMMIT` entities."""
+        for start in range(0, len(entities), MAX_ENTITIES_PER_COMMIT):
+            self.client.put_multi(entities[start:start + MAX_ENTITIES_PER_COMMIT])
+
+    def build_user_account_entity(self, data: dict) -> datastore.Entity:
+        """Builds the user account entity from the session data, without reading the stored one."""
+        user_entity = datastore.Entity(self.client.key(USER_ACCOUNT_KIND, int(data["user_id"])))
+        user_entity.update(data)
+        user_entity['current_balance'] = data['current_balance'] * DATASTORE_FLOAT_MULTIPLIER
+        user_entity[LAST_ACTIVE_PROPERTY] = datetime.now(timezone.utc)
+        return user_entity
+
+    def build_chat_entities(self, data: dict) -> t.List[datastore.Entity]:
+        """Builds the entities of the messages newer than `persisted_message_id` and then of the chat itself
+        from the session data, without reading the stored ones.
+
+        The chat comes last, so its `persisted_message_id` is never saved ahead of the messages.
+        """
+        chat_key = self.client.key(CHAT_KIND, int(data["chat_id"]))
+        persisted_message_id = data.get("persisted_message_id", 0)
+        new_messages = [message for message in data["messages"] if message["message_id"] > persisted_message_id]
+        entities = [self.build_chat_message_entity(chat_key, message) for message in new_messages]
+        chat_entity = datastore.Entity(chat_key, exclude_from_indexes=CHAT_UNINDEXED_PROPERTIES)
+        chat_entity.update({name: value for name, value in data.items() if name != "messages"})
+        chat_entity["system_message"] = build_embedded_entity(data["system_message"])
+        if data.get("summary"):
+            chat_entity["summary"] = build_embedded_entity(data["summary"])
+        chat_entity["persisted_message_id"] = max([persisted_message_id,
+                                                   *(message["message_id"] for message in new_messages)])
+        chat_entity[LAST_ACTIVE_PROPERTY] = datetime.now(timezone.utc)
+        entities.append(chat_entity)
+        return entities
+
+    def build_chat_message_entity(self, chat_key: Key, message: dict) -> datastore.Entity:
+        message_entity = datastore.Entity(self.client.key(CHAT_MESSAGE_KIND, message["message_id"], parent=chat_key),
+                                          exclude_from_indexes=('role', 'content', 'token_count', 'token_encoding'))
+        message_entity.update({name: value for name, value in message.items() if name != "message_id"})
+        return message_entity
+
+    @timed(DATASTORE_LATENCY, operation="get_newest_chat_messages")
+    def get_newest_chat_messages(self, chat_key: Key, first_message_id: int, max_tokens: int) -> t.List[dict]:
+        """Returns the newest messages of the chat which fit into `max_tokens`, at least the newest one.
+
+        The messages are read page by page from the newest one, so only the pages needed are fetched.
+        """
+        query = self.client.query(kind=CHAT_MESSAGE_KIND, ancestor=chat_key)
+        if first_message_id:
+            query.key_filter(self.client.key(CHAT_MESSAGE_KIND, first_message_id, parent=chat_key), ">=")
+        query.order = ["-__key__"]  # see index.yaml
+        messages, tokens_num, cursor = [], 0, None
+        while len(messages) < CHAT_HISTORY_WINDOW:
+            limit = min(CHAT_MESSAGES_PAGE_SIZE, CHAT_HISTORY_WINDOW - len(messages))
+            iterator = query.fetch(limit=limit, start_cursor=cursor)
+            page = list(next(iterator.pages, []))
+            for entity in page:
+                tokens_num += entity.get("token_count") or len(entity["content"]) // 4
+                if tokens_num > max_tokens and messages:
+                    return messages[::-1]
+                messages.append(dict(entity, message_id=entity.key.id))
+            cursor = iterator.next_page_token
+            if len(page) < limit or cursor is None:
+                break
+        return messages[::-1]
+
+    def load_chat_messages(self, chat_entity: datastore.Entity) -> datastore.Entity:
+        """Adds the newest messages of the chat, which fit into its token budget, to the chat entity.
+
+        The chats saved before the ChatMessage kind embed the whole history, it is numbered to be saved anew.
+        """
+        if chat_entity.get("messages"):
+            chat_entity["messages"] = [dict(message) for message in chat_entity["messages"]]
+            number_legacy_messages(chat_entity["messages"])
+            chat_entity["persisted_message_id"] = 0
+            return chat_entity
+        max_tokens = (chat_entity.get("open_ai_config") or {}).get("max_tokens", DEFAULT_MAX_TOKENS)
+        chat_entity["messages"] = self.get_newest_chat_messages(chat_entity.key, chat_entity.get("first_message_id", 0),
+                                                                max_tokens)
+        return chat_entity
 
+    @timed(DATASTORE_LATENCY, operation="get_recently_active_chats")
+    def get_recently_active_chats(self, limit: int) -> t.List[datastore.Entity]:
+        """Returns the chat entities persisted most recently, the newest first."""
+        query = self.client.query(kind=CHAT_KIND)
+        query.order = [f"-{LAST_ACTIVE_PROPERTY}"]
+        return [self.load_chat_messages(chat) for chat in query.fetch(limit=limit)]
+
+    @timed(DATASTORE_LATENCY, operation="get_recently_active_user_accounts")
+    def get_recently_active_user_accounts(self, limit: int) -> t.List[datastore.Entity]:
+        """Returns the user account entities persisted most recently, the newest first."""
+        query = self.client.query(kind=USER_ACCOUNT_KIND)
+        query.order = [f"-{LAST_ACTIVE_PROPERTY}"]
+        users = list(query.fetch(limit=limit))
+        for user in users:
+            user.update({'current_balance': user['current_balance'] / DATASTORE_FLOAT_MULTIPLIER})
+        return users
+
+    @timed(DATASTORE_LATENCY, operation="get_user_account_by_username")
     def get_user_account_by_username(self, username: str):
         """Returns a user account entity by its username."""
         query = self.client.query(kind=USER_ACCOUNT_KIND)
@@ -35,33 +163,64 @@ class DatastoreManager:
             user.update({'current_balance': user['current_balance'] / DATASTORE_FLOAT_MULTIPLIER})
             return user
 
+    @timed(DATASTORE_LATENCY, operation="get_or_create_user_account_entity")
     def get_or_create_user_account_entity(self, data: t.Union[Update, dict]) -> t.Tuple[datastore.Entity, Key, bool]:
         """Creates a new user account entity in the Datastore UserAccount kind."""
 
         user_id = data.effective_user.id if isinstance(data, Update) else data['user_id']
-        is_created = False
 
         with self.client.transaction():
             user_key = self.client.key(
                 USER_ACCOUNT_KIND, user_id
             )
-            user_entity = self.client.get(user_key)
-            if not user_entity:
-                is_created = True
-                user_entity = datastore.Entity(user_key)
-                username = data.effective_user.username if isinstance(data, Update) else data['username']
-                user_account = UserAccount(user_id=user_id,
-                                           is_admin=user_id == settings.ADMIN_CHAT_ID,
-                                           username=username,
-                                           model_token_usage=ModelTokenUsage()).dict()
-                current_balance = user_account['current_balance']
-                user_account[
-                    'current_balance'] = current_balance * DATASTORE_FLOAT_MULTIPLIER  # datastore cant store floats
-                user_entity.update(user_account)
+            user_entity, is_created = self._prepare_user_account_entity(user_key, self.client.get(user_key), data)
+            if is_created:
                 self.client.put(user_entity)
-            user_entity['current_balance'] = user_entity['current_balance'] / DATASTORE_FLOAT_MULTIPLIER
-            return user_entity, user_key, is_created
+        user_entity['current_balance'] = user_entity['current_balance'] / DATASTORE_FLOAT_MULTIPLIER
+        return user_entity, user_key, is_created
+
+    @timed(DATASTORE_LATENCY, operation="get_or_create_chat_and_user_account_entities")
+    def get_or_create_chat_and_user_account_entities(
+            self, update: Update) -> t.Tuple[t.Tuple[datastore.Entity, Key, bool], t.Tuple[datastore.Entity, Key, bool]]:
+        """Gets or creates both the chat and the user account entities of the update, using a single lookup."""
+
+        with self.client.transaction():
+            chat_key = self.client.key(CHAT_KIND, update.effective_chat.id)
+            user_key = self.client.key(USER_ACCOUNT_KIND, update.effective_user.id)
+            found = {entity.key: entity for entity in self.client.get_multi([chat_key, user_key])}
+            chat_entity, is_chat_created = self._prepare_chat_entity(chat_key, found.get(chat_key))
+            user_entity, is_user_created = self._prepare_user_account_entity(user_key, found.get(user_key), update)
+            created = [entity for entity, is_created in ((chat_entity, is_chat_created), (user_entity, is_user_created))
+                       if is_created]
+            if created:
+                self.client.put_multi(created)
+        if is_chat_created:
+            chat_entity["messages"] = []
+        else:
+            self.load_chat_messages(chat_entity)
+        user_entity['current_balance'] = user_entity['current_balance'] / DATASTORE_FLOAT_MULTIPLIER
+        return (chat_entity, chat_key, is_chat_created), (user_entity, user_key, is_user_created)
+
+    @staticmethod
+    def _prepare_user_account_entity(user_key: Key, user_entity: t.Optional[datastore.Entity],
+                                     data: t.Union[Update, dict]) -> t.Tuple[datastore.Entity, bool]:
+        """Returns the stored user account entity or builds a new one, which is still to be put."""
+        if user_entity:
+            return user_entity, False
+        user_id = user_key.id
+        user_entity = datastore.Entity(user_key)
+        username = data.effective_user.username if isinstance(data, Update) else data['username']
+        user_account = UserAccount(user_id=user_id,
+                                   is_admin=user_id == settings.ADMIN_CHAT_ID,
+                                   username=username,
+                                   model_token_usage=ModelTokenUsage()).dict()
+        current_balance = user_account['current_balance']
+        user_account[
+            'current_balance'] = current_balance * DATASTORE_FLOAT_MULTIPLIER  # datastore cant store floats
+        user_entity.update(user_account)
+        return user_entity, True
 
+    @timed(DATASTORE_LATENCY, operation="update_or_create_user_account_entity")
     def update_or_create_user_account_entity(self, data: dict) -> t.Tuple[datastore.Entity, Key, bool]:
         """Creates a new user account entity in the Datastore UserAccount kind."""
 
@@ -83,98 +242,108 @@ class DatastoreManager:
             self.client.put(user_entity)
             return user_entity, user_key, is_created
 
+    @timed(DATASTORE_LATENCY, operation="get_or_create_chat_entity")
     def get_or_create_chat_entity(self, update: Update) -> t.Tuple[datastore.Entity, Key, bool]:
         """Creates a new chat entity in the Datastore ChatData kind."""
 
-        chat_id = update.effective_chat.id
-        is_created = False
-
         with self.client.transaction():
             chat_key = self.client.key(
-                CHAT_KIND, chat_id
+                CHAT_KIND, update.effective_chat.id
             )
-            chat_entity = self.client.get(chat_key)
-            user_name = f"{update.effective_user.first_name} {update.effective_user.last_name}"
-            if not user_name:
-                user_name = update.effective_user.username
-            new_message = {
-                "role": "user",
-                "content": f"{user_name} says:{update.effective_message.text}"
-            }
-            new_message = Message(**new_message)
-            new_message_entity = datastore.Entity(exclude_from_indexes=list(new_message.dict().keys()))  # noqa
-            new_message_entity.update(new_message.dict())
-            if not chat_entity:
-                is_created = True
-                chat_entity = datastore.Entity(chat_key,
-                                               exclude_from_indexes=('messages', 'system_message'))
-                intro_system_message = BASIC_INTRODUCTION
-                system_message = Message(content=intro_system_message)
-                system_message_entity = datastore.Entity(
-                    exclude_from_indexes=list(system_message.dict().keys()))  # noqa
-                system_message_entity.update(system_message.dict())
-
-                chat = Chat(**{
-                    "chat_id": chat_id,
-                    "system_message": system_message_entity,
-                    "messages": [
-                        new_message_entity
-                    ]
-                })
-                chat_entity.update(chat.dict())
-            else:
-                chat_message_entities = []
-                for message in chat_entity["messages"]:
-                    message_entity = datastore.Entity(exclude_from_indexes=list(message.keys()))  # noqa
-                    message_entity.update(message)
-                    chat_message_entities.append(message_entity)
-                chat_entity.update({
-                    "messages": chat_message_entities + [new_message_entity]
-                })
-            self.client.put(chat_entity)
-            return chat_entity, chat_key, is_created
+            chat_entity, is_created = self._prepare_chat_entity(chat_key, self.client.get(chat_key))
+            if is_created:
+                self.client.put(chat_entity)
+        if is_created:
+            chat_entity["messages"] = []
+        else:
+            self.load_chat_messages(chat_entity)
+        return chat_entity, chat_key, is_created
 
-    def update_or_create_chat_entity(self, data: dict) -> t.Tuple[datastore.Entity, Key, bool]:
-        """Updates the chat entity in the Datastore ChatData kind or creates in instead."""
+    @staticmethod
+    def _prepare_chat_entity(chat_key: Key,
+                             chat_entity: t.Optional[datastore.Entity]) -> t.Tuple[datastore.Entity, bool]:
+        """Returns the stored chat entity or builds a new one, which is still to be put.
 
-        chat_id = data["chat_id"]
-        is_created = False
+        The message of the update is not included, it is appended by the chat session alongside with the others.
+        The messages are not loaded, see `load_chat_messages`.
+        """
+        if chat_entity:
+            return chat_entity, False
+        chat_entity = datastore.Entity(chat_key, exclude_from_indexes=CHAT_UNINDEXED_PROPERTIES)
+        system_message = Message(content=BASIC_INTRODUCTION)
+        chat = Chat(**{
+            "chat_id": chat_key.id,
+            "system_message": build_embedded_entity(system_message.dict()),
+            "messages": []
+        })
+        chat_entity.update(chat.dict(exclude={"messages"}))
+        return chat_entity, True
+
+    @timed(DATASTORE_LATENCY, operation="update_or_create_chat_entity")
+    def update_or_create_chat_entity(self, data: dict) -> t.Tuple[datastore.Entity, Key, bool]:
+        """Saves the chat and its messages newer than `persisted_message_id`, creating the chat if there is none."""
 
+        chat_key = self.client.key(CHAT_KIND, data["chat_id"])
         with self.client.transaction():
-            chat_key = self.client.key(
-                CHAT_KIND, chat_id
-            )
-            chat_entity = self.client.get(chat_key)
-            logger.debug(f"chat_entity: {chat_entity}")
-            logger.debug(f'Data size: {getsizeof(data)}')
-            logger.debug(f'Data: {data}')
-            if not chat_entity:
-                is_created = True
-                chat_entity = datastore.Entity(chat_key,
-                                               exclude_from_indexes=('messages', 'system_message'))
-                intro_system_message = data["system_message"]["content"]
-                system_message = Message(content=intro_system_message)
-                system_message_entity = datastore.Entity(
-                    exclude_from_indexes=list(system_message.dict().keys()))  # noqa
-                system_message_entity.update(system_message.dict())
-                chat_message_entities = []
-                for message in data["messages"]:
-                    message_entity = datastore.Entity(exclude_from_indexes=list(message.keys()))  # noqa
-                    message_entity.update(message)
-                    chat_message_entities.append(message_entity)
-                chat = Chat(**{
-                    "chat_id": chat_id,
-                    "system_message": system_message_entity,
-                    "messages": chat_message_entities
-                })
-                chat_entity.update(chat.dict())
-            else:
-                chat_message_entities = []
-                for message in data["messages"]:
-                    message_entity = datastore.Entity(exclude_from_indexes=list(message.keys()))  # noqa
-                    message_entity.update(message)
-                    chat_message_entities.append(message_entity)
-                data.pop("messages")
-                chat_entity.update(dict(messages=chat_message_entities, **data))
-            self.client.put(chat_entity)
-            return chat_entity, chat_key, is_created
+            is_created = self.client.get(chat_key) is None
+            entities = self.build_chat_entities(data)
+            self.client.put_multi(entities)
+        return entities[-1], chat_key, is_created
+
+
+class DatastoreGateway:
+    """This class exposes the blocking Datastore RPCs as awaitables.
+
+    The RPCs run in a dedicated thread pool over the shared client, so they never block the event loop.
+    """
+
+    def __init__(self, datastore_manager: DatastoreManager, max_workers: int):
+        self.datastore_manager = datastore_manager
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="datastore")
+
+    async def run(self, func: t.Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def get_user_account_by_username(self, username: str):
+        return await self.run(self.datastore_manager.get_user_account_by_username, username)
+
+    async def get_or_create_user_account_entity(self, data: t.Union[Update, dict]):
+        return await self.run(self.datastore_manager.get_or_create_user_account_entity, data)
+
+    async def get_or_create_chat_entity(self, update: Update):
+        return await self.run(self.datastore_manager.get_or_create_chat_entity, update)
+
+    async def get_or_create_chat_and_user_account_entities(self, update: Update):
+        return await self.run(self.datastore_manager.get_or_create_chat_and_user_account_entities, update)
+
+    async def get_recently_active_chats(self, limit: int):
+        return await self.run(self.datastore_manager.get_recently_active_chats, limit)
+
+    async def get_recently_active_user_accounts(self, limit: int):
+        return await self.run(self.datastore_manager.get_recently_active_user_accounts, limit)
+
+    async def put_multi(self, entities: t.List[datastore.Entity]):
+        return await self.run(self.datastore_manager.put_multi, entities)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+_datastore_gateway: t.Optional[DatastoreGateway] = None
+
+
+def get_datastore_gateway() -> DatastoreGateway:
+    """Returns the Datastore gateway shared by the whole process, the client is created on the first call."""
+    global _datastore_gateway
+    if _datastore_gateway is None:
+        _datastore_gateway = DatastoreGateway(DatastoreManager(), max_workers=settings.DATASTORE_SETTINGS.WORKERS)
+    return _datastore_gateway
+
+
+def close_datastore_gateway():
+    """Waits for the running RPCs of the shared gateway, should be called when the application is about to stop."""
+    global _datastore_gateway
+    if _datastore_gateway is not None:
+        _datastore_gateway.shutdown()
+    _datastore_gateway = None
@@ -0,0 +1,102 @@
+"""
+This module holds the dispatcher of the incoming updates.
+
+The updates of one chat are processed strictly in order within the process, so the chat session read-modify-write
+does not race there, while the updates of different chats are processed concurrently by a bounded pool of workers.
+The ordering does not hold across the processes, e.g. the uvicorn workers, each of them runs its own dispatcher;
+the update stream (`core.update_stream`) leases every chat to a single consumer for that.
+The chats take turns in a round-robin order, so a busy group can't starve the other chats. No update is dropped:
+a chat with too many pending updates holds back the submission of its next one, which in turn holds back the webhook
+response, so Telegram slows down the delivery instead of losing the updates.
+"""
+import asyncio
+import collections
+import logging
+import typing as t
+
+from telegram import Update
+
+from core.metrics import DISPATCHER_PENDING, DISPATCHER_THROTTLED
+
+logger = logging.getLogger(__name__)
+
+
+def get_update_chat_key(update: object) -> t.Hashable:
+    """Returns the key the updates are serialized by, the updates without a chat are not serialized."""
+    if isinstance(update, Update) and update.effective_chat:
+        return update.effective_chat.id
+    return id(update)
+
+
+class ChatDispatcher:
+    """This class is responsible for processing the updates per chat in order and across chats concurrently."""
+
+    def __init__(self, process: t.Callable[[object], t.Awaitable[t.Any]], workers: int, max_pending: int,
+                 max_pending_per_chat: int, get_key: t.Callable[[object], t.Hashable] = get_update_chat_key):
+        self._process = process
+        self._get_key = get_key
+        self._workers_num = workers
+        self._max_pending_per_chat = max_pending_per_chat
+        self._capacity = asyncio.Semaphore(max_pending)  # bounds the queued and the running updates
+        self._pending: t.Dict[t.Hashable, t.Deque[object]] = {}  # the updates per chat, the running one included
+        self._ready: asyncio.Queue[t.Hashable] = asyncio.Queue()  # the chats waiting for their turn
+        self._room: t.Dict[t.Hashable, asyncio.Future] = {}  # resolved once the held back chat has room again
+        self._workers: t.List[asyncio.Task] = []
+
+    @property
+    def pending_num(self) -> int:
+        return sum(len(updates) for updates in self._pending.values())
+
+    async def start(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self._workers_num)]
+
+    async def stop(self, timeout: t.Optional[float] = None):
+        """Waits for the pending updates to be processed and stops the workers."""
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Stopping the dispatcher with {self.pending_num} pending update(s).")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, update: object):
+        """Queues the update, waiting while its chat has too many pending updates or the dispatcher is full."""
+        key = self._get_key(update)
+        if len(self._pending.get(key, ())) >= self._max_pending_per_chat:
+            logger.warning(f"Holding back the update, chat {key} has {len(self._pending[key])} pending update(s).")
+            DISPATCHER_THROTTLED.inc()
+            while len(self._pending.get(key, ())) >= self._max_pending_per_chat:
+                room = self._room.get(key)
+                if room is None:
+                    room = self._room[key] = asyncio.get_running_loop().create_future()
+                await asyncio.shield(room)  # the future is shared by the submissions held back
+        await self._capacity.acquire()
+        updates = self._pending.get(key)
+        if updates is None:
+            updates = self._pending[key] = collections.deque()
+            self._ready.put_nowait(key)
+        updates.append(update)
+        DISPATCHER_PENDING.inc()
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            updates = self._pending[key]
+            try:
+                await self._process(updates[0])
+            except Exception:
+                logger.exception(f"Processing the update of chat {key} failed.")
+            finally:
+                updates.popleft()
+                self._capacity.release()
+                DISPATCHER_PENDING.dec()
+                room = self._room.pop(key, None)
+                if room is not None and not room.done():
+                    room.set_result(None)
+                if updates:
+                    self._ready.put_nowait(key)  # the chat goes to the end of the line
+                else:
+                    del self._pending[key]
+                self._ready.task_done()
@@ -0,0 +1,102 @@
+"""
+This module holds the migration of the Memorystore (Redis) keys written by the previous versions.
+
+The untagged keys, e.g. `chat_session:42`, `chat_session:42:messages` or `shadow:user_session:7`, are renamed
+to their tagged names, e.g. `chat_session:{42}`. Then every session stored is scheduled to be flushed unless it is
+already, so the sessions written before the flush schedule, or left behind by a missed shadow key expiration,
+are persisted too. The listener runs the migration on start, it may also be run on its own:
+
+    python -m core.key_migration
+
+The renames need every key on one node, so the keys are migrated on the single instance before switching to
+the cluster (`MEMORYSTORE_CLUSTER`). The migration is idempotent, the keys written by the processes still
+running the old version are picked up by the next run.
+"""
+import asyncio
+import logging
+import re
+import typing as t
+
+from redis.exceptions import ResponseError
+
+from core.constants import RedisPrefixes
+from core.redis_tools import redis_client, close_redis_pool, get_session_key, get_shard_clients, \
+    memory_store_settings, schedule_flush
+
+logger = logging.getLogger(__name__)
+
+SESSION_PREFIXES = "|".join(prefix.value for prefix in RedisPrefixes)
+LEGACY_KEY_PATTERN = re.compile(rf"^(?P<head>(?:shadow:|preloaded:)?)(?P<prefix>{SESSION_PREFIXES}):"
+                                rf"(?P<entity_id>-?\d+)(?P<tail>(?::messages|:balance)?)$")
+LEGACY_KEYS_DROPPED = ["completion_cache:index"]  # the entries it scores expire on their own
+SCAN_COUNT = 1_000
+
+
+def get_tagged_key(legacy_key: str) -> t.Optional[str]:
+    """Returns the tagged name of the legacy key, or None if that is not a legacy session key."""
+    match = LEGACY_KEY_PATTERN.match(legacy_key)
+    if match is None:
+        return None
+    return match["head"] + get_session_key(match["prefix"], match["entity_id"]) + match["tail"]
+
+
+async def migrate_legacy_keys() -> int:
+    """Renames the legacy session keys to the tagged ones, returns the number of the keys renamed.
+
+    A tagged key written already by the new version is kept, the legacy one is left for a manual review.
+    """
+    if memory_store_settings.CLUSTER:
+        logger.info("The legacy keys are migrated on the single instance only, skipping.")
+        return 0
+    renamed_num = 0
+    for prefix in RedisPrefixes:
+        async for legacy_key in redis_client.scan_iter(match=f"*{prefix.value}:*", count=SCAN_COUNT):
+            legacy_key = legacy_key.decode("utf-8")
+            tagged_key = get_tagged_key(legacy_key)
+            if tagged_key is None:
+                continue
+            try:
+                is_renamed = await redis_client.renamenx(legacy_key, tagged_key)
+            except ResponseError:  # the key is gone, e.g. the shadow key expired or the session was saved
+                continue
+            if not is_renamed:
+                logger.warning(f"Both {legacy_key} and {tagged_key} exist, the legacy key is kept.")
+                continue
+            renamed_num += 1
+    await redis_client.delete(*LEGACY_KEYS_DROPPED)
+    logger.info(f"{renamed_num} legacy key(s) were migrated to the tagged ones.")
+    return renamed_num
+
+
+async def schedule_stored_sessions() -> int:
+    """Schedules the flush of every session stored on any shard, keeping the deadlines already scheduled.
+
+    Returns the number of the sessions found.
+    """
+    sessions_num = 0
+    for shard_client in await get_shard_clients():
+        for prefix in RedisPrefixes:
+            session_keys = [session_key async for session_key in
+                            shard_client.scan_iter(match=f"{prefix.value}:{{*}}", count=SCAN_COUNT)
+                            if session_key.endswith(b"}")]  # not the bookkeeping keys of the sessions
+            for start in range(0, len(session_keys), SCAN_COUNT):
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    for session_key in session_keys[start:start + SCAN_COUNT]:
+                        schedule_flush(pipe, session_key.decode("utf-8"), keep_deadline=True)
+                    await pipe.execute()
+            sessions_num += len(session_keys)
+    logger.info(f"{sessions_num} stored session(s) are scheduled to be flushed.")
+    return sessions_num
+
+
+async def main():
+    try:
+        await migrate_legacy_keys()
+        await schedule_stored_sessions()
+    finally:
+        await close_redis_pool()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,31 @@
+"""
+This module holds the deferred imports of the heavy client libraries.
+
+The Google Cloud and OpenAI client stacks take a large part of the start up time, while the webhook only
+needs them once the first update is handled. Their modules are executed on the first attribute access.
+"""
+import importlib.util
+import sys
+import types
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Returns the module, which is actually executed on the first access to its attributes."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def preload(*names: str):
+    """Executes the lazily imported modules, so the first update does not pay for them.
+
+    A lazy module is not safe to be executed by several threads at once, so the modules used by the worker
+    pools should be loaded on the event loop before any work is offloaded.
+    """
+    for name in names:
+        getattr(lazy_import(name), "__name__")
@@ -0,0 +1,184 @@
+"""
+This module holds the session lifecycle around the process start up and shutdown.
+
+A fresh process preloads the most recently active chats and users from the Datastore into the Memorystore (Redis),
+so their next messages do not pay for a Datastore transaction. A preloaded session carries a marker key until it
+is written, so when its flush is due untouched the listener just drops it instead of saving it back.
+
+A process about to stop flushes the sessions it has written recently to the Datastore with `put_multi`, so they
+are persisted without waiting for the listener to reach their flush deadlines.
+"""
+import asyncio
+import logging
+import typing as t
+
+from redis.asyncio.client import Pipeline
+
+from core.accounting import merge_balance
+from core.codec import session_codec
+from core.constants import CHAT_HISTORY_MAX_LENGTH, RedisPrefixes
+from core.datastore import DatastoreManager, get_datastore_gateway
+from core.models import Chat, UserAccount, number_legacy_messages
+from core.redis_tools import redis_client, dirty_sessions, get_chat_messages_key, get_preload_marker_key, \
+    execute_with_scripts, get_session_key, get_user_balance_key, schedule_flush
+from core.settings import get_settings
+from core.usage_stats import index_username
+
+settings = get_settings()
+lifecycle_settings = settings.LIFECYCLE_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+PRELOAD_LOCK_KEY = "preload_lock"
+
+# Stores the session (the first key) unless it is already there, marking it preloaded (the second key).
+# The payload is the first argument, the chat messages (the rest of them) go to the list under the third key.
+PRELOAD_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[1])
+if #ARGV > 1 then
+    redis.call('del', KEYS[3])
+    redis.call('rpush', KEYS[3], unpack(ARGV, 2))
+end
+redis.call('set', KEYS[2], '')
+return 1
+"""
+
+_preload = redis_client.register_script(PRELOAD_SCRIPT)
+
+
+async def read_session_entities(datastore_manager: DatastoreManager, redis_keys: t.List[str]
+                                ) -> t.Tuple[list, t.List[t.Tuple[str, t.List[str]]]]:
+    """Reads the sessions from Redis within one round trip.
+
+    Returns the Datastore entities of the changed sessions, and every session found alongside with its keys.
+    The sessions preloaded and not changed since then have no entities, they are already in the Datastore.
+    """
+    prefixes = [RedisPrefixes(redis_key.split(":", 1)[0]) for redis_key in redis_keys]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for redis_key, prefix in zip(redis_keys, prefixes):
+            pipe.get(redis_key)
+            if prefix == RedisPrefixes.CHAT_SESSION:
+                pipe.lrange(get_chat_messages_key(redis_key), 0, -1)
+            else:
+                pipe.hgetall(get_user_balance_key(redis_key))
+            pipe.exists(get_preload_marker_key(redis_key))
+        results = iter(await pipe.execute())
+    entities, found = [], []
+    for redis_key, prefix in zip(redis_keys, prefixes):
+        payload, companion, is_preloaded = next(results), next(results), next(results)
+        if payload is None:
+            logger.debug(f"Session is already persisted: {redis_key}.")
+            continue
+        match prefix:
+            case RedisPrefixes.CHAT_SESSION:
+                session_keys = [redis_key, get_chat_messages_key(redis_key)]
+                if not is_preloaded:
+                    data = session_codec.decode(payload)
+                    if "messages" not in data:  # the payloads written before the list layout embed them
+                        data["messages"] = [session_codec.decode(message) for message in companion]
+                    number_legacy_messages(data["messages"])
+                    entities.extend(datastore_manager.build_chat_entities(data))
+            case RedisPrefixes.USER_SESSION:
+                session_keys = [redis_key, get_user_balance_key(redis_key)]
+                if not is_preloaded:
+                    data = merge_balance(session_codec.decode(payload), companion)
+                    entities.append(datastore_manager.build_user_account_entity(data))
+        found.append((redis_key, [*session_keys, get_preload_marker_key(redis_key)]))
+    return entities, found
+
+
+async def preload_sessions():
+    """Loads the most recently active chats and users missing in Redis, once per `PRELOAD_INTERVAL` overall.
+
+    That is best effort, the failures are only logged.
+    """
+    if not lifecycle_settings.PRELOAD_CHATS and not lifecycle_settings.PRELOAD_USERS:
+        return
+    if not await redis_client.set(PRELOAD_LOCK_KEY, "", ex=lifecycle_settings.PRELOAD_INTERVAL, nx=True):
+        logger.info("The sessions were preloaded recently by another process.")
+        return
+    try:
+        chat_entities, user_entities = await asyncio.gather(fetch_recently_active_chats(),
+                                                            fetch_recently_active_user_accounts())
+        user_accounts = [UserAccount(**entity) for entity in user_entities]
+        sessions = [build_chat_preload(Chat(**entity)) for entity in chat_entities]
+        sessions.extend(build_user_preload(user_account) for user_account in user_accounts)
+        preloaded_num = 0
+        for start in range(0, len(sessions), lifecycle_settings.BATCH_SIZE):
+            batch = sessions[start:start + lifecycle_settings.BATCH_SIZE]
+
+            async def build(pipe: Pipeline):
+                for keys, args in batch:
+                    await _preload(keys=keys, args=args, client=pipe)
+                    # The untouched preloaded session is dropped after `PRELOAD_TTL`, unless it is already scheduled
+                    schedule_flush(pipe, keys[0], delay=lifecycle_settings.PRELOAD_TTL, keep_deadline=True)
+
+            preloaded_num += sum((await execute_with_scripts(build, _preload))[::2])
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for user_account in user_accounts:
+                index_username(pipe, user_account.user_id, user_account.username)
+            await pipe.execute()
+    except Exception:
+        logger.exception("Preloading the sessions failed.")
+        return
+    logger.info(f"{preloaded_num} of {len(sessions)} recently active session(s) were preloaded.")
+
+
+async def fetch_recently_active_chats() -> list:
+    if not lifecycle_settings.PRELOAD_CHATS:
+        return []
+    return await get_datastore_gateway().get_recently_active_chats(lifecycle_settings.PRELOAD_CHATS)
+
+
+async def fetch_recently_active_user_accounts() -> list:
+    if not lifecycle_settings.PRELOAD_USERS:
+        return []
+    return await get_datastore_gateway().get_recently_active_user_accounts(lifecycle_settings.PRELOAD_USERS)
+
+
+def build_chat_preload(chat: Chat) -> t.Tuple[t.List[str], list]:
+    """Returns the keys and the arguments of the preload script for the chat, in the `ChatSession` layout."""
+    redis_key = get_session_key(RedisPrefixes.CHAT_SESSION.value, chat.chat_id)
+    keys = [redis_key, get_preload_marker_key(redis_key), get_chat_messages_key(redis_key)]
+    messages = [session_codec.encode(message.dict()) for message in chat.messages[-CHAT_HISTORY_MAX_LENGTH:]]
+    return keys, [session_codec.encode(chat.dict(exclude={"messages"})), *messages]
+
+
+def build_user_preload(user_account: UserAccount) -> t.Tuple[t.List[str], list]:
+    """Returns the keys and the arguments of the preload script for the user account."""
+    redis_key = get_session_key(RedisPrefixes.USER_SESSION.value, user_account.user_id)
+    keys = [redis_key, get_preload_marker_key(redis_key)]
+    return keys, [session_codec.encode(user_account.dict())]
+
+
+async def flush_dirty_sessions():
+    """Saves the sessions written by the process to the Datastore, within `FLUSH_TIMEOUT` seconds.
+
+    That is best effort, the sessions failed to be saved are left to the listener.
+    """
+    try:
+        await asyncio.wait_for(save_dirty_sessions(), timeout=lifecycle_settings.FLUSH_TIMEOUT)
+    except Exception:
+        logger.exception("Flushing the sessions failed, they are left to the listener.")
+
+
+async def save_dirty_sessions():
+    """Saves the sessions written by the process to the Datastore in batches.
+
+    The sessions are left in Redis, the listener removes them once their flushes are due.
+    """
+    redis_keys = dirty_sessions.pop_all()
+    if not redis_keys:
+        return
+    datastore_gateway = get_datastore_gateway()
+    saved_num = 0
+    for start in range(0, len(redis_keys), lifecycle_settings.BATCH_SIZE):
+        entities, _ = await read_session_entities(datastore_gateway.datastore_manager,
+                                                  redis_keys[start:start + lifecycle_settings.BATCH_SIZE])
+        if entities:
+            await datastore_gateway.put_multi(entities)
+            saved_num += len(entities)
+    logger.info(f"{saved_num} session(s) were flushed to the Datastore.")
@@ -1,13 +1,37 @@
-import json
+"""
+That module holds the listener, which persists the sessions due to be flushed from the Memorystore (Redis)
+to the Datastore.
+
+Every session write schedules the session flush in a sorted set scored by the flush deadline, see `redis_tools`.
+The listener polls the due sessions and claims them atomically into the claims sorted set, where they are kept
+until the Datastore write is acknowledged. So the sessions claimed by a listener which crashed or failed to save
+them are claimed again once their claims expire, and nothing is lost while the listener is down.
+The claimed sessions go through a bounded queue, so a burst of the due sessions applies backpressure instead of
+piling up in memory. A pool of workers collects the pending sessions into batches and writes every batch with
+a single `put_multi` commit.
+"""
+import asyncio
 import logging
+import random
 import sys
+import time
+import typing as t
+from concurrent.futures import ThreadPoolExecutor
 
-import redis
+from google.api_core import exceptions as google_exceptions
+from prometheus_client import start_http_server
+from redis.asyncio.client import Pipeline
 
-from core.constants import RedisPrefixes
-from core.settings import Settings
+from core.settings import get_settings
 from core.datastore import DatastoreManager
-settings = Settings()
+from core.key_migration import migrate_legacy_keys, schedule_stored_sessions
+from core.lifecycle import read_session_entities
+from core.metrics import LISTENER_FAILED, LISTENER_LAG, LISTENER_QUEUE, LISTENER_SAVED
+from core.redis_tools import FLUSH_CLAIMS_KEY, FLUSH_SCHEDULE_KEY, redis_client, execute_with_scripts, get_shadow_key
+from core.session_cache import publish_invalidation
+
+settings = get_settings()
+listener_settings = settings.LISTENER_SETTINGS
 
 logger = logging.getLogger('listener')
 logger.setLevel(logging.DEBUG)
@@ -16,57 +40,155 @@ handler = logging.StreamHandler(sys.stdout)
 handler.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
-redis_client = redis.Redis(host=settings.MEMORY_STORE_SETTINGS.HOST,
-                           port=settings.MEMORY_STORE_SETTINGS.PORT)
-
-EXPIRED_KEY_EVENT = "__keyevent@0__:expired"
-
-
-def expire_event_handler(message):  # pragma: no cover
-    try:
-        logger.debug(f"Got a message from Redis: {message}.")
-        initial_key = message["data"].decode("utf-8").strip()
-        _, prefix, chat_id = initial_key.split(":")
-        logger.debug(f"Session Type: {prefix}. Chat ID: {chat_id}.")
-        redis_key = f"{prefix}:{chat_id}"
-        prefix = RedisPrefixes(prefix)
-        logger.debug(f"Getting the value from Redis: {redis_key}.")
-        data = json.loads(redis_client.get(redis_key).decode("utf-8"))
-        logger.debug(f"Got the value from Redis: {data}.")
-        datastore_manager = DatastoreManager()
-        match prefix:
-            case RedisPrefixes.CHAT_SESSION:
-                save_chat_session_to_datastore(data=data, datastore_manager=datastore_manager)
-            case RedisPrefixes.USER_SESSION:
-                save_user_account_session_to_datastore(data=data, datastore_manager=datastore_manager)
-        # Once we got to know the value we remove it from Redis and do whatever required
-        logger.debug(f"Deleting used data from Redis: {redis_key}.")
-        redis_client.delete(redis_key)
-        logger.debug(f"Data were successfully deleted from Redis: {redis_key}.")
-    except Exception as exp:
-        logger.debug("Got an exception: ", exp)
-
-
-def save_chat_session_to_datastore(data: dict, datastore_manager: DatastoreManager):
-    """Saves the chat_session object to the Datastore"""
-    logger.debug("Saving chat session to the Datastore: ", data)
-    chat, key, created = datastore_manager.update_or_create_chat_entity(data)
-    logger.debug(f"Data were successfully saved to the datastore. Data was created: {created}."
-                 f" Chat: {chat}. Key: {key}.")
-
-
-def save_user_account_session_to_datastore(data: dict, datastore_manager: DatastoreManager):
-    """Saves the user_session object to the Datastore"""
-    logger.debug("Saving user session to the Datastore: ", data)
-    user, key, created = datastore_manager.update_or_create_user_account_entity(data)
-    logger.debug(f"Data were successfully saved to the datastore. Data was created: {created}.")
+# Claims up to the third argument of the sessions due by the first argument: the expired claims (the second key)
+# first and then the scheduled flushes (the first key). They are moved to the claims with the claim deadline
+# (the second argument). Returns the session keys alongside with the moments they were due at.
+CLAIM_SCRIPT = """
+local limit = tonumber(ARGV[3])
+local claimed = {}
+for _, source in ipairs({KEYS[2], KEYS[1]}) do
+    if limit > 0 then
+        local due = redis.call('zrangebyscore', source, '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, limit)
+        for i = 1, #due, 2 do
+            redis.call('zrem', source, due[i])
+            redis.call('zadd', KEYS[2], ARGV[2], due[i])
+            table.insert(claimed, due[i])
+            table.insert(claimed, due[i + 1])
+        end
+        limit = limit - #due / 2
+    end
+end
+return claimed
+"""
+
+# Deletes the session keys only if the session was not rewritten while being saved to the Datastore,
+# as every session write sets its shadow key (the first key)
+DELETE_IF_NOT_SHADOWED_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return redis.call('del', unpack(KEYS, 2))
+end
+return 0
+"""
+
+RETRIABLE_EXCEPTIONS = (
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+    google_exceptions.Aborted,
+    google_exceptions.TooManyRequests,
+)
+
+
+class SessionListener:
+    """This class is responsible for the write-behind of the sessions due to be flushed to the Datastore."""
+
+    def __init__(self):
+        # The claimed session keys alongside with the moments they were due at
+        self.queue: asyncio.Queue[t.Tuple[str, float]] = asyncio.Queue(maxsize=listener_settings.QUEUE_SIZE)
+        LISTENER_QUEUE.set_function(self.queue.qsize)
+        self.datastore_manager = DatastoreManager()
+        self.executor = ThreadPoolExecutor(max_workers=listener_settings.WORKERS, thread_name_prefix="datastore")
+        self.claim = redis_client.register_script(CLAIM_SCRIPT)
+        self.delete_if_not_shadowed = redis_client.register_script(DELETE_IF_NOT_SHADOWED_SCRIPT)
+
+    async def run(self):
+        await migrate_legacy_keys()
+        await schedule_stored_sessions()
+        workers = [asyncio.create_task(self.worker(number)) for number in range(listener_settings.WORKERS)]
+        try:
+            await self.claim_due_sessions()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.executor.shutdown(wait=False)
+
+    async def claim_due_sessions(self):
+        """Claims the due sessions into the queue while it has room, polls every `POLL_INTERVAL` seconds once
+        there are no more of them."""
+        logger.info("Polling the due sessions")
+        while True:
+            limit = min(listener_settings.BATCH_SIZE, self.queue.maxsize - self.queue.qsize())
+            claimed = []
+            if limit > 0:
+                now = time.time()
+                claimed = await self.claim(keys=[FLUSH_SCHEDULE_KEY, FLUSH_CLAIMS_KEY],
+                                           args=[now, now + listener_settings.CLAIM_TIMEOUT, limit])
+                for redis_key, due_at in zip(claimed[::2], claimed[1::2]):
+                    self.queue.put_nowait((redis_key.decode("utf-8"), float(due_at)))
+            if len(claimed) // 2 < limit or limit <= 0:
+                await asyncio.sleep(listener_settings.POLL_INTERVAL)
+
+    async def worker(self, number: int):
+        logger.info(f"Worker {number} started.")
+        while True:
+            batch = await self.collect_batch()
+            try:
+                await self.save_batch([redis_key for redis_key, _ in batch])
+            except Exception:
+                LISTENER_FAILED.inc(len(batch))
+                logger.exception(f"Worker {number} failed to save the batch of {len(batch)} session(s), "
+                                 f"they are claimed again once their claims expire.")
+            else:
+                LISTENER_SAVED.inc(len(batch))
+                now = time.time()
+                for _, due_at in batch:
+                    LISTENER_LAG.observe(now - due_at)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def collect_batch(self) -> t.List[t.Tuple[str, float]]:
+        """Waits for the first pending session and collects the following ones for up to `BATCH_WAIT` seconds."""
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + listener_settings.BATCH_WAIT
+        while len(batch) < listener_settings.BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def save_batch(self, batch: t.List[str]):
+        redis_keys = list(dict.fromkeys(batch))  # the same session may be claimed twice within the batch
+        # The writes from now on set the shadow keys again, so the sessions written meanwhile are kept in Redis
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for redis_key in redis_keys:
+                pipe.delete(get_shadow_key(redis_key))
+            await pipe.execute()
+        entities, saved = await read_session_entities(self.datastore_manager, redis_keys)
+        if entities:  # the untouched preloaded sessions are only removed
+            await self.put_multi_with_retry(entities)
+            logger.debug(f"{len(entities)} session(s) were successfully saved to the Datastore.")
+
+        # Once the data is persisted we remove it from Redis, unless it was updated in the meantime
+        async def build(pipe: Pipeline):
+            for redis_key, session_keys in saved:
+                await self.delete_if_not_shadowed(keys=[get_shadow_key(redis_key), *session_keys], client=pipe)
+
+        deleted = await execute_with_scripts(build, self.delete_if_not_shadowed) if saved else []
+        await redis_client.zrem(FLUSH_CLAIMS_KEY, *redis_keys)  # the acknowledgement
+        # The processes caching the sessions have to read them from the Datastore from now on
+        await publish_invalidation(redis_key for (redis_key, _), is_deleted in zip(saved, deleted) if is_deleted)
+
+    async def put_multi_with_retry(self, entities: list):
+        loop = asyncio.get_running_loop()
+        for attempt in range(listener_settings.MAX_RETRIES):
+            try:
+                await loop.run_in_executor(self.executor, self.datastore_manager.put_multi, entities)
+                return
+            except RETRIABLE_EXCEPTIONS:
+                if attempt == listener_settings.MAX_RETRIES - 1:
+                    raise
+                delay = random.uniform(0, listener_settings.RETRY_BASE_DELAY * 2 ** attempt)  # full jitter
+                logger.warning(f"Datastore commit failed, retrying in {delay:.2f} seconds.")
+                await asyncio.sleep(delay)
 
 
 if __name__ == "__main__":
-    logger.info("Start listening to Redis")
-    pubsub = redis_client.pubsub()
-    logger.info("Subscribing to Redis")
-    pubsub.psubscribe(**{EXPIRED_KEY_EVENT: expire_event_handler})
-    logger.info("Running Redis in thread")
-    pubsub.run_in_thread(sleep_time=0.01)
-    logger.info("Done")
+    start_http_server(listener_settings.METRICS_PORT)
+    logger.info("Start flushing the sessions from Redis")
+    asyncio.run(SessionListener().run())
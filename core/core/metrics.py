@@ -0,0 +1,140 @@
+"""
+This module holds the Prometheus metrics of the hot paths.
+
+The webhook server runs several uvicorn workers, so when `PROMETHEUS_MULTIPROC_DIR` is set the metrics of
+every worker process are written there and aggregated by the `/metrics` endpoint. The listener exposes its
+metrics on its own HTTP port.
+"""
+import asyncio
+import enum
+import os
+import time
+import typing as t
+from functools import wraps
+
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, CONTENT_TYPE_LATEST, REGISTRY, \
+    generate_latest, multiprocess
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+FAST_BUCKETS = (.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1)
+
+WEBHOOK_LATENCY = Histogram("webhook_request_seconds", "Time to accept the update by the webhook", ["mode"],
+                            buckets=FAST_BUCKETS)
+DISPATCHER_PENDING = Gauge("dispatcher_pending_updates", "Updates queued or being processed by the dispatcher",
+                           multiprocess_mode="livesum")
+DISPATCHER_THROTTLED = Counter("dispatcher_throttled_updates_total", "Updates held back by the per chat limit")
+HANDLER_LATENCY = Histogram("handler_seconds", "Bot handler latency", ["handler"], buckets=LATENCY_BUCKETS)
+HANDLER_ERRORS = Counter("handler_errors_total", "Bot handler exceptions", ["handler"])
+OPEN_AI_LATENCY = Histogram("openai_request_seconds", "OpenAI completion latency, up to the last token",
+                            ["model", "stream"], buckets=LATENCY_BUCKETS)
+OPEN_AI_FIRST_TOKEN_LATENCY = Histogram("openai_first_token_seconds", "OpenAI streamed completion first token latency",
+                                        ["model"], buckets=LATENCY_BUCKETS)
+OPEN_AI_SCHEDULER_WAIT = Histogram("openai_scheduler_wait_seconds", "Time waiting for the OpenAI rate limits",
+                                   ["model"], buckets=LATENCY_BUCKETS)
+OPEN_AI_RATE_LIMITED = Counter("openai_rate_limited_total", "OpenAI requests rejected by the rate limits", ["model"])
+OPEN_AI_TOKENS = Counter("openai_tokens_total", "OpenAI tokens billed", ["model", "kind"])
+COMPLETION_CACHE_LOOKUPS = Counter("completion_cache_lookups_total", "Completion cache lookups", ["result"])
+BACKOFF_RETRIES = Counter("backoff_retries_total", "Retries of the failed external calls", ["target"])
+SESSION_LOOKUPS = Counter("session_lookups_total", "Session reads from Redis", ["session", "result"])
+SESSION_CACHE_LOOKUPS = Counter("session_cache_lookups_total", "In-process session cache lookups", ["result"])
+SESSION_GET_LATENCY = Histogram("session_get_seconds", "Session read latency, the Datastore fallback included",
+                                ["session"], buckets=FAST_BUCKETS)
+DATASTORE_LATENCY = Histogram("datastore_operation_seconds", "Datastore operation latency", ["operation"],
+                              buckets=LATENCY_BUCKETS)
+TOKENIZER_CPU = Histogram("tokenizer_cpu_seconds", "CPU time spent encoding the texts into tokens",
+                          buckets=FAST_BUCKETS)
+LISTENER_LAG = Histogram("listener_lag_seconds", "Time from the session flush deadline to its save to the Datastore",
+                         buckets=LATENCY_BUCKETS)
+LISTENER_QUEUE = Gauge("listener_queue_size", "Due sessions waiting to be saved")
+LISTENER_SAVED = Counter("listener_saved_sessions_total", "Sessions saved to the Datastore")
+LISTENER_FAILED = Counter("listener_failed_sessions_total", "Sessions failed to be saved to the Datastore")
+
+
+def timed(histogram: Histogram, **labels):
+    """Observes the duration of the decorated function, which may be a coroutine function."""
+    metric = histogram.labels(**labels) if labels else histogram
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    metric.observe(time.perf_counter() - started_at)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metric.observe(time.perf_counter() - started_at)
+
+        return wrapper
+
+    return decorator
+
+
+def cpu_timed(histogram: Histogram):
+    """Observes the CPU time of the calling thread spent in the decorated function."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started_at = time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.thread_time() - started_at)
+
+        return wrapper
+
+    return decorator
+
+
+def track_handler(func):
+    """Observes the latency and the exceptions of the bot handler."""
+    latency = HANDLER_LATENCY.labels(handler=func.__name__)
+    errors = HANDLER_ERRORS.labels(handler=func.__name__)
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - started_at)
+
+    return wrapper
+
+
+def count_retry(target: str) -> t.Callable[[dict], None]:
+    """Returns the `on_backoff` handler counting the retries of the target."""
+    retries = BACKOFF_RETRIES.labels(target=target)
+    return lambda details: retries.inc()
+
+
+def get_model_label(model: t.Union[str, enum.Enum]) -> str:
+    return model.value if isinstance(model, enum.Enum) else model
+
+
+def observe_usage(model: t.Union[str, enum.Enum], usage: dict):
+    model = get_model_label(model)
+    OPEN_AI_TOKENS.labels(model=model, kind="prompt").inc(usage["prompt_tokens"])
+    OPEN_AI_TOKENS.labels(model=model, kind="completion").inc(usage["completion_tokens"])
+
+
+def generate_metrics() -> t.Tuple[bytes, str]:
+    """Returns the metrics of the process, or of all the worker processes in the multiprocess mode."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
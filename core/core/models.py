@@ -1,3 +1,4 @@
+import time
 import typing as t
 
 from pydantic import BaseModel
@@ -61,6 +62,31 @@ class UserAccount(BaseModel):
 class Message(BaseModel):
     role: str = "system"
     content: str
+    # Cached number of tokens of the role and the content, valid only for the `token_encoding` encoding
+    token_count: t.Optional[int] = None
+    token_encoding: t.Optional[str] = None
+    message_id: t.Optional[int] = None  # the id of the ChatMessage entity, growing within the chat
+
+    def to_prompt(self) -> dict:
+        """Returns the message in the format expected by the OpenAI API."""
+        return {"role": self.role, "content": self.content}
+
+
+def new_message_id(previous_id: int) -> int:
+    """Returns the id of the next message of the chat, the microseconds since the epoch unless the previous is ahead.
+
+    So the ids keep growing even if the history, and the previous id with it, is lost, e.g. by clearing it.
+    """
+    return max(time.time_ns() // 1000, previous_id + 1)
+
+
+def number_legacy_messages(messages: t.List[dict]) -> bool:
+    """Numbers the messages saved before the messages had the ids, in their order. Returns whether they were."""
+    if not messages or messages[0].get("message_id") is not None:
+        return False
+    for number, message in enumerate(messages, 1):
+        message["message_id"] = number
+    return True
 
 
 class OpenAIConfig(BaseModel):
@@ -73,7 +99,20 @@ class Chat(BaseModel):
     chat_id: int
     open_ai_config: OpenAIConfig = OpenAIConfig()
     system_message: Message
+    summary: t.Optional[Message] = None  # the rolling summary of the messages folded out of the history
     messages: t.List[Message]
+    first_message_id: int = 0  # the older messages are out of the history, i.e. cleared or folded into the summary
+    persisted_message_id: int = 0  # the newest message saved to the Datastore, only the newer ones are saved
+
+    @property
+    def last_message_id(self) -> int:
+        """The id of the newest message, or the one the history starts after if there are no messages."""
+        newest_id = self.messages[-1].message_id or 0 if self.messages else 0
+        return max(newest_id, self.first_message_id, self.persisted_message_id)
+
+    def get_context_messages(self) -> t.List[Message]:
+        """Returns the messages preceding the history in the prompt."""
+        return [self.system_message, self.summary] if self.summary else [self.system_message]
 
 
 pydantic_model_per_gpt_model = {
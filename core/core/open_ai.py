@@ -1,25 +1,86 @@
 """
     This file holds the logic for interacting with the OpenAI API.
 """
+from __future__ import annotations
+
+import asyncio
+import functools
+import heapq
+import itertools
 import logging
+import time
 import typing as t
+from concurrent.futures import ThreadPoolExecutor
 
 import backoff
-import openai
-import tiktoken
-
 
-from core.models import UserAccount, Chat
-from core.settings import Settings
-from core.constants import ChatModel, THOUSAND, MODEL_PRICING, DEFAULT_MAX_TOKENS, DEFAULT_MODEL_TEMPERATURE
+from core.accounting import UserBalance
+from core.metrics import OPEN_AI_LATENCY, OPEN_AI_FIRST_TOKEN_LATENCY, OPEN_AI_RATE_LIMITED, OPEN_AI_SCHEDULER_WAIT, \
+    TOKENIZER_CPU, count_retry, cpu_timed, get_model_label, observe_usage
+from core.models import UserAccount, Chat, Message
+from core.lazy import lazy_import, preload
+from core.redis_tools import redis_client
+from core.settings import get_settings
+from core.constants import ChatModel, THOUSAND, MODEL_PRICING, DEFAULT_MAX_TOKENS, DEFAULT_MODEL_TEMPERATURE, \
+    OPEN_AI_TIMEOUT, SupportedModels, OPEN_AI_STREAM_TIMEOUT
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-settings = Settings()
+settings = get_settings()
+scheduler_settings = settings.OPEN_AI_SCHEDULER_SETTINGS
+
+if t.TYPE_CHECKING:
+    import aiohttp
+    import openai
+    import tiktoken
+else:
+    # The client libraries are executed on the first request, off the start up path
+    aiohttp = lazy_import("aiohttp")
+    openai = lazy_import("openai")
+    tiktoken = lazy_import("tiktoken")
+
+
+@functools.lru_cache(maxsize=None)
+def get_openai():
+    """Returns the OpenAI client library, set up on the first call."""
+    openai.api_key = settings.OPEN_AI_API_KEY  # ToDo: add normal settings get
+    openai.api_base = settings.OPEN_AI_SETTINGS.API_BASE
+    return openai
+
+
+def is_permanent_error(*error_names: str) -> t.Callable[[Exception], bool]:
+    """Returns the `giveup` predicate of backoff, which retries only the named `openai.error` exceptions.
+
+    The exceptions are looked up on the first failure, so the decorated functions do not import the library.
+    """
+
+    def giveup(exp: Exception) -> bool:
+        return not isinstance(exp, tuple(getattr(openai.error, name) for name in error_names))
+
+    return giveup
 
-# Set up OpenAI API
-openai.api_key = settings.OPEN_AI_API_KEY  # ToDo: add normal settings get
+
+# Keep-alive HTTP session shared by every completion request of the worker process
+_http_session: t.Optional[aiohttp.ClientSession] = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Returns the shared aiohttp session, creating it (and its connection pool) on the first call."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        connector = aiohttp.TCPConnector(limit=settings.OPEN_AI_SETTINGS.POOL_SIZE,
+                                         keepalive_timeout=settings.OPEN_AI_SETTINGS.KEEPALIVE_TIMEOUT)
+        _http_session = aiohttp.ClientSession(connector=connector)
+    return _http_session
+
+
+async def close_http_session():
+    """Closes the shared aiohttp session, should be called when the application is about to stop."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
 
 
 class UserTokenManager:
@@ -32,12 +93,12 @@ class UserTokenManager:
             self.model = ChatModel.CHAT_GPT_4
         self.tokens_for_messages = 0
         self.dollars_for_prompt = 0
+        self.reserved_cents = 0  # the price of the prompt deducted from the balance
 
     def count_tokens_from_messages(self):
-        """Returns the number of tokens used by the user in the chat."""
-        chat_data = self.chat.dict()
-        messages = [chat_data["system_message"]] + chat_data["messages"]
-        self.tokens_for_messages = num_tokens_from_messages(messages, model=self.model)
+        """Returns the number of tokens used by the user in the chat, the summary of the older messages included."""
+        messages = self.chat.get_context_messages() + self.chat.messages
+        self.tokens_for_messages = sum(tokenizer.count_messages(messages, model=self.model)) + REPLY_PRIMING_TOKENS
         return self.tokens_for_messages
 
     def count_tokens_to_dollars(self, tokens: int, is_prompt: bool = False):
@@ -60,74 +121,376 @@ class UserTokenManager:
             case _:
                 raise ValueError(f"Model {model} not found.")
 
-    def can_user_ask_ai(self) -> bool:
-        """Returns True if the user has enough tokens to ask the AI."""
+    async def can_user_ask_ai(self, balance: UserBalance) -> bool:
+        """Returns True if the user has enough tokens to ask the AI, reserving the price of the prompt.
+
+        The reservation has to be settled or released afterwards, see `UserBalance`.
+        """
         tokens = self.count_tokens_from_messages()
-        dollars = self.count_tokens_to_dollars(tokens, is_prompt=True)
-        current_balance = self.user_account.current_balance
-        return current_balance >= dollars * 100  # convert dollars to cents
+        cents = self.count_tokens_to_dollars(tokens, is_prompt=True) * 100  # convert dollars to cents
+        return await self.reserve(balance, cents)
 
+    async def reserve(self, balance: UserBalance, cents: float) -> bool:
+        """Deducts the cents if the balance covers them, they have to be settled or released afterwards."""
+        is_reserved, self.user_account.current_balance = await balance.reserve(self.user_account, cents)
+        self.reserved_cents = cents if is_reserved else 0
+        return is_reserved
 
-def num_tokens_from_messages(messages: t.List[t.Dict[str, str]], model: ChatModel = ChatModel.CHAT_GPT_3_5_TURBO_0301):
-    """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.warning("Model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+    async def settle(self, balance: UserBalance, usage: t.Optional[dict], price_cents: float):
+        """Charges the price of the response instead of the reservation and counts its tokens, if there is usage."""
+        self.user_account.current_balance = await balance.settle(
+            self.user_account, reserved_cents=self.reserved_cents, price_cents=price_cents,
+            model=self.chat.open_ai_config.current_model, usage=usage)
+        self.reserved_cents = 0
+
+    async def release(self, balance: UserBalance):
+        """Returns the reservation to the balance, if the response has not been settled."""
+        if self.reserved_cents:
+            self.user_account.current_balance = await balance.release(self.user_account, self.reserved_cents)
+            self.reserved_cents = 0
+
+
+REPLY_PRIMING_TOKENS = 2  # every reply is primed with <im_start>assistant
+
+
+@functools.lru_cache(maxsize=None)
+def get_message_token_params(model: ChatModel) -> t.Tuple[ChatModel, int, int]:
+    """Returns the model the tokens are counted for, alongside with the tokens per message and per name."""
     match model:
         case ChatModel.CHAT_GPT_3_5_TURBO:
             logger.warning("gpt-3.5-turbo may change over time. Returning num tokens assuming gpt-3.5-turbo-0301.")
-            return num_tokens_from_messages(messages, model=ChatModel.CHAT_GPT_3_5_TURBO_0301)
+            return get_message_token_params(ChatModel.CHAT_GPT_3_5_TURBO_0301)
         case ChatModel.CHAT_GPT_4:
             logger.warning("gpt-4 may change over time. Returning num tokens assuming gpt-4-0314.")
-            return num_tokens_from_messages(messages, model=ChatModel.CHAT_GPT_4_0314)
+            return get_message_token_params(ChatModel.CHAT_GPT_4_0314)
         case ChatModel.CHAT_GPT_3_5_TURBO_0301:
-            tokens_per_message = 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            tokens_per_name = -1  # if there's a name, the role is omitted
+            # every message follows <im_start>{role/name}\n{content}<im_end>\n
+            # if there's a name, the role is omitted
+            return ChatModel.CHAT_GPT_3_5_TURBO_0301, 4, -1
         case ChatModel.CHAT_GPT_4_0314:
-            tokens_per_message = 3
-            tokens_per_name = 1
+            return ChatModel.CHAT_GPT_4_0314, 3, 1
         case _:
             raise NotImplementedError(
                 f"""num_tokens_from_messages() is not implemented for model {model}.
                  See https://github.com/openai/openai-python/blob/main/chatml.md for information on how
                   messages are converted to tokens.""")
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 2  # every reply is primed with <im_start>assistant
-    return num_tokens
+
+
+class Tokenizer:
+    """This class is responsible for counting tokens.
+
+    The encoders are loaded once per process from the BPE cache bundled into the image
+    (see `TIKTOKEN_CACHE_DIR` in the Dockerfile), texts are encoded in batches and the large inputs
+    are counted in a worker pool, so they don't block the event loop.
+    """
+
+    def __init__(self, offload_threshold: int, max_workers: int):
+        self.offload_threshold = offload_threshold  # number of characters to count in the worker pool
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tokenizer")
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_encoding(model: ChatModel) -> tiktoken.Encoding:
+        """Returns the tiktoken encoding used by the model."""
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            logger.warning("Model not found. Using cl100k_base encoding.")
+            return tiktoken.get_encoding("cl100k_base")
+
+    @cpu_timed(TOKENIZER_CPU)
+    def count_texts(self, texts: t.List[str], model: ChatModel) -> t.List[int]:
+        """Returns the number of tokens of every text."""
+        if not texts:
+            return []
+        encoding = self.get_encoding(get_message_token_params(model)[0])
+        if len(texts) == 1:
+            return [len(encoding.encode(texts[0], disallowed_special=()))]
+        return [len(tokens) for tokens in encoding.encode_batch(texts, disallowed_special=())]
+
+    def num_tokens_from_messages(self, messages: t.List[t.Dict[str, str]],
+                                 model: ChatModel = ChatModel.CHAT_GPT_3_5_TURBO_0301) -> int:
+        """Returns the number of tokens used by a list of messages."""
+        _, tokens_per_message, tokens_per_name = get_message_token_params(model)
+        values = [value for message in messages for value in message.values()]
+        names_num = sum("name" in message for message in messages)
+        return (sum(self.count_texts(values, model=model)) + tokens_per_message * len(messages)
+                + tokens_per_name * names_num + REPLY_PRIMING_TOKENS)
+
+    def count_messages(self, messages: t.List[Message], model: ChatModel) -> t.List[int]:
+        """Returns the number of tokens of every message, the per-message framing included.
+
+        The encoded part is cached on the message itself, so only the messages which have never been counted
+        with the model encoding go through the tokenizer.
+        """
+        model, tokens_per_message, _ = get_message_token_params(model)
+        encoding_name = self.get_encoding(model).name
+        uncounted = self._get_uncounted(messages, encoding_name)
+        if uncounted:
+            counts = self.count_texts([value for message in uncounted for value in (message.role, message.content)],
+                                      model=model)
+            for index, message in enumerate(uncounted):
+                message.token_count = counts[2 * index] + counts[2 * index + 1]
+                message.token_encoding = encoding_name
+        return [tokens_per_message + message.token_count for message in messages]
+
+    async def acount_messages(self, messages: t.List[Message], model: ChatModel) -> t.List[int]:
+        """Same as `count_messages`, but counts the large inputs in the worker pool."""
+        encoding_name = self.get_encoding(get_message_token_params(model)[0]).name
+        uncounted = self._get_uncounted(messages, encoding_name)
+        if sum(len(message.content) for message in uncounted) < self.offload_threshold:
+            return self.count_messages(messages, model=model)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.count_messages, messages, model)
+
+    def warm_up(self):
+        """Loads the encoders of all the models, so the first request doesn't pay for it."""
+        for model in {get_message_token_params(model)[0] for model in SupportedModels}:
+            self.count_texts(["warm up"], model=model)
+        logger.info("Tokenizer is warmed up.")
+
+    async def awarm_up(self):
+        """Warms up in the worker pool, so the event loop keeps answering in the meantime."""
+        preload("tiktoken")
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.warm_up)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def _get_uncounted(messages: t.List[Message], encoding_name: str) -> t.List[Message]:
+        return [message for message in messages
+                if message.token_count is None or message.token_encoding != encoding_name]
+
+
+tokenizer = Tokenizer(offload_threshold=settings.OPEN_AI_SETTINGS.TOKENIZER_OFFLOAD_THRESHOLD,
+                      max_workers=settings.OPEN_AI_SETTINGS.TOKENIZER_WORKERS)
+num_tokens_from_messages = tokenizer.num_tokens_from_messages
+
+
+# Takes a request and its tokens from the model buckets (the first key) if both suffice, returns the seconds
+# to wait otherwise. The buckets refill continuously at the rates, in the Redis time, unless they are paused
+ACQUIRE_SCRIPT = """
+local now = redis.call('time')
+now = now[1] + now[2] / 1000000
+local request_rate, request_capacity = tonumber(ARGV[1]), tonumber(ARGV[2])
+local token_rate, token_capacity = tonumber(ARGV[3]), tonumber(ARGV[4])
+local cost = math.min(tonumber(ARGV[5]), token_capacity)
+local state = redis.call('hmget', KEYS[1], 'requests', 'tokens', 'updated_at')
+local updated_at = tonumber(state[3]) or now
+if now < updated_at then
+    return tostring(updated_at - now)
+end
+local elapsed = now - updated_at
+local requests = math.min(request_capacity, (tonumber(state[1]) or request_capacity) + elapsed * request_rate)
+local tokens = math.min(token_capacity, (tonumber(state[2]) or token_capacity) + elapsed * token_rate)
+local wait = 0
+if requests < 1 then
+    wait = (1 - requests) / request_rate
+end
+if tokens < cost then
+    wait = math.max(wait, (cost - tokens) / token_rate)
+end
+if wait == 0 then
+    requests = requests - 1
+    tokens = tokens - cost
+end
+redis.call('hset', KEYS[1], 'requests', requests, 'tokens', tokens, 'updated_at', now)
+redis.call('expire', KEYS[1], 120)
+return tostring(wait)
+"""
+
+# Empties the model buckets (the first key) and stops refilling them for the seconds (the first argument)
+PAUSE_SCRIPT = """
+local now = redis.call('time')
+now = now[1] + now[2] / 1000000
+redis.call('hset', KEYS[1], 'requests', 0, 'tokens', 0, 'updated_at', now + tonumber(ARGV[1]))
+redis.call('expire', KEYS[1], 120)
+return 1
+"""
+
+# Returns the tokens (the first argument) and the requests (the second one) taken but not used to the model
+# buckets (the first key)
+REFUND_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+    redis.call('hincrbyfloat', KEYS[1], 'tokens', ARGV[1])
+    redis.call('hincrbyfloat', KEYS[1], 'requests', ARGV[2])
+end
+return 1
+"""
+
+
+def get_model_family(model: t.Union[ChatModel, str]) -> str:
+    """Returns the model family the provider rate limits apply to."""
+    return "gpt-4" if get_model_label(model).startswith("gpt-4") else "gpt-3.5-turbo"
+
+
+def estimate_prompt_tokens(messages: t.List[dict]) -> int:
+    """Returns the rough number of the prompt tokens, for the callers which have not counted them."""
+    return sum(len(message["content"]) for message in messages) // 4 + len(messages) * 4
+
+
+class _Waiter(t.NamedTuple):
+    deadline: float
+    number: int  # breaks the ties in the order of arrival
+    tokens: int
+    future: asyncio.Future
+
+
+class OpenAIScheduler:
+    """This class is responsible for keeping the OpenAI requests of all the processes under the provider limits.
+
+    Every model family has the requests per minute and the tokens per minute buckets in Redis, shared by all
+    the processes. A request takes its prompt tokens and the completion limit from them before being sent.
+    The requests waiting in the process are served in the order of their virtual deadlines: the short and
+    the private requests come first, while the long and the group ones are delayed, but never starved.
+    When the provider still rate limits a request, the buckets are emptied for every process.
+    """
+
+    def __init__(self):
+        self._acquire = redis_client.register_script(ACQUIRE_SCRIPT)
+        self._pause = redis_client.register_script(PAUSE_SCRIPT)
+        self._refund = redis_client.register_script(REFUND_SCRIPT)
+        self._waiters: t.Dict[str, t.List[_Waiter]] = {}
+        self._pumps: t.Dict[str, asyncio.Task] = {}
+        self._numbers = itertools.count()
+
+    @staticmethod
+    def get_limits(family: str) -> t.Tuple[float, float]:
+        """Returns the requests and the tokens per second of the model family, below the provider limits."""
+        if family == "gpt-4":
+            rpm, tpm = scheduler_settings.GPT_4_RPM, scheduler_settings.GPT_4_TPM
+        else:
+            rpm, tpm = scheduler_settings.GPT_3_5_RPM, scheduler_settings.GPT_3_5_TPM
+        return rpm * scheduler_settings.LIMIT_SHARE / 60, tpm * scheduler_settings.LIMIT_SHARE / 60
+
+    async def acquire(self, model: t.Union[ChatModel, str], tokens: int, is_private: bool = True):
+        """Waits until the request with the tokens fits into the limits of the model."""
+        if not scheduler_settings.ENABLED:
+            return
+        family = get_model_family(model)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + tokens / THOUSAND * scheduler_settings.PRIORITY_SECONDS_PER_1K_TOKENS
+        if not is_private:
+            deadline += scheduler_settings.GROUP_PRIORITY_DELAY
+        waiter = _Waiter(deadline=deadline, number=next(self._numbers), tokens=tokens, future=loop.create_future())
+        heapq.heappush(self._waiters.setdefault(family, []), waiter)
+        pump = self._pumps.get(family)
+        if pump is None or pump.done():
+            self._pumps[family] = asyncio.create_task(self._pump(family))
+        started_at = time.perf_counter()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            # Cancelled after the grant, before resuming, the grant would never be used
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.result():
+                await self._return_grant(family, tokens)
+            raise
+        OPEN_AI_SCHEDULER_WAIT.labels(model=family).observe(time.perf_counter() - started_at)
+
+    async def _pump(self, family: str):
+        """Grants the waiting requests of the model family one by one, the most urgent first."""
+        waiters = self._waiters[family]
+        request_rate, token_rate = self.get_limits(family)
+        while waiters:
+            waiter = waiters[0]
+            if waiter.future.done():  # cancelled while waiting
+                heapq.heappop(waiters)
+                continue
+            is_granted = True
+            try:
+                wait = float(await self._acquire(
+                    keys=[f"openai_limits:{family}"],
+                    args=[request_rate, request_rate * scheduler_settings.BURST_SECONDS,
+                          token_rate, token_rate * scheduler_settings.BURST_SECONDS, waiter.tokens]))
+            except Exception:
+                logger.exception("The OpenAI limits are unavailable, sending the request unscheduled.")
+                wait, is_granted = 0, False
+            if wait > 0:
+                await asyncio.sleep(wait)  # a more urgent request may arrive meanwhile
+                continue
+            heapq.heappop(waiters)
+            if not waiter.future.done():
+                waiter.future.set_result(is_granted)
+            elif is_granted:  # cancelled while its budget was being taken
+                await self._return_grant(family, waiter.tokens)
+
+    async def _return_grant(self, family: str, tokens: int):
+        """Returns the request and the tokens granted to a request which was cancelled before being sent."""
+        _, token_rate = self.get_limits(family)
+        try:
+            await self._refund(keys=[f"openai_limits:{family}"],
+                               args=[min(tokens, token_rate * scheduler_settings.BURST_SECONDS), 1])
+        except Exception:
+            logger.exception("The OpenAI limits are unavailable, the grant of a cancelled request is not returned.")
+
+    async def pause(self, model: t.Union[ChatModel, str], seconds: float):
+        """Stops all the processes from sending the requests of the model for the seconds."""
+        family = get_model_family(model)
+        OPEN_AI_RATE_LIMITED.labels(model=family).inc()
+        if scheduler_settings.ENABLED:
+            await self._pause(keys=[f"openai_limits:{family}"], args=[seconds])
+
+    async def refund(self, model: t.Union[ChatModel, str], tokens: int):
+        """Returns the reserved tokens which were not used."""
+        if scheduler_settings.ENABLED and tokens > 0:
+            await self._refund(keys=[f"openai_limits:{get_model_family(model)}"], args=[tokens, 0])
+
+
+scheduler = OpenAIScheduler()
+
+
+async def pause_on_rate_limit(model: t.Union[ChatModel, str], exp: openai.error.RateLimitError):
+    """Pauses the model for the time the provider asks for, so the retries do not feed the 429 storm."""
+    headers = exp.headers or {}
+    try:
+        seconds = float(headers.get("retry-after", 1))
+    except (TypeError, ValueError):
+        seconds = 1
+    await scheduler.pause(model, seconds)
 
 
 # Define function to generate response with OpenAI API
 @backoff.on_exception(
     wait_gen=backoff.expo,
-    exception=(openai.error.RateLimitError,
-               openai.error.InvalidRequestError,
-               openai.error.APIError,
-               openai.error.ServiceUnavailableError),
-    max_tries=10,
+    exception=Exception,
+    giveup=is_permanent_error("RateLimitError", "InvalidRequestError", "APIError", "ServiceUnavailableError"),
+    max_tries=scheduler_settings.MAX_TRIES,
+    on_backoff=count_retry("openai"),
     logger="open-ai-generate-response",
     backoff_log_level=logging.DEBUG,
 )
 async def generate_response(messages: list[dict],
                             model: ChatModel = ChatModel.CHAT_GPT_3_5_TURBO_0301.value,
                             max_tokens=DEFAULT_MAX_TOKENS,
-                            temperature=DEFAULT_MODEL_TEMPERATURE):
-    """Generates a response from the OpenAI API."""
+                            temperature=DEFAULT_MODEL_TEMPERATURE,
+                            prompt_tokens: t.Optional[int] = None,
+                            is_private: bool = True):
+    """Generates a response from the OpenAI API.
 
-    response = openai.ChatCompletion.create(
-        model=model,  # The name of the OpenAI chatbot model to use
-        messages=messages,  # The conversation history up to this point, as a list of dictionaries
-        max_tokens=max_tokens,  # The maximum number of tokens (words or subwords) in the generated response
-        stop=None,  # The stopping sequence for the generated response, if any (not used here)
-        temperature=temperature,  # The "creativity" of the generated response (higher temperature = more creative)
-    )
+    The request waits for the `scheduler` with the prompt tokens (estimated if not given) and the completion
+    limit, the unused tokens are refunded afterwards. The request goes through the shared keep-alive session,
+    so cancelling the awaiting task (e.g. by `asyncio.wait_for`) really aborts the underlying HTTP request.
+    """
+    reserved_tokens = (prompt_tokens or estimate_prompt_tokens(messages)) + max_tokens
+    await scheduler.acquire(model, tokens=reserved_tokens, is_private=is_private)
+    get_openai().aiosession.set(get_http_session())
+    started_at = time.perf_counter()
+    try:
+        response = await openai.ChatCompletion.acreate(
+            model=model,  # The name of the OpenAI chatbot model to use
+            messages=messages,  # The conversation history up to this point, as a list of dictionaries
+            max_tokens=max_tokens,  # The maximum number of tokens (words or subwords) in the generated response
+            stop=None,  # The stopping sequence for the generated response, if any (not used here)
+            temperature=temperature,  # The "creativity" of the generated response (higher temperature = more creative)
+            request_timeout=(settings.OPEN_AI_SETTINGS.CONNECT_TIMEOUT, OPEN_AI_TIMEOUT),
+        )
+    except openai.error.RateLimitError as exp:
+        await pause_on_rate_limit(model, exp)
+        raise
+    OPEN_AI_LATENCY.labels(model=get_model_label(model), stream="false").observe(time.perf_counter() - started_at)
+    observe_usage(model=model, usage=response["usage"])
+    await scheduler.refund(model, reserved_tokens - response["usage"]["total_tokens"])
 
     # Find the first response from the chatbot that has text in it (some responses may not have text)
     for choice in response.choices:
@@ -136,3 +499,58 @@ async def generate_response(messages: list[dict],
 
     # If no response with text is found, return the first response's content (which may be empty)
     return response
+
+
+@backoff.on_exception(
+    wait_gen=backoff.expo,
+    exception=Exception,
+    giveup=is_permanent_error("RateLimitError", "APIError", "ServiceUnavailableError"),
+    max_tries=scheduler_settings.MAX_TRIES,
+    on_backoff=count_retry("openai_stream"),
+    logger="open-ai-stream-response",
+    backoff_log_level=logging.DEBUG,
+)
+async def _create_response_stream(messages: list[dict], model: ChatModel, max_tokens: int, temperature: float,
+                                  reserved_tokens: int, is_private: bool):
+    await scheduler.acquire(model, tokens=reserved_tokens, is_private=is_private)
+    get_openai().aiosession.set(get_http_session())
+    try:
+        return await openai.ChatCompletion.acreate(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+            request_timeout=(settings.OPEN_AI_SETTINGS.CONNECT_TIMEOUT, OPEN_AI_STREAM_TIMEOUT),
+        )
+    except openai.error.RateLimitError as exp:
+        await pause_on_rate_limit(model, exp)
+        raise
+
+
+async def stream_response(messages: list[dict],
+                          model: ChatModel = ChatModel.CHAT_GPT_3_5_TURBO_0301.value,
+                          max_tokens=DEFAULT_MAX_TOKENS,
+                          temperature=DEFAULT_MODEL_TEMPERATURE,
+                          prompt_tokens: t.Optional[int] = None,
+                          is_private: bool = True) -> t.AsyncIterator[str]:
+    """Generates a response from the OpenAI API, yielding the content pieces as soon as they arrive.
+
+    Only establishing the stream is retried, a stream broken in the middle is not replayed. The stream is
+    scheduled like `generate_response`, its whole completion limit is kept reserved.
+    """
+    model_label = get_model_label(model)
+    started_at = time.perf_counter()
+    reserved_tokens = (prompt_tokens or estimate_prompt_tokens(messages)) + max_tokens
+    stream = await _create_response_stream(messages=messages, model=model, max_tokens=max_tokens,
+                                           temperature=temperature, reserved_tokens=reserved_tokens,
+                                           is_private=is_private)
+    is_first = True
+    async for chunk in stream:
+        content = chunk.choices[0].delta.get("content")
+        if content:
+            if is_first:
+                OPEN_AI_FIRST_TOKEN_LATENCY.labels(model=model_label).observe(time.perf_counter() - started_at)
+                is_first = False
+            yield content
+    OPEN_AI_LATENCY.labels(model=model_label, stream="true").observe(time.perf_counter() - started_at)
@@ -0,0 +1,161 @@
+"""
+This module holds the outbound side of the bot: the throttling of the Telegram Bot API requests and the chat actions.
+
+Telegram allows about 30 messages per second overall, one message per second in a private chat and 20 messages
+per minute in a group. Every request addressed to a chat waits for a token of the chat bucket and then of
+the global one, so the bursts are spread out instead of being answered by `RetryAfter`. When Telegram still
+asks to retry, the chat (or every chat, if the request has no chat) is paused for the requested time and
+the request is retried.
+"""
+import asyncio
+import collections
+import contextlib
+import logging
+import time
+import typing as t
+
+from telegram import Bot
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import BaseRateLimiter
+
+from core.settings import get_settings
+
+settings = get_settings()
+outbound_settings = settings.TELEGRAM_OUTBOUND_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# The requests which are never delayed, e.g. the callback queries are answered right away by the clients
+UNLIMITED_ENDPOINTS = frozenset({"answerCallbackQuery", "getMe", "getWebhookInfo", "setWebhook", "getChatMember"})
+# The requests which only take the global limit into account
+CHAT_ACTION_ENDPOINT = "sendChatAction"
+
+
+class TokenBucket:
+    """This class is responsible for spreading the requests out to `rate` per second, allowing `capacity` bursts."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float):
+        """Stops handing out the tokens for the time Telegram asks to wait."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    @property
+    def is_idle(self) -> bool:
+        """Whether the bucket is full, so dropping it loses nothing."""
+        now = time.monotonic()
+        return now >= self.paused_until and self.tokens + (now - self.updated_at) * self.rate >= self.capacity
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ChatRateLimiter(BaseRateLimiter):
+    """This class is responsible for keeping the bot requests within the Telegram global and per chat limits.
+
+    The requests of one chat acquire their tokens in the order they were made. `rate_limit_args` of a request
+    overrides the number of the retries after `RetryAfter`, e.g. `{"max_retries": 0}` for the edits which may be
+    skipped. It has to be a non-empty dict, as `ExtBot` drops the falsy `rate_limit_args`.
+    """
+
+    def __init__(self, max_retries: int = outbound_settings.MAX_RETRIES):
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(rate=outbound_settings.GLOBAL_RATE, capacity=outbound_settings.GLOBAL_BURST)
+        self.chat_buckets: t.OrderedDict[t.Union[int, str], TokenBucket] = collections.OrderedDict()
+        self.chat_locks: t.Dict[t.Union[int, str], asyncio.Lock] = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self.chat_buckets.clear()
+        self.chat_locks.clear()
+
+    def get_chat_bucket(self, chat_id: t.Union[int, str]) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            is_private = isinstance(chat_id, int) and chat_id > 0  # groups and channels have negative identifiers
+            if is_private:
+                bucket = TokenBucket(rate=outbound_settings.PRIVATE_CHAT_RATE,
+                                     capacity=outbound_settings.PRIVATE_CHAT_BURST)
+            else:
+                bucket = TokenBucket(rate=outbound_settings.GROUP_CHAT_RATE,
+                                     capacity=outbound_settings.GROUP_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+            self._drop_idle_buckets()
+        self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _drop_idle_buckets(self):
+        """Keeps at most `MAX_CHATS` buckets, the least recently used ones are dropped once they are full."""
+        while len(self.chat_buckets) > outbound_settings.MAX_CHATS:
+            chat_id, bucket = next(iter(self.chat_buckets.items()))
+            if not bucket.is_idle:
+                break
+            del self.chat_buckets[chat_id]
+            lock = self.chat_locks.get(chat_id)
+            if lock is not None and not lock.locked():
+                del self.chat_locks[chat_id]
+
+    async def acquire(self, endpoint: str, chat_id: t.Optional[t.Union[int, str]]):
+        if chat_id is not None and endpoint != CHAT_ACTION_ENDPOINT:
+            async with self.chat_locks.setdefault(chat_id, asyncio.Lock()):
+                await self.get_chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+        max_retries = (rate_limit_args or {}).get("max_retries", self.max_retries)
+        chat_id = data.get("chat_id")
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)  # the identifiers may be passed as strings
+        for attempt in range(max_retries + 1):
+            await self.acquire(endpoint, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exp:
+                if attempt == max_retries:
+                    raise
+                logger.info(f"Telegram asks to retry {endpoint} to {chat_id} after {exp.retry_after} seconds.")
+                bucket = self.global_bucket if chat_id is None else self.get_chat_bucket(chat_id)
+                bucket.pause(exp.retry_after)
+
+
+@contextlib.asynccontextmanager
+async def keep_chat_action(bot: Bot, chat_id: int, action: str) -> t.AsyncIterator[None]:
+    """Shows the chat action while the body runs, without waiting for Telegram.
+
+    The action is sent in the background and refreshed every `CHAT_ACTION_INTERVAL` seconds, as Telegram
+    shows it for five seconds only.
+    """
+
+    async def send_periodically():
+        while True:
+            try:
+                await bot.send_chat_action(chat_id=chat_id, action=action)
+            except TelegramError as exp:
+                logger.debug(f"Could not send the chat action: {exp}.")
+            await asyncio.sleep(outbound_settings.CHAT_ACTION_INTERVAL)
+
+    task = asyncio.create_task(send_periodically())
+    try:
+        yield
+    finally:
+        task.cancel()
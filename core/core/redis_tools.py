@@ -1,13 +1,178 @@
 """
 That module manages creation all the necessary connections within the application, alongside with the saving data from
 the Memorystore to the Datastore when the application is about to stop.
+
+The Memorystore is either a single instance or a cluster (`MEMORYSTORE_CLUSTER`). The session keys carry the entity id
+as the hash tag, e.g. `chat_session:{42}`, and the bookkeeping keys of a session only add a prefix or a suffix to its
+key, e.g. `shadow:chat_session:{42}` or `chat_session:{42}:messages`. So a session and its bookkeeping keys always
+land in the same slot, and the scripts touching them run on a single shard.
+
+Every session write sets the shadow key of the session, flagging it written, and schedules the session flush in
+the `{flush}:schedule` sorted set, scored by the flush deadline. The listener claims the due sessions into
+the `{flush}:claims` sorted set, scored by the claim deadline, saves them to the Datastore and acknowledges them.
+So the sessions written while the listener is down are flushed once it is back.
 """
-import redis
+import collections
+import time
+import typing as t
+
+from redis import asyncio as aioredis
+from redis.asyncio.client import Pipeline
+from redis.commands.core import AsyncScript
+from redis.exceptions import NoScriptError
+
+from core.constants import TWO_MINUTES
+from core.settings import get_settings
+
+settings = get_settings()
+memory_store_settings = settings.MEMORY_STORE_SETTINGS
+
+SHADOW_PREFIX = "shadow"
+FLUSH_SCHEDULE_KEY = "{flush}:schedule"  # the session keys scored by their flush deadlines
+FLUSH_CLAIMS_KEY = "{flush}:claims"  # the session keys being flushed scored by their claim deadlines
+
+# Set up the Memorystore (Redis) connection pool, shared by every session within the worker process
+if memory_store_settings.CLUSTER:
+    redis_pool = None
+    redis_client = aioredis.RedisCluster(host=memory_store_settings.HOST, port=memory_store_settings.PORT,
+                                         max_connections=memory_store_settings.MAX_CONNECTIONS)
+else:
+    redis_pool = aioredis.ConnectionPool(host=memory_store_settings.HOST,
+                                         port=memory_store_settings.PORT,
+                                         db=memory_store_settings.DB,
+                                         max_connections=memory_store_settings.MAX_CONNECTIONS)
+    redis_client = aioredis.Redis(connection_pool=redis_pool)
+
+_shard_clients: t.Dict[str, aioredis.Redis] = {}  # the clients of the cluster nodes, by the node name
+_loaded_scripts: t.Set[str] = set()  # the digests of the scripts loaded to every shard
+
+
+async def close_redis_pool():
+    """Closes all the connections of the shared pool, should be called when the application is about to stop."""
+    await redis_client.close()
+    if redis_pool is not None:
+        await redis_pool.disconnect()
+    for shard_client in _shard_clients.values():
+        await shard_client.close()
+    _shard_clients.clear()
+
+
+def get_session_key(prefix: str, entity_id: t.Union[int, str]) -> str:
+    """Returns the key of the session, tagged with the entity id so the session keys share the slot."""
+    return f"{prefix}:{{{entity_id}}}"
+
+
+def get_shadow_key(session_key: str) -> str:
+    """Returns the key flagging the session written since the listener has read it."""
+    return f"{SHADOW_PREFIX}:{session_key}"
+
+
+def schedule_flush(pipe: Pipeline, session_key: str, delay: float = TWO_MINUTES, keep_deadline: bool = False):
+    """Adds the flush of the session in `delay` seconds to the pipeline.
+
+    Every write postpones the flush of the session, so a busy session is flushed once it is idle, unless
+    `keep_deadline` is set and the session is already scheduled.
+    """
+    pipe.zadd(FLUSH_SCHEDULE_KEY, {session_key: time.time() + delay}, nx=keep_deadline)
+
+
+def session_pipeline() -> Pipeline:
+    """Returns the pipeline for the session writes, a transaction on a single instance.
+
+    The cluster pipelines of redis-py have no transactions, there the commands are only pipelined. They are still
+    sent in order to the shard of every session, and the shadow key is written last.
+    """
+    return redis_client.pipeline(transaction=not memory_store_settings.CLUSTER)
+
+
+async def load_scripts(*scripts: AsyncScript, reload: bool = False):
+    """Loads the scripts to every shard before they are run within a cluster pipeline, once per process.
+
+    A cluster pipeline can't load the script missing on a shard, unlike the single instance pipeline.
+    """
+    if not memory_store_settings.CLUSTER:
+        return
+    for script in scripts:
+        if reload or script.sha not in _loaded_scripts:
+            await redis_client.script_load(script.script)
+            _loaded_scripts.add(script.sha)
+
+
+async def execute_with_scripts(build: t.Callable[[Pipeline], t.Awaitable[t.Any]], *scripts: AsyncScript) -> list:
+    """Executes the non-transactional pipeline built by `build`, which runs the scripts.
+
+    If a shard misses the scripts, e.g. after a failover, they are loaded again and the whole pipeline is retried,
+    so it should be idempotent.
+    """
+    for attempt in range(2):
+        await load_scripts(*scripts, reload=attempt > 0)
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                await build(pipe)
+                return await pipe.execute()
+        except NoScriptError:
+            if attempt > 0:
+                raise
+
+
+async def get_shard_clients() -> t.List[aioredis.Redis]:
+    """Returns the client of every primary node, or the only client of the single instance.
+
+    The commands local to the node, e.g. SCAN, are sent to every shard separately.
+    """
+    if not memory_store_settings.CLUSTER:
+        return [redis_client]
+    await redis_client.initialize()
+    shard_clients = []
+    for node in redis_client.get_primaries():
+        if node.name not in _shard_clients:
+            _shard_clients[node.name] = aioredis.Redis(host=node.host, port=node.port)
+        shard_clients.append(_shard_clients[node.name])
+    return shard_clients
+
+
+async def get_pubsub_client() -> aioredis.Redis:
+    """Returns the client for the pub/sub channels, the messages published to a cluster node reach every node."""
+    return (await get_shard_clients())[0]
+
+
+def get_chat_messages_key(chat_session_key: str) -> str:
+    """Returns the key of the list holding the messages of the chat session."""
+    return f"{chat_session_key}:messages"
+
+
+def get_user_balance_key(user_session_key: str) -> str:
+    """Returns the key of the hash holding the balance and the token usage of the user session."""
+    return f"{user_session_key}:balance"
+
+
+def get_preload_marker_key(session_key: str) -> str:
+    """Returns the key marking the session preloaded from the Datastore and not changed since then."""
+    return f"preloaded:{session_key}"
+
+
+class DirtySessions:
+    """This class keeps the session keys written by the process within the last `retention` seconds.
+
+    They are flushed to the Datastore when the process is about to stop, so the writes do not wait for
+    the listener to reach their flush deadlines.
+    """
+
+    def __init__(self, retention: float):
+        self.retention = retention
+        self._written_at: t.OrderedDict[str, float] = collections.OrderedDict()
+
+    def add(self, session_key: str):
+        now = time.monotonic()
+        self._written_at[session_key] = now
+        self._written_at.move_to_end(session_key)
+        while next(iter(self._written_at.values())) < now - self.retention:
+            self._written_at.popitem(last=False)
 
-from core.settings import Settings
+    def pop_all(self) -> t.List[str]:
+        session_keys = list(self._written_at)
+        self._written_at.clear()
+        return session_keys
 
-settings = Settings()
 
-# Set up the Memorystore (Redis) connection
-redis_client = redis.Redis(host=settings.MEMORY_STORE_SETTINGS.HOST,
-                           port=settings.MEMORY_STORE_SETTINGS.PORT)
+dirty_sessions = DirtySessions(retention=settings.LIFECYCLE_SETTINGS.DIRTY_RETENTION)
@@ -0,0 +1,178 @@
+"""
+This module holds the in-process cache of the session payloads read from the Memorystore (Redis).
+
+The raw payloads are kept in a bounded LRU, so the read-mostly commands are answered without a network hop.
+Every session write invalidates its keys in all the processes through a Redis pub/sub channel, while the short
+`TTL` bounds the staleness if an invalidation is missed. The cache is only used by the processes subscribed to
+the channel, see `SessionCache.start`.
+
+The concurrent loads of the same key are deduplicated (single-flight), so N concurrent misses cause one load.
+"""
+import asyncio
+import collections
+import json
+import logging
+import time
+import typing as t
+
+from core.metrics import SESSION_CACHE_LOOKUPS
+from core.redis_tools import get_pubsub_client
+from core.settings import get_settings
+
+settings = get_settings()
+cache_settings = settings.SESSION_CACHE_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = "session_invalidation"
+
+T = t.TypeVar("T")
+
+
+class SessionCache:
+    """This class is responsible for caching the session payloads in the process memory."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: t.OrderedDict[str, t.Tuple[float, t.Any]] = collections.OrderedDict()
+        self._flights: t.Dict[str, asyncio.Future] = {}  # the loads in progress
+        self._stale: t.Set[str] = set()  # the keys invalidated while being loaded
+        self._subscriber: t.Optional[asyncio.Task] = None
+
+    @property
+    def is_enabled(self) -> bool:
+        """The cache is coherent only while the invalidations are received."""
+        return self._subscriber is not None and not self._subscriber.done()
+
+    async def start(self):
+        pubsub = (await get_pubsub_client()).pubsub()
+        await pubsub.subscribe(INVALIDATION_CHANNEL)
+        self._subscriber = asyncio.create_task(self._receive_invalidations(pubsub))
+
+    async def stop(self):
+        if self._subscriber is not None:
+            self._subscriber.cancel()
+            await asyncio.gather(self._subscriber, return_exceptions=True)
+            self._subscriber = None
+        self._entries.clear()
+
+    async def read_many(self, keys: t.List[str],
+                        fetch: t.Callable[[t.List[str]], t.Awaitable[t.Dict[str, t.Any]]]) -> t.Dict[str, t.Any]:
+        """Returns the payloads of the keys, fetching the ones which are neither cached nor being loaded.
+
+        The payloads missing in Redis (None) are not cached.
+        """
+        results, waiting, missing = {}, {}, []
+        for key in keys:
+            if self.is_enabled and (entry := self._get(key)) is not None:
+                results[key] = entry
+            elif key in self._flights:
+                waiting[key] = self._flights[key]
+            else:
+                missing.append(key)
+        SESSION_CACHE_LOOKUPS.labels(result="hit").inc(len(results))
+        SESSION_CACHE_LOOKUPS.labels(result="miss").inc(len(keys) - len(results))
+        if missing:
+            results.update(await self._load(missing, fetch))
+        for key, flight in waiting.items():
+            results[key] = await asyncio.shield(flight)
+        return results
+
+    async def read(self, key: str, fetch: t.Callable[[], t.Awaitable[t.Any]]) -> t.Any:
+        async def fetch_one(_: t.List[str]) -> t.Dict[str, t.Any]:
+            return {key: await fetch()}
+
+        return (await self.read_many([key], fetch_one))[key]
+
+    async def single_flight(self, key: str, load: t.Callable[[], t.Awaitable[T]]) -> T:
+        """Runs the load, or joins the load of the same key which is already in progress. Nothing is cached."""
+        flight = self._flights.get(key)
+        if flight is not None:
+            return await asyncio.shield(flight)
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await load()
+        except BaseException as exp:
+            flight.set_exception(exp)
+            flight.exception()  # marks the exception as retrieved, if nobody else is waiting
+            raise
+        finally:
+            self._flights.pop(key, None)
+        flight.set_result(result)
+        return result
+
+    async def invalidate(self, *keys: str):
+        """Drops the keys in this process and publishes their invalidation to the other ones."""
+        self.invalidate_locally(keys)
+        await publish_invalidation(keys)
+
+    def invalidate_locally(self, keys: t.Iterable[str]):
+        for key in keys:
+            self._entries.pop(key, None)
+            if key in self._flights:
+                self._stale.add(key)
+
+    async def _load(self, keys: t.List[str],
+                    fetch: t.Callable[[t.List[str]], t.Awaitable[t.Dict[str, t.Any]]]) -> t.Dict[str, t.Any]:
+        loop = asyncio.get_running_loop()
+        flights = {key: loop.create_future() for key in keys}
+        self._flights.update(flights)
+        try:
+            results = await fetch(keys)
+        except BaseException as exp:
+            for flight in flights.values():
+                flight.set_exception(exp)
+                flight.exception()
+            raise
+        finally:
+            for key in keys:
+                self._flights.pop(key, None)
+        for key, flight in flights.items():
+            value = results[key]
+            if key in self._stale:
+                self._stale.discard(key)  # the value may be older than the invalidating write
+            elif value is not None and self.is_enabled:
+                self._put(key, value)
+            flight.set_result(value)
+        return results
+
+    def _get(self, key: str) -> t.Optional[t.Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put(self, key: str, value: t.Any):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def _receive_invalidations(self, pubsub):
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    self.invalidate_locally(json.loads(message["data"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Receiving the session invalidations failed, the session cache is disabled.")
+        finally:
+            self._entries.clear()
+            await pubsub.close()
+
+
+async def publish_invalidation(keys: t.Iterable[str]):
+    """Notifies the processes caching the sessions that the keys have changed."""
+    keys = list(keys)
+    if keys:
+        await (await get_pubsub_client()).publish(INVALIDATION_CHANNEL, json.dumps(keys))
+
+
+session_cache = SessionCache(max_size=cache_settings.MAX_SIZE, ttl=cache_settings.TTL)
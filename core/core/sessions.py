@@ -1,45 +1,191 @@
 """
 That module holds the functionality connected with ChatSession from Memorystore (Redis) in-memory database.
 ChatSessions reduce the load on the Datastore database, by storing the data in the Memorystore.
+All the Redis calls are awaitable and go through the shared asyncio connection pool, so they never block the event loop.
+
+The chat is stored in two keys: `chat_session:{<id>}` holds the chat settings and the system message, while
+`chat_session:{<id>}:messages` is a list of the messages, so a new message is appended in O(1) and only the tail
+needed for the prompt is read.
 """
-import json
 import logging
+import typing as t
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from redis.asyncio.client import Pipeline
 from telegram import Update
 
-from core.constants import TWO_MINUTES
-from core.datastore import DatastoreManager, UserAccount, Chat
-from core.redis_tools import redis_client
+from core.accounting import UserBalance
+from core.codec import session_codec
+from core.constants import CHAT_HISTORY_WINDOW, CHAT_HISTORY_MAX_LENGTH, RedisPrefixes
+from core.datastore import UserAccount, Chat, get_datastore_gateway
+from core.metrics import SESSION_GET_LATENCY, SESSION_LOOKUPS, timed
+from core.models import Message, new_message_id, number_legacy_messages
+from core.open_ai import tokenizer
+from core.redis_tools import redis_client, dirty_sessions, get_chat_messages_key, get_preload_marker_key, \
+    execute_with_scripts, get_session_key, get_shadow_key, get_user_balance_key, schedule_flush, session_pipeline
+from core.session_cache import session_cache
+from core.usage_stats import index_username
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+RedisCommand = t.Callable[[Pipeline], t.Any]
+
+# Replaces the folded messages of the chat with the summary, only if the chat settings (the first key) are still
+# the ones read (the first argument) and the folded messages are still at the position they were read at
+# (the second argument) of the list under the second key. Then sets the shadow key (the third key) and drops
+# the preload marker (the fourth key). The new chat settings are the third argument, the folded messages are
+# the rest of them.
+APPLY_SUMMARY_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+local start = tonumber(ARGV[2])
+local folded = redis.call('lrange', KEYS[2], start, start + #ARGV - 4)
+if #folded ~= #ARGV - 3 then
+    return 0
+end
+for i = 1, #folded do
+    if folded[i] ~= ARGV[i + 3] then
+        return 0
+    end
+end
+redis.call('set', KEYS[1], ARGV[3])
+redis.call('ltrim', KEYS[2], start + #folded, -1)
+redis.call('set', KEYS[3], '')
+redis.call('del', KEYS[4])
+return 1
+"""
+
+
+class SessionUnitOfWork:
+    """This class buffers all the session mutations made while handling one update.
+
+    The mutations are flushed in a single pipelined transaction, so the chat and the user account are
+    updated atomically together within one Redis round trip.
+    """
+
+    def __init__(self):
+        self._commands: t.List[RedisCommand] = []
+        self._payloads: t.Dict[str, bytes] = {}  # the last written payload per Redis key
+        self._sessions: t.Dict[str, None] = {}  # the written session keys, in the order of writing
+        self.identity_map: t.Dict[str, t.Any] = {}  # the entities loaded within the unit of work
+
+    def add(self, session_key: str, command: RedisCommand, payload: t.Optional[bytes] = None):
+        self._commands.append(command)
+        self._sessions[session_key] = None
+        if payload is not None:
+            self._payloads[session_key] = payload
+
+    def get(self, redis_key: str) -> t.Optional[bytes]:
+        return self._payloads.get(redis_key)
+
+    async def flush(self):
+        if not self._commands:
+            return
+        logger.debug(f"Flushing {len(self._sessions)} session(s) to Redis.")
+        async with session_pipeline() as pipe:
+            for command in self._commands:
+                command(pipe)
+            for session_key in self._sessions:
+                mark_for_persistence(pipe, session_key)
+            await pipe.execute()
+        await session_cache.invalidate(*self._sessions)
+        self._commands.clear()
+        self._payloads.clear()
+        self._sessions.clear()
+
+
+_unit_of_work: ContextVar[t.Optional[SessionUnitOfWork]] = ContextVar("session_unit_of_work", default=None)
+
+
+def mark_for_persistence(pipe: Pipeline, session_key: str):
+    """Adds the shadow key write and the flush scheduling to the pipeline.
+
+    The session keys are without the expiration time, they will be deleted afterwards in the listener.
+    The listener claims the session once its flush is due and persists it, the shadow key tells the listener
+    whether the session was written again in the meantime.
+    The session is not the preloaded copy of the Datastore one anymore, and it is flushed if the process stops.
+    """
+    pipe.set(get_shadow_key(session_key), "")
+    schedule_flush(pipe, session_key)
+    pipe.delete(get_preload_marker_key(session_key))
+    dirty_sessions.add(session_key)
+
+
+@asynccontextmanager
+async def unit_of_work() -> t.AsyncIterator[SessionUnitOfWork]:
+    """Opens a unit of work, which is flushed on the successful exit. The nested calls reuse the outer one."""
+    current = _unit_of_work.get()
+    if current is not None:
+        yield current
+        return
+    current = SessionUnitOfWork()
+    token = _unit_of_work.set(current)
+    try:
+        yield current
+    finally:
+        _unit_of_work.reset(token)
+    await current.flush()
+
+
+def atomic_sessions(func):
+    """Runs the handler within a unit of work."""
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with unit_of_work():
+            return await func(*args, **kwargs)
+
+    return wrapper
+
 
 class Session:
     """This class is responsible for working with the ChatSession in the Memorystore (Redis)"""
 
-    PREFIX = "session:"
+    PREFIX = "session"
 
     def __init__(self, entity_id, update: Update):
         self._id = entity_id
-        self.redis_key = f"{self.PREFIX}{entity_id}"
-        self.datastore_manager = DatastoreManager()
+        self.redis_key = get_session_key(self.PREFIX, entity_id)
         self.update = update
 
-    def set(self, entity: dict):
-        logger.debug(f"Setting {type(self).__name__} in Redis.")
-        """The first key value pair is without the expiration time, it will be deleted afterwards in 
-        listener.pu functionality"""
-        redis_client.set(self.redis_key, json.dumps(entity))
-        """The second key value pair has the expiration time, listener consumes it and retrieves the ID 
-        to delete afterwards"""
-        redis_client.set(f"shadow:{self.redis_key}", "", TWO_MINUTES)
+    async def set(self, entity: dict):
+        payload = session_codec.encode(entity)
+        await self._write(lambda pipe: pipe.set(self.redis_key, payload), payload=payload)
+
+    async def _write(self, command: RedisCommand, payload: t.Optional[bytes] = None):
+        """Buffers the command in the current unit of work or executes it right away."""
+        current_unit_of_work = _unit_of_work.get()
+        if current_unit_of_work is not None:
+            logger.debug(f"Buffering {type(self).__name__} write in the unit of work.")
+            current_unit_of_work.add(self.redis_key, command, payload=payload)
+            return
+        logger.debug(f"Writing {type(self).__name__} to Redis.")
+        async with session_pipeline() as pipe:
+            command(pipe)
+            mark_for_persistence(pipe, self.redis_key)
+            await pipe.execute()
+        await session_cache.invalidate(self.redis_key)
         logger.debug("Session set in Redis.")
 
-    def get(self, *args, **kwargs):
+    async def _get_payload(self) -> t.Optional[bytes]:
+        """Returns the payload buffered in the current unit of work, cached in the process or stored in Redis."""
+        current_unit_of_work = _unit_of_work.get()
+        if current_unit_of_work is not None:
+            payload = current_unit_of_work.get(self.redis_key)
+            if payload is not None:
+                return payload
+        return await session_cache.read(self.redis_key, lambda: redis_client.get(self.redis_key))
+
+    async def get(self, *args, **kwargs):
         raise NotImplementedError("This method should be implemented in the child class.")
 
-    def delete(self):
-        redis_client.delete(self.redis_key)
+    async def delete(self):
+        await redis_client.delete(self.redis_key, get_preload_marker_key(self.redis_key))
+        await session_cache.invalidate(self.redis_key)
 
     def __repr__(self):
         return f"{type(self).__name__} - ({self._id})"
@@ -50,51 +196,321 @@ class Session:
 class ChatSession(Session):
     """This class is responsible for working with the ChatSession in the Memorystore (Redis)"""
 
-    PREFIX = "chat_session:"
+    PREFIX = RedisPrefixes.CHAT_SESSION.value
+    _apply_summary = redis_client.register_script(APPLY_SUMMARY_SCRIPT)
+
+    def __init__(self, entity_id, update: Update):
+        super().__init__(entity_id, update)
+        self.messages_key = get_chat_messages_key(self.redis_key)
+        self.last_message_id = 0  # the id the appended messages are numbered after, set once the chat is got
+
+    async def set(self, entity: dict):
+        """Replaces the whole chat, the messages included."""
+        chat_data = dict(entity)
+        messages = [session_codec.encode(message) for message in chat_data.pop("messages")]
+        payload = session_codec.encode(chat_data)
+
+        def command(pipe: Pipeline):
+            pipe.set(self.redis_key, payload)
+            pipe.delete(self.messages_key)
+            if messages:
+                pipe.rpush(self.messages_key, *messages)
+                pipe.ltrim(self.messages_key, -CHAT_HISTORY_MAX_LENGTH, -1)
+
+        await self._write(command)
+
+    async def set_config(self, chat: Chat):
+        """Saves the chat settings and the system message, leaving the messages untouched."""
+        payload = session_codec.encode(chat.dict(exclude={"messages"}))
+        await self._write(lambda pipe: pipe.set(self.redis_key, payload))
+
+    async def append_messages(self, *messages: Message):
+        """Appends the messages, trimming the oldest ones beyond the history limit on the server side.
+
+        The messages without the ids are numbered after the newest one.
+        """
+        self._assign_ids(messages)
+        payloads = [session_codec.encode(message.dict()) for message in messages]
+
+        def command(pipe: Pipeline):
+            pipe.rpush(self.messages_key, *payloads)
+            pipe.ltrim(self.messages_key, -CHAT_HISTORY_MAX_LENGTH, -1)
+
+        await self._write(command)
+
+    async def set_last_message(self, message: Message):
+        payload = session_codec.encode(message.dict())
+        await self._write(lambda pipe: pipe.lset(self.messages_key, -1, payload))
+
+    async def pop_last_message(self):
+        await self._write(lambda pipe: pipe.rpop(self.messages_key))
+
+    async def trim_messages(self, keep_last: int):
+        """Keeps only the `keep_last` newest messages."""
+        if keep_last:
+            await self._write(lambda pipe: pipe.ltrim(self.messages_key, -keep_last, -1))
+        else:
+            await self.clear_messages()
 
-    def get(self) -> Chat:
+    async def clear_messages(self):
+        await self._write(lambda pipe: pipe.delete(self.messages_key))
+
+    async def clear_history(self, chat: Chat):
+        """Drops the messages and the summary of the chat.
+
+        The history starts after the dropped messages, so the ones already saved to the Datastore are not loaded
+        anymore and are left in place instead of being deleted.
+        """
+        chat.first_message_id = self.last_message_id = new_message_id(max(self.last_message_id, chat.last_message_id))
+        chat.messages = []
+        chat.summary = None
+        payload = session_codec.encode(chat.dict(exclude={"messages"}))
+
+        def command(pipe: Pipeline):
+            pipe.set(self.redis_key, payload)
+            pipe.delete(self.messages_key)
+
+        await self._write(command)
+
+    async def apply_summary(self, summary: Message, folded: t.List[Message], attempts: int = 3) -> bool:
+        """Replaces the folded messages with the summary, returns False if they are not in the history anymore.
+
+        That runs apart from the handlers, so the chat is updated optimistically: the script compares the chat
+        with the one read and the write is retried if the chat was changed in the meantime, keeping the messages
+        appended since the summary was requested.
+        """
+        folded_prompt = [message.to_prompt() for message in folded]
+        for _ in range(attempts):
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.get(self.redis_key)
+                pipe.lrange(self.messages_key, 0, -1)
+                chat, payloads = await pipe.execute()
+            stored = [Message(**session_codec.decode(payload)) for payload in payloads]
+            messages = [message.to_prompt() for message in stored]
+            # The last occurrence, as the folded messages directly precede the kept ones
+            start = next((index for index in range(len(messages) - len(folded), -1, -1)
+                          if messages[index:index + len(folded)] == folded_prompt), None)
+            if chat is None or start is None:
+                return False
+            chat_data = session_codec.decode(chat)
+            chat_data["summary"] = summary.dict()
+            end = start + len(folded)
+            # The folded messages are not loaded from the Datastore anymore
+            if end < len(stored) and stored[end].message_id:
+                chat_data["first_message_id"] = stored[end].message_id
+            elif stored[end - 1].message_id:
+                chat_data["first_message_id"] = stored[end - 1].message_id + 1
+            keys = [self.redis_key, self.messages_key, get_shadow_key(self.redis_key),
+                    get_preload_marker_key(self.redis_key)]
+            args = [chat, start, session_codec.encode(chat_data), *payloads[start:end]]
+
+            async def build(pipe: Pipeline):
+                schedule_flush(pipe, self.redis_key)  # a flush of the unchanged chat does no harm
+                await self._apply_summary(keys=keys, args=args, client=pipe)
+
+            _, is_applied = await execute_with_scripts(build, self._apply_summary)
+            if is_applied:
+                dirty_sessions.add(self.redis_key)
+                await session_cache.invalidate(self.redis_key)
+                return True
+            logger.debug("The chat was changed while applying the summary, retrying.")
+        return False
+
+    async def delete(self):
+        await redis_client.delete(self.redis_key, self.messages_key, get_preload_marker_key(self.redis_key))
+        await session_cache.invalidate(self.redis_key)
+
+    def add_reads(self, pipe: Pipeline):
+        """Adds the reads of the chat settings and the messages tail to the pipeline."""
+        pipe.get(self.redis_key)
+        pipe.lrange(self.messages_key, -CHAT_HISTORY_WINDOW, -1)
+
+    @timed(SESSION_GET_LATENCY, session="chat")
+    async def get(self) -> Chat:
+        current_unit_of_work = _unit_of_work.get()
+        if current_unit_of_work is not None and self.redis_key in current_unit_of_work.identity_map:
+            return self._remember(current_unit_of_work.identity_map[self.redis_key])
         logger.debug("Trying to get the ChatSession from Redis.")
-        chat: str = redis_client.get(self.redis_key)
-        user_name = f"{self.update.effective_user.first_name} {self.update.effective_user.last_name}"
-        if not user_name:
-            user_name = self.update.effective_user.username
+        chat, messages = await session_cache.read(self.redis_key, self.fetch) or (None, [])
+        return await self.load(chat, messages)
+
+    async def fetch(self) -> t.Optional[t.Tuple[bytes, t.List[bytes]]]:
+        """Returns the chat settings and the messages tail payloads, or None if the chat is not in Redis."""
+        async with redis_client.pipeline(transaction=False) as pipe:
+            self.add_reads(pipe)
+            chat, messages = await pipe.execute()
+        return (chat, messages) if chat else None
 
-        new_message = {
-            'role': 'user',
-            'content': f"{user_name} says:{self.update.effective_message.text}"
-        } if not self.update.effective_message.text.startswith('/') else None
+    async def load(self, chat: t.Optional[bytes], messages: t.List[bytes]) -> Chat:
+        """Returns the chat from the Redis payloads, or from the Datastore if there is no payload."""
+        SESSION_LOOKUPS.labels(session="chat", result="hit" if chat else "miss").inc()
         if chat:
-            chat_data: dict = json.loads(chat)
+            chat_data: dict = session_codec.decode(chat)
             logger.debug(f"ChatSession found in Redis: {chat_data}")
+            is_embedded = "messages" in chat_data  # the payloads written before the list layout embed the messages
+            if not is_embedded:
+                chat_data["messages"] = [session_codec.decode(message) for message in messages]
+                if chat_data["messages"] and chat_data["messages"][0].get("message_id") is None:
+                    # The lists written before the messages had the ids are numbered as a whole
+                    chat_data["messages"] = [session_codec.decode(message)
+                                             for message in await redis_client.lrange(self.messages_key, 0, -1)]
+            if number_legacy_messages(chat_data["messages"]) or is_embedded:
+                await self.set(chat_data)
+            chat_data["messages"] = chat_data["messages"][-CHAT_HISTORY_WINDOW:]
+            chat = self._remember(Chat(**chat_data))
+            new_message = self._get_new_message(chat)
             if new_message:
-                chat_data["messages"].append(new_message)
-                self.set(chat_data)
-            return Chat(**chat_data)
+                chat.messages.append(new_message)
+                await self.append_messages(new_message)
+            return chat
         logger.debug("ChatSession not found in Redis, getting it from the Datastore.")
-        chat_entity, _, created = self.datastore_manager.get_or_create_chat_entity(self.update)
+        chat_entity, _, created = await session_cache.single_flight(
+            f"datastore:{self.redis_key}", lambda: get_datastore_gateway().get_or_create_chat_entity(self.update))
         logger.debug(f"ChatSession found in the Datastore: {chat_entity}. Created - {created}")
-        chat_data: dict = json.loads(json.dumps(chat_entity), parse_int=str)
-        self.set(chat_data)
+        return await self.load_entity(chat_entity)
+
+    async def load_entity(self, chat_entity: dict) -> Chat:
+        """Returns the chat from the Datastore entity with the new message appended, caching it in Redis."""
+        chat = self._remember(Chat(**chat_entity))
+        new_message = self._get_new_message(chat)
+        if new_message:
+            self._assign_ids([new_message])
+            chat.messages.append(new_message)
+        await self.set(chat.dict())
         logger.debug("Updated ChatSession set in Redis.")
-        return Chat(**chat_data)
+        chat.messages = chat.messages[-CHAT_HISTORY_WINDOW:]
+        return chat
+
+    def _assign_ids(self, messages: t.Iterable[Message]):
+        for message in messages:
+            if message.message_id is None:
+                message.message_id = self.last_message_id = new_message_id(self.last_message_id)
+
+    def _remember(self, chat: Chat) -> Chat:
+        self.last_message_id = max(self.last_message_id, chat.last_message_id)
+        current_unit_of_work = _unit_of_work.get()
+        if current_unit_of_work is not None:
+            current_unit_of_work.identity_map[self.redis_key] = chat
+        return chat
+
+    def _get_new_message(self, chat: Chat) -> t.Optional[Message]:
+        if self.update.effective_message.text.startswith('/'):
+            return None
+        user_name = f"{self.update.effective_user.first_name} {self.update.effective_user.last_name}"
+        if not user_name:
+            user_name = self.update.effective_user.username
+        new_message = Message(role='user', content=f"{user_name} says:{self.update.effective_message.text}")
+        tokenizer.count_messages([new_message], model=chat.open_ai_config.current_model)
+        return new_message
 
 
 class UserSession(Session):
-    """This class is responsible for working with the UserSession in the Memorystore (Redis)"""
+    """This class is responsible for working with the UserSession in the Memorystore (Redis)
+
+    The balance and the token usage are changed only through `balance`, the stored document keeps the values
+    the session was loaded with.
+    """
+
+    PREFIX = RedisPrefixes.USER_SESSION.value
+
+    def __init__(self, entity_id, update: Update):
+        super().__init__(entity_id, update)
+        self.balance = UserBalance(self.redis_key)
+
+    async def set(self, entity: dict):
+        """Saves the user account, indexing its username for the admin commands."""
+        payload = session_codec.encode(entity)
+
+        def command(pipe: Pipeline):
+            pipe.set(self.redis_key, payload)
+            index_username(pipe, entity["user_id"], entity.get("username"))
+
+        await self._write(command, payload=payload)
 
-    PREFIX = "user_session:"
+    async def delete(self):
+        await redis_client.delete(self.redis_key, get_user_balance_key(self.redis_key),
+                                  get_preload_marker_key(self.redis_key))
+        await session_cache.invalidate(self.redis_key)
 
-    def get(self) -> UserAccount:
+    async def credit(self, cents: float, fetch_entity: t.Callable[[], t.Awaitable[dict]]) -> float:
+        """Adds the cents to the balance.
+
+        The user account entity is fetched, e.g. from the Datastore, and stored only if the session is not in Redis.
+        """
+        payload = await self._get_payload()
+        entity = session_codec.decode(payload) if payload is not None else await fetch_entity()
+        user_account = UserAccount(**entity)
+        balance = await self.balance.credit(user_account, cents, payload=session_codec.encode(user_account.dict()))
+        async with redis_client.pipeline(transaction=False) as pipe:
+            index_username(pipe, user_account.user_id, user_account.username)
+            await pipe.execute()
+        await session_cache.invalidate(self.redis_key)
+        return balance
+
+    @timed(SESSION_GET_LATENCY, session="user")
+    async def get(self) -> UserAccount:
         logger.debug("Trying to get the UserSession from Redis.")
-        user: str = redis_client.get(self.redis_key)
+        return await self.load(await self._get_payload())
+
+    async def load(self, user: t.Optional[bytes]) -> UserAccount:
+        """Returns the user account from the Redis payload, or from the Datastore if there is no payload."""
+        SESSION_LOOKUPS.labels(session="user", result="hit" if user else "miss").inc()
         if user:
-            user_data: dict = json.loads(user)
+            user_data: dict = session_codec.decode(user)
             logger.debug(f"UserSession found in Redis: {user_data}")
             return UserAccount(**user_data)
         logger.debug("UserSession not found in Redis, getting it from the Datastore.")
-        user_entity, _, created = self.datastore_manager.get_or_create_user_account_entity(self.update)
+        user_entity, _, created = await session_cache.single_flight(
+            f"datastore:{self.redis_key}",
+            lambda: get_datastore_gateway().get_or_create_user_account_entity(self.update))
         logger.debug(f"UserSession found in the Datastore: {user_entity}. Created - {created}")
-        user_data: dict = json.loads(json.dumps(user_entity), parse_int=str)
-        self.set(user_data)
+        return await self.load_entity(user_entity)
+
+    async def load_entity(self, user_entity: dict) -> UserAccount:
+        """Returns the user account from the Datastore entity, caching it in Redis."""
+        user_data: dict = UserAccount(**user_entity).dict()
+        await self.set(user_data)
         logger.debug("UserSession set in Redis.")
         return UserAccount(**user_data)
+
+
+@timed(SESSION_GET_LATENCY, session="chat_and_user")
+async def get_chat_and_user_account(chat_session: ChatSession,
+                                    user_session: UserSession) -> t.Tuple[Chat, UserAccount]:
+    """Returns both the chat and the user account of the update.
+
+    Both sessions are read from the process cache or from Redis within one round trip. If both are missing,
+    they are loaded from the Datastore with a single lookup.
+    """
+    current_unit_of_work = _unit_of_work.get()
+    if current_unit_of_work is not None and (chat_session.redis_key in current_unit_of_work.identity_map
+                                             or current_unit_of_work.get(user_session.redis_key)):
+        return await chat_session.get(), await user_session.get()
+
+    async def fetch(keys: t.List[str]) -> t.Dict[str, t.Any]:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            if chat_session.redis_key in keys:
+                chat_session.add_reads(pipe)
+            if user_session.redis_key in keys:
+                pipe.get(user_session.redis_key)
+            results = iter(await pipe.execute())
+        payloads = {}
+        if chat_session.redis_key in keys:
+            chat, messages = next(results), next(results)
+            payloads[chat_session.redis_key] = (chat, messages) if chat else None
+        if user_session.redis_key in keys:
+            payloads[user_session.redis_key] = next(results)
+        return payloads
+
+    payloads = await session_cache.read_many([chat_session.redis_key, user_session.redis_key], fetch)
+    chat_payload, chat_messages = payloads[chat_session.redis_key] or (None, [])
+    user_payload = payloads[user_session.redis_key]
+    if chat_payload or user_payload:
+        return await chat_session.load(chat_payload, chat_messages), await user_session.load(user_payload)
+    logger.debug("Both sessions not found in Redis, getting them from the Datastore.")
+    SESSION_LOOKUPS.labels(session="chat", result="miss").inc()
+    SESSION_LOOKUPS.labels(session="user", result="miss").inc()
+    (chat_entity, _, _), (user_entity, _, _) = await session_cache.single_flight(
+        f"datastore:{chat_session.redis_key}:{user_session.redis_key}",
+        lambda: get_datastore_gateway().get_or_create_chat_and_user_account_entities(chat_session.update))
+    return await chat_session.load_entity(chat_entity), await user_session.load_entity(user_entity)
@@ -2,6 +2,7 @@
     Pydantic settings for the application
 
 """
+import functools
 import os
 
 from dotenv import load_dotenv
@@ -17,6 +18,149 @@ class MemoryStoreSettings(BaseSettings):
     HOST: str = Field(env="MEMORYSTORE_HOST", default="localhost")
     PORT: int = Field(env="MEMORYSTORE_PORT", default=6379)
     DB: int = Field(env="MEMORYSTORE_DB", default=0)
+    MAX_CONNECTIONS: int = Field(env="MEMORYSTORE_MAX_CONNECTIONS", default=200)
+    CLUSTER: bool = Field(env="MEMORYSTORE_CLUSTER", default=False)  # HOST and PORT are any node of the cluster
+
+
+class OpenAISettings(BaseSettings):
+    """OpenAI HTTP client settings"""
+
+    API_BASE: str = Field(env="OPEN_AI_API_BASE", default="https://api.openai.com/v1")
+    POOL_SIZE: int = Field(env="OPEN_AI_POOL_SIZE", default=100)
+    CONNECT_TIMEOUT: float = Field(env="OPEN_AI_CONNECT_TIMEOUT", default=3)
+    KEEPALIVE_TIMEOUT: float = Field(env="OPEN_AI_KEEPALIVE_TIMEOUT", default=60)
+    TOKENIZER_OFFLOAD_THRESHOLD: int = Field(env="TOKENIZER_OFFLOAD_THRESHOLD", default=20_000)
+    TOKENIZER_WORKERS: int = Field(env="TOKENIZER_WORKERS", default=2)
+    STREAM_RESPONSES: bool = Field(env="OPEN_AI_STREAM_RESPONSES", default=True)
+
+
+class OpenAISchedulerSettings(BaseSettings):
+    """OpenAI request scheduler settings, the limits are shared by all the processes through Redis"""
+
+    ENABLED: bool = Field(env="OPEN_AI_SCHEDULER_ENABLED", default=True)
+    GPT_3_5_RPM: int = Field(env="OPEN_AI_GPT_3_5_RPM", default=3_500)  # requests per minute
+    GPT_3_5_TPM: int = Field(env="OPEN_AI_GPT_3_5_TPM", default=90_000)  # tokens per minute
+    GPT_4_RPM: int = Field(env="OPEN_AI_GPT_4_RPM", default=200)
+    GPT_4_TPM: int = Field(env="OPEN_AI_GPT_4_TPM", default=40_000)
+    LIMIT_SHARE: float = Field(env="OPEN_AI_LIMIT_SHARE", default=0.9)  # of the provider limits used
+    BURST_SECONDS: float = Field(env="OPEN_AI_BURST_SECONDS", default=10)  # of the rate allowed at once
+    PRIORITY_SECONDS_PER_1K_TOKENS: float = Field(env="OPEN_AI_PRIORITY_SECONDS_PER_1K_TOKENS", default=1)
+    GROUP_PRIORITY_DELAY: float = Field(env="OPEN_AI_GROUP_PRIORITY_DELAY", default=2)  # seconds
+    MAX_TRIES: int = Field(env="OPEN_AI_MAX_TRIES", default=3)  # per request, the rate limited retries included
+
+
+class CompletionCacheSettings(BaseSettings):
+    """OpenAI completion cache settings"""
+
+    ENABLED: bool = Field(env="COMPLETION_CACHE_ENABLED", default=False)
+    MAX_TEMPERATURE: float = Field(env="COMPLETION_CACHE_MAX_TEMPERATURE", default=0.2)  # only for the stable answers
+    TTL: int = Field(env="COMPLETION_CACHE_TTL", default=24 * 60 * 60)  # seconds
+    MAX_SIZE: int = Field(env="COMPLETION_CACHE_MAX_SIZE", default=10_000)  # entries
+    HIT_PRICE_SHARE: float = Field(env="COMPLETION_CACHE_HIT_PRICE_SHARE", default=1)  # of the original answer price
+
+
+class TelegramOutboundSettings(BaseSettings):
+    """Telegram Bot API client settings"""
+
+    CONNECTION_POOL_SIZE: int = Field(env="TELEGRAM_CONNECTION_POOL_SIZE", default=256)
+    POOL_TIMEOUT: float = Field(env="TELEGRAM_POOL_TIMEOUT", default=5)  # seconds to wait for a free connection
+    GLOBAL_RATE: float = Field(env="TELEGRAM_GLOBAL_RATE", default=30)  # requests per second
+    GLOBAL_BURST: float = Field(env="TELEGRAM_GLOBAL_BURST", default=30)
+    PRIVATE_CHAT_RATE: float = Field(env="TELEGRAM_PRIVATE_CHAT_RATE", default=1)
+    PRIVATE_CHAT_BURST: float = Field(env="TELEGRAM_PRIVATE_CHAT_BURST", default=3)
+    GROUP_CHAT_RATE: float = Field(env="TELEGRAM_GROUP_CHAT_RATE", default=20 / 60)
+    GROUP_CHAT_BURST: float = Field(env="TELEGRAM_GROUP_CHAT_BURST", default=3)
+    MAX_CHATS: int = Field(env="TELEGRAM_MAX_CHATS", default=10_000)  # chat buckets kept per process
+    MAX_RETRIES: int = Field(env="TELEGRAM_MAX_RETRIES", default=3)  # after RetryAfter
+    CHAT_ACTION_INTERVAL: float = Field(env="TELEGRAM_CHAT_ACTION_INTERVAL", default=4.5)  # an action lasts 5 seconds
+
+
+class HistoryCompactionSettings(BaseSettings):
+    """Chat history compaction by rolling summaries settings"""
+
+    ENABLED: bool = Field(env="HISTORY_COMPACTION_ENABLED", default=True)
+    THRESHOLD: float = Field(env="HISTORY_COMPACTION_THRESHOLD", default=0.8)  # of max_tokens taken by the prompt
+    KEEP_SHARE: float = Field(env="HISTORY_COMPACTION_KEEP_SHARE", default=0.4)  # of max_tokens kept verbatim
+    SUMMARY_MAX_TOKENS: int = Field(env="HISTORY_COMPACTION_SUMMARY_MAX_TOKENS", default=300)
+
+
+class DatastoreSettings(BaseSettings):
+    """Datastore client settings"""
+
+    WORKERS: int = Field(env="DATASTORE_WORKERS", default=16)  # threads running the blocking RPCs
+
+
+class SessionCacheSettings(BaseSettings):
+    """In-process session cache settings"""
+
+    ENABLED: bool = Field(env="SESSION_CACHE_ENABLED", default=True)
+    MAX_SIZE: int = Field(env="SESSION_CACHE_MAX_SIZE", default=10_000)  # sessions per process
+    TTL: float = Field(env="SESSION_CACHE_TTL", default=30)  # seconds, bounds the staleness of a missed invalidation
+
+
+class SessionCodecSettings(BaseSettings):
+    """Session payload codec settings"""
+
+    CODEC: str = Field(env="SESSION_CODEC", default="msgpack")  # json or msgpack
+    COMPRESSION_THRESHOLD: int = Field(env="SESSION_COMPRESSION_THRESHOLD", default=1024)  # bytes
+    COMPRESSION_LEVEL: int = Field(env="SESSION_COMPRESSION_LEVEL", default=1)
+
+
+class DispatcherSettings(BaseSettings):
+    """Incoming updates dispatcher settings"""
+
+    WORKERS: int = Field(env="DISPATCHER_WORKERS", default=32)  # updates processed concurrently per process
+    MAX_PENDING: int = Field(env="DISPATCHER_MAX_PENDING", default=1_000)
+    MAX_PENDING_PER_CHAT: int = Field(env="DISPATCHER_MAX_PENDING_PER_CHAT", default=20)  # then it is held back
+    SHUTDOWN_TIMEOUT: float = Field(env="DISPATCHER_SHUTDOWN_TIMEOUT", default=30)
+
+
+class UpdateStreamSettings(BaseSettings):
+    """Redis stream backed update queue settings"""
+
+    ENABLED: bool = Field(env="UPDATE_STREAM_ENABLED", default=False)  # the webhook only appends to the stream
+    PARTITIONS: int = Field(env="UPDATE_STREAM_PARTITIONS", default=16)  # the streams the chats are spread over
+    GROUP: str = Field(env="UPDATE_STREAM_GROUP", default="update-workers")
+    MAX_LENGTH: int = Field(env="UPDATE_STREAM_MAX_LENGTH", default=100_000)  # entries kept per partition
+    READ_COUNT: int = Field(env="UPDATE_STREAM_READ_COUNT", default=10)
+    READ_BLOCK: float = Field(env="UPDATE_STREAM_READ_BLOCK", default=1)  # seconds
+    LEASE_TTL: float = Field(env="UPDATE_STREAM_LEASE_TTL", default=10)  # seconds
+    CLAIM_IDLE: float = Field(env="UPDATE_STREAM_CLAIM_IDLE", default=60)  # seconds, for the gone consumers
+    METRICS_PORT: int = Field(env="UPDATE_WORKER_METRICS_PORT", default=9101)  # the update worker Prometheus port
+
+
+class ListenerSettings(BaseSettings):
+    """Listener (Memorystore to Datastore write-behind) settings"""
+
+    WORKERS: int = Field(env="LISTENER_WORKERS", default=4)
+    QUEUE_SIZE: int = Field(env="LISTENER_QUEUE_SIZE", default=1_000)
+    BATCH_SIZE: int = Field(env="LISTENER_BATCH_SIZE", default=100)  # Datastore allows up to 500 per commit
+    BATCH_WAIT: float = Field(env="LISTENER_BATCH_WAIT", default=0.5)
+    POLL_INTERVAL: float = Field(env="LISTENER_POLL_INTERVAL", default=1)  # once no flush is due
+    CLAIM_TIMEOUT: float = Field(env="LISTENER_CLAIM_TIMEOUT", default=60)  # then an unsaved session is claimed again
+    MAX_RETRIES: int = Field(env="LISTENER_MAX_RETRIES", default=5)
+    RETRY_BASE_DELAY: float = Field(env="LISTENER_RETRY_BASE_DELAY", default=0.5)
+    METRICS_PORT: int = Field(env="LISTENER_METRICS_PORT", default=9100)  # the listener Prometheus port
+
+
+class LifecycleSettings(BaseSettings):
+    """Session preload on start up and flush on shutdown settings"""
+
+    PRELOAD_CHATS: int = Field(env="PRELOAD_CHATS", default=1_000)  # the most recently active ones, 0 disables
+    PRELOAD_USERS: int = Field(env="PRELOAD_USERS", default=1_000)
+    PRELOAD_TTL: int = Field(env="PRELOAD_TTL", default=30 * 60)  # seconds an untouched preloaded session is kept
+    PRELOAD_INTERVAL: int = Field(env="PRELOAD_INTERVAL", default=5 * 60)  # seconds, one process preloads per interval
+    BATCH_SIZE: int = Field(env="LIFECYCLE_BATCH_SIZE", default=100)  # Datastore allows up to 500 per commit
+    FLUSH_TIMEOUT: float = Field(env="LIFECYCLE_FLUSH_TIMEOUT", default=20)
+    DIRTY_RETENTION: float = Field(env="LIFECYCLE_DIRTY_RETENTION", default=10 * 60)  # seconds a write is tracked
+
+
+class UsageStatsSettings(BaseSettings):
+    """Admin usage report settings"""
+
+    DAYS_KEPT: int = Field(env="USAGE_STATS_DAYS_KEPT", default=90)  # the daily aggregates expire afterwards
+    REPORT_DAYS: int = Field(env="USAGE_STATS_REPORT_DAYS", default=7)
+    TOP_USERS: int = Field(env="USAGE_STATS_TOP_USERS", default=10)
 
 
 class Settings(BaseSettings):
@@ -25,11 +169,31 @@ class Settings(BaseSettings):
     OPEN_AI_API_KEY: str = Field(env="OPEN_AI_API_KEY")
     TELEGRAM_BOT_API_TOKEN: str = Field(env="TELEGRAM_BOT_API_TOKEN")
     TELEGRAM_WEBHOOK_URL: str = Field(env="TELEGRAM_WEBHOOK_URL")
+    TELEGRAM_API_BASE_URL: str = Field(env="TELEGRAM_API_BASE_URL", default="https://api.telegram.org/bot")
     BOT_USERNAME: str = Field(env="BOT_USERNAME")
     GOOGLE_CLOUD_PROJECT: str = Field(env="GOOGLE_CLOUD_PROJECT")
     ADMIN_CHAT_ID: str = Field(env="ADMIN_CHAT_ID")
     MEMORY_STORE_SETTINGS: MemoryStoreSettings = MemoryStoreSettings()
+    OPEN_AI_SETTINGS: OpenAISettings = OpenAISettings()
+    OPEN_AI_SCHEDULER_SETTINGS: OpenAISchedulerSettings = OpenAISchedulerSettings()
+    COMPLETION_CACHE_SETTINGS: CompletionCacheSettings = CompletionCacheSettings()
+    TELEGRAM_OUTBOUND_SETTINGS: TelegramOutboundSettings = TelegramOutboundSettings()
+    HISTORY_COMPACTION_SETTINGS: HistoryCompactionSettings = HistoryCompactionSettings()
+    DATASTORE_SETTINGS: DatastoreSettings = DatastoreSettings()
+    DISPATCHER_SETTINGS: DispatcherSettings = DispatcherSettings()
+    UPDATE_STREAM_SETTINGS: UpdateStreamSettings = UpdateStreamSettings()
+    LISTENER_SETTINGS: ListenerSettings = ListenerSettings()
+    SESSION_CODEC_SETTINGS: SessionCodecSettings = SessionCodecSettings()
+    SESSION_CACHE_SETTINGS: SessionCacheSettings = SessionCacheSettings()
+    LIFECYCLE_SETTINGS: LifecycleSettings = LifecycleSettings()
+    USAGE_STATS_SETTINGS: UsageStatsSettings = UsageStatsSettings()
 
     class Config:
         env_file = env_file_path  # Load settings from .env file
         env_file_encoding = "utf-8"  # Specify encoding of .env file
+
+
+@functools.lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """Returns the settings shared by the whole process, the environment and `.env` are read only once."""
+    return Settings()
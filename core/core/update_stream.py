@@ -0,0 +1,326 @@
+"""
+This module holds the Redis stream backed queue of the incoming updates.
+
+The webhook appends the raw updates to a set of streams partitioned by the chat id, so the HTTP ingress stays cheap
+and the processing can be scaled on its own. The update workers consume the streams through a consumer group.
+Every partition is leased by a single consumer at a time, which keeps the updates of one chat in order across
+the workers and the nodes, while the leases are spread evenly over the live consumers.
+An entry is acknowledged once its update is processed. A consumer giving up a partition stops reading it and keeps
+the lease until the entries it has submitted are acknowledged, so the next consumer never processes a chat alongside
+it. A consumer taking a partition over first claims the entries left by the previous holder whose heartbeat expired,
+or waits up to `CLAIM_IDLE` seconds for the one still alive to acknowledge them, and only then reads the new ones.
+Later on, the entries of the consumers whose heartbeats expired are claimed after `CLAIM_IDLE` seconds of idling,
+the ones of the live consumers are never taken over.
+"""
+import asyncio
+import collections
+import json
+import logging
+import math
+import os
+import random
+import socket
+import time
+import typing as t
+import uuid
+
+from redis.exceptions import ResponseError
+from telegram import Bot, Update
+
+from core.dispatcher import get_update_chat_key
+from core.redis_tools import redis_client
+from core.settings import get_settings
+
+settings = get_settings()
+stream_settings = settings.UPDATE_STREAM_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+UPDATE_STREAM_PREFIX = "telegram_updates"
+CONSUMERS_KEY = f"{UPDATE_STREAM_PREFIX}:consumers"  # the heartbeats of the live consumers
+DRAIN_POLL_INTERVAL = 0.1  # seconds
+
+# Prolongs the lease (the first key) only if it is still held by the consumer
+RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Releases the lease (the first key) only if it is still held by the consumer
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def get_stream_key(partition: int) -> str:
+    return f"{UPDATE_STREAM_PREFIX}:{partition}"
+
+
+def get_lease_key(partition: int) -> str:
+    return f"{UPDATE_STREAM_PREFIX}:{partition}:lease"
+
+
+def get_entry_id_order(entry_id: bytes) -> t.Tuple[int, ...]:
+    return tuple(int(part) for part in entry_id.split(b"-"))
+
+
+def get_raw_update_chat_id(data: dict) -> t.Optional[int]:
+    """Returns the chat id of the raw update without deserializing it, or None if the update has no chat."""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        if "chat" in value:  # messages, channel posts, chat member updates and join requests
+            return value["chat"]["id"]
+        if isinstance(value.get("message"), dict):  # callback queries
+            return value["message"]["chat"]["id"]
+        if "from" in value:  # inline and shipping queries are bound to the user
+            return value["from"]["id"]
+    return None
+
+
+def get_update_partition(data: dict) -> int:
+    chat_id = get_raw_update_chat_id(data)
+    if chat_id is None:
+        chat_id = data.get("update_id", 0)
+    return chat_id % stream_settings.PARTITIONS
+
+
+async def publish_update(data: dict):
+    """Appends the raw update to the stream of its partition."""
+    await redis_client.xadd(get_stream_key(get_update_partition(data)), {"update": json.dumps(data)},
+                            maxlen=stream_settings.MAX_LENGTH, approximate=True)
+
+
+class StreamEntry(t.NamedTuple):
+    stream: str
+    entry_id: bytes
+    update: Update
+
+
+class UpdateStreamConsumer:
+    """This class is responsible for consuming the leased partitions of the update stream.
+
+    The entries are passed to `submit`, which should eventually call `process_entry`, e.g. the dispatcher.
+    """
+
+    def __init__(self, bot: Bot, process: t.Callable[[Update], t.Awaitable[t.Any]]):
+        self.bot = bot
+        self.name = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._process = process
+        self._submit: t.Optional[t.Callable[[StreamEntry], t.Awaitable[t.Any]]] = None
+        # The leased partitions and the tasks consuming them, or draining them once they are given up
+        self._partitions: t.Dict[int, asyncio.Task] = {}
+        self._draining: t.Set[int] = set()
+        self._in_flight: t.Dict[str, t.Set[bytes]] = collections.defaultdict(set)  # submitted and not acknowledged
+        self._is_stopping = False
+        self._lease_task: t.Optional[asyncio.Task] = None
+        self._renew_lease = redis_client.register_script(RENEW_LEASE_SCRIPT)
+        self._release_lease = redis_client.register_script(RELEASE_LEASE_SCRIPT)
+
+    async def start(self, submit: t.Callable[[StreamEntry], t.Awaitable[t.Any]]):
+        self._submit = submit
+        for partition in range(stream_settings.PARTITIONS):
+            try:
+                await redis_client.xgroup_create(get_stream_key(partition), stream_settings.GROUP, id="0",
+                                                 mkstream=True)
+            except ResponseError as error:
+                if "BUSYGROUP" not in str(error):  # the group is already created by another consumer
+                    raise
+        await self._balance_leases()
+        self._lease_task = asyncio.create_task(self._keep_leases())
+        logger.info(f"Update stream consumer {self.name} started.")
+
+    async def stop(self, timeout: t.Optional[float] = None):
+        """Stops consuming, releasing the leases once the submitted entries are acknowledged or after the timeout."""
+        self._is_stopping = True
+        for partition in list(self._partitions):
+            self._give_up_partition(partition)
+        if self._partitions:
+            await asyncio.wait(list(self._partitions.values()), timeout=timeout)  # the leases are still renewed
+        if self._lease_task is not None:
+            self._lease_task.cancel()
+            await asyncio.gather(self._lease_task, return_exceptions=True)
+            self._lease_task = None
+        for partition in list(self._partitions):
+            logger.warning(f"Releasing the update stream partition {partition} with "
+                           f"{len(self._in_flight[get_stream_key(partition)])} unacknowledged update(s).")
+            await self._cancel_partition(partition)
+            await self._release_lease(keys=[get_lease_key(partition)], args=[self.name])
+        await redis_client.zrem(CONSUMERS_KEY, self.name)
+
+    async def process_entry(self, entry: StreamEntry):
+        try:
+            await self._process(entry.update)
+        finally:
+            # A failed update is acknowledged as well, so it can't be redelivered over and over again
+            await self.ack(entry)
+
+    async def ack(self, entry: StreamEntry):
+        try:
+            await redis_client.xack(entry.stream, stream_settings.GROUP, entry.entry_id)
+        finally:
+            self._in_flight[entry.stream].discard(entry.entry_id)
+
+    async def _keep_leases(self):
+        while True:
+            await asyncio.sleep(stream_settings.LEASE_TTL / 3)
+            try:
+                await self._balance_leases()
+            except Exception:
+                logger.exception("Balancing the update stream leases failed.")
+
+    async def _balance_leases(self):
+        """Renews the held leases and acquires or releases the partitions to match the fair share."""
+        now = time.time()
+        lease_ttl = int(stream_settings.LEASE_TTL * 1000)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zadd(CONSUMERS_KEY, {self.name: now})
+            pipe.zremrangebyscore(CONSUMERS_KEY, "-inf", now - stream_settings.LEASE_TTL)
+            pipe.zcard(CONSUMERS_KEY)
+            consumers_num = (await pipe.execute())[-1]
+        share = math.ceil(stream_settings.PARTITIONS / max(consumers_num, 1))
+
+        for partition in list(self._partitions):  # the draining ones included
+            is_renewed = await self._renew_lease(keys=[get_lease_key(partition)], args=[self.name, lease_ttl])
+            if not is_renewed and partition in self._partitions:  # not released by its drain meanwhile
+                logger.warning(f"Lost the lease of the update stream partition {partition}.")
+                await self._cancel_partition(partition)
+        consumed = [partition for partition in self._partitions if partition not in self._draining]
+        for partition in consumed[share:]:
+            self._give_up_partition(partition)
+
+        if len(consumed) >= share or self._is_stopping:
+            return
+        offset = random.randrange(stream_settings.PARTITIONS)  # the consumers start looking at different partitions
+        for index in range(stream_settings.PARTITIONS):
+            partition = (offset + index) % stream_settings.PARTITIONS
+            if partition in self._partitions:
+                continue
+            if await redis_client.set(get_lease_key(partition), self.name, nx=True, px=lease_ttl):
+                self._partitions[partition] = asyncio.create_task(self._consume(partition))
+                logger.info(f"Leased the update stream partition {partition}.")
+                consumed.append(partition)
+                if len(consumed) >= share:
+                    break
+
+    def _give_up_partition(self, partition: int):
+        """Stops reading the partition, its lease is released once it is drained."""
+        if partition in self._draining:
+            return
+        self._draining.add(partition)
+        self._partitions[partition] = asyncio.create_task(self._drain(partition, self._partitions[partition]))
+
+    async def _drain(self, partition: int, consuming: asyncio.Task):
+        """Waits for the current batch to be submitted and for the submitted entries to be acknowledged,
+        then releases the lease."""
+        stream = get_stream_key(partition)
+        await asyncio.gather(consuming, return_exceptions=True)
+        while self._in_flight[stream]:
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+        await self._release_lease(keys=[get_lease_key(partition)], args=[self.name])
+        del self._partitions[partition]
+        self._draining.discard(partition)
+        logger.info(f"Released the drained update stream partition {partition}.")
+
+    async def _cancel_partition(self, partition: int):
+        """Stops consuming or draining the partition at once, the submitted entries are still processed."""
+        task = self._partitions.pop(partition, None)
+        self._draining.discard(partition)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _consume(self, partition: int):
+        stream = get_stream_key(partition)
+        loop = asyncio.get_running_loop()
+        # The entries left by the previous holder go before the new ones, so the updates of a chat stay in order
+        takeover_deadline = loop.time() + stream_settings.CLAIM_IDLE
+        next_claim = None
+        while partition not in self._draining:
+            try:
+                if next_claim is None:
+                    live_pending_num = await self._claim_stuck_entries(stream, min_idle_time=0)
+                    if live_pending_num and loop.time() < takeover_deadline:
+                        await asyncio.sleep(stream_settings.READ_BLOCK)  # the previous holder is still finishing
+                        continue
+                    if live_pending_num:
+                        logger.warning(f"Reading {stream} with {live_pending_num} update(s) left pending "
+                                       f"by the live consumers.")
+                    next_claim = loop.time() + stream_settings.CLAIM_IDLE / 2
+                elif loop.time() >= next_claim:
+                    await self._claim_stuck_entries(stream, min_idle_time=stream_settings.CLAIM_IDLE)
+                    next_claim = loop.time() + stream_settings.CLAIM_IDLE / 2
+                response = await redis_client.xreadgroup(stream_settings.GROUP, self.name, {stream: ">"},
+                                                         count=stream_settings.READ_COUNT,
+                                                         block=int(stream_settings.READ_BLOCK * 1000))
+                for _, entries in response or []:
+                    await self._submit_entries(stream, entries)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Consuming the update stream partition {partition} failed.")
+                await asyncio.sleep(stream_settings.READ_BLOCK)
+
+    async def _claim_stuck_entries(self, stream: str, min_idle_time: float) -> int:
+        """Resubmits the pending entries of the consumer which are not in flight, e.g. read by the consuming task
+        cancelled before submitting them, and takes over the ones not acknowledged for `min_idle_time` seconds
+        by the consumers whose heartbeats expired.
+
+        Returns the number of the entries left pending by the other live consumers.
+        """
+        name = self.name.encode("utf-8")
+        live_consumers = set(await redis_client.zrangebyscore(CONSUMERS_KEY, time.time() - stream_settings.LEASE_TTL,
+                                                              "+inf"))
+        live_pending_num = 0
+        start_id = "-"
+        while True:
+            pending = await redis_client.xpending_range(stream, stream_settings.GROUP, min=start_id, max="+",
+                                                        count=stream_settings.READ_COUNT)
+            if not pending:
+                return live_pending_num
+            start_id = b"(" + pending[-1]["message_id"]
+            own_ids = [entry["message_id"] for entry in pending
+                       if entry["consumer"] == name and entry["message_id"] not in self._in_flight[stream]]
+            orphaned_ids = [entry["message_id"] for entry in pending
+                            if entry["consumer"] != name and entry["consumer"] not in live_consumers]
+            live_pending_num += sum(entry["consumer"] != name and entry["consumer"] in live_consumers
+                                    for entry in pending)
+            entries = []
+            if own_ids:
+                entries.extend(await redis_client.xclaim(stream, stream_settings.GROUP, self.name, min_idle_time=0,
+                                                         message_ids=own_ids))
+            if orphaned_ids:
+                entries.extend(await redis_client.xclaim(stream, stream_settings.GROUP, self.name,
+                                                         min_idle_time=int(min_idle_time * 1000),
+                                                         message_ids=orphaned_ids))
+            entries = [(entry_id, fields) for entry_id, fields in entries if entry_id is not None]
+            if entries:
+                logger.warning(f"Redelivering {len(entries)} stuck update(s) of {stream}.")
+                await self._submit_entries(stream, sorted(entries, key=lambda entry: get_entry_id_order(entry[0])))
+
+    async def _submit_entries(self, stream: str, entries: t.List[t.Tuple[bytes, dict]]):
+        in_flight = self._in_flight[stream]
+        for entry_id, fields in entries:
+            if entry_id is None or entry_id in in_flight:  # the entry was trimmed from the stream or is submitted
+                continue
+            try:
+                update = Update.de_json(data=json.loads(fields[b"update"]), bot=self.bot)
+            except Exception:
+                logger.exception(f"Dropping the malformed update {entry_id} of {stream}.")
+                await redis_client.xack(stream, stream_settings.GROUP, entry_id)
+                continue
+            in_flight.add(entry_id)
+            try:
+                await self._submit(StreamEntry(stream=stream, entry_id=entry_id, update=update))
+            except BaseException:  # e.g. the consuming task is cancelled while the dispatcher is at its capacity
+                in_flight.discard(entry_id)
+                raise
+
+
+def get_entry_chat_key(entry: StreamEntry) -> t.Hashable:
+    return get_update_chat_key(entry.update)
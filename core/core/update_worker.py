@@ -0,0 +1,70 @@
+"""
+That module holds the update worker, which processes the updates appended to the Redis stream by the webhook.
+
+Any number of the workers can be run on any number of nodes, see `core.update_stream` for the details.
+"""
+import asyncio
+import logging
+import signal
+
+from prometheus_client import start_http_server
+
+from core.application import build_application
+from core.compaction import wait_for_compactions
+from core.datastore import close_datastore_gateway
+from core.dispatcher import ChatDispatcher
+from core.lifecycle import flush_dirty_sessions
+from core.open_ai import close_http_session, tokenizer
+from core.redis_tools import close_redis_pool
+from core.session_cache import session_cache
+from core.settings import get_settings
+from core.update_stream import UpdateStreamConsumer, get_entry_chat_key
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO
+)
+logger = logging.getLogger('update_worker')
+settings = get_settings()
+
+
+async def run():
+    tokenizer.warm_up()
+    application = build_application()
+    if settings.SESSION_CACHE_SETTINGS.ENABLED:
+        await session_cache.start()
+    await application.initialize()
+    await application.start()
+    consumer = UpdateStreamConsumer(bot=application.bot, process=application.process_update)
+    dispatcher = ChatDispatcher(process=consumer.process_entry,
+                                workers=settings.DISPATCHER_SETTINGS.WORKERS,
+                                max_pending=settings.DISPATCHER_SETTINGS.MAX_PENDING,
+                                max_pending_per_chat=settings.DISPATCHER_SETTINGS.MAX_PENDING_PER_CHAT,
+                                get_key=get_entry_chat_key)
+    await dispatcher.start()
+    await consumer.start(submit=dispatcher.submit)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopping.set)
+    await stopping.wait()
+
+    logger.info("Stopping the update worker")
+    await consumer.stop(timeout=settings.DISPATCHER_SETTINGS.SHUTDOWN_TIMEOUT)
+    await dispatcher.stop(timeout=settings.DISPATCHER_SETTINGS.SHUTDOWN_TIMEOUT)
+    await wait_for_compactions(timeout=settings.DISPATCHER_SETTINGS.SHUTDOWN_TIMEOUT)
+    await flush_dirty_sessions()
+    await application.stop()
+    await application.shutdown()
+    await session_cache.stop()
+    await close_redis_pool()
+    await close_http_session()
+    tokenizer.shutdown()
+    close_datastore_gateway()
+
+
+if __name__ == "__main__":
+    start_http_server(settings.UPDATE_STREAM_SETTINGS.METRICS_PORT)
+    logger.info("Start consuming the update stream")
+    asyncio.run(run())
@@ -0,0 +1,106 @@
+"""
+This module holds the admin lookups and the usage reports, kept in the Memorystore (Redis).
+
+The username index maps the usernames to the user ids and back. It is written alongside with every
+`UserSession` write, so the admin commands resolve a mention with one hash lookup instead of a Datastore query.
+
+The usage aggregates are incremented on every settled request: the spend and the token counters per model
+overall (`usage:total`) and per day (`usage:day:<date>`), and the spend per user (`usage:top_users`).
+So a report is a few hash reads, instead of scanning every `UserAccount`.
+"""
+import logging
+import typing as t
+from datetime import datetime, timedelta, timezone
+
+from redis.asyncio.client import Pipeline
+
+from core.redis_tools import redis_client
+from core.settings import get_settings
+
+settings = get_settings()
+usage_stats_settings = settings.USAGE_STATS_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+USERNAMES_KEY = "usernames"  # the username to the user id
+USER_NAMES_KEY = "user_names"  # the user id to the username
+TOTAL_USAGE_KEY = "usage:total"
+TOP_USERS_KEY = "usage:top_users"
+SPEND_COUNTER = "spend_cents"
+
+
+def normalize_username(username: str) -> str:
+    """The usernames are case-insensitive in Telegram and the mentions start with @."""
+    return username.lstrip("@").lower()
+
+
+def get_daily_usage_key(day: str) -> str:
+    return f"usage:day:{day}"
+
+
+def index_username(pipe: Pipeline, user_id: int, username: t.Optional[str]):
+    """Adds the writes of the username index entries of the user to the pipeline."""
+    if username:
+        pipe.hset(USERNAMES_KEY, normalize_username(username), user_id)
+        pipe.hset(USER_NAMES_KEY, user_id, username.lstrip("@"))
+
+
+async def find_user_id(username: str) -> t.Optional[int]:
+    """Returns the id of the user with the username, if the user session was written since the index exists."""
+    user_id = await redis_client.hget(USERNAMES_KEY, normalize_username(username))
+    return None if user_id is None else int(user_id)
+
+
+async def record_usage(user_id: int, model_field: str, counters: t.Dict[str, int], price_cents: float):
+    """Adds the price and the token counters of the settled request to the aggregates.
+
+    That is best effort, the failures are only logged, the balance is already settled.
+    """
+    daily_key = get_daily_usage_key(datetime.now(timezone.utc).date().isoformat())
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key in (TOTAL_USAGE_KEY, daily_key):
+                pipe.hincrbyfloat(key, f"{model_field}:{SPEND_COUNTER}", price_cents)
+                for counter, value in counters.items():
+                    pipe.hincrby(key, f"{model_field}:{counter}", value)
+            pipe.expire(daily_key, usage_stats_settings.DAYS_KEPT * 24 * 60 * 60)
+            pipe.zincrby(TOP_USERS_KEY, price_cents, user_id)
+            await pipe.execute()
+    except Exception:
+        logger.exception(f"Recording the usage of the user {user_id} failed.")
+
+
+def format_usage(fields: t.Dict[bytes, bytes]) -> t.List[str]:
+    """Returns a line per model, with the spend and the token counters of the model."""
+    models: t.Dict[str, t.Dict[str, float]] = {}
+    for name, value in fields.items():
+        model_field, counter = name.decode("utf-8").split(":", 1)
+        models.setdefault(model_field, {})[counter] = float(value)
+    lines = []
+    for model_field, counters in sorted(models.items()):
+        spend = counters.pop(SPEND_COUNTER, 0) / 100
+        tokens = ", ".join(f"{counter} {int(value)}" for counter, value in sorted(counters.items()))
+        lines.append(f"  {model_field}: ${spend:.2f}, {tokens}")
+    return lines or ["  no usage"]
+
+
+async def build_usage_report(days: int = usage_stats_settings.REPORT_DAYS,
+                             top_users: int = usage_stats_settings.TOP_USERS) -> str:
+    """Returns the report of the overall usage, the usage of the last days and the users who spent the most."""
+    today = datetime.now(timezone.utc).date()
+    dates = [(today - timedelta(days=offset)).isoformat() for offset in range(days)]
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(TOTAL_USAGE_KEY)
+        for day in dates:
+            pipe.hgetall(get_daily_usage_key(day))
+        pipe.zrevrange(TOP_USERS_KEY, 0, top_users - 1, withscores=True)
+        total, *daily, top = await pipe.execute()
+    names = await redis_client.hmget(USER_NAMES_KEY, [user_id for user_id, _ in top]) if top else []
+    lines = ["Total:", *format_usage(total)]
+    for day, fields in zip(dates, daily):
+        lines.extend([f"{day}:", *format_usage(fields)])
+    lines.append("Top users:")
+    for (user_id, spend), name in zip(top, names):
+        user = f"@{name.decode('utf-8')}" if name else user_id.decode("utf-8")
+        lines.append(f"  {user}: ${spend / 100:.2f}")
+    return "\n".join(lines)
@@ -0,0 +1,8 @@
+"""
+The tests run offline: the settings get placeholder values, Redis is faked by `tests.fake_redis`.
+"""
+import os
+
+for name, value in {"OPEN_AI_API_KEY": "x", "TELEGRAM_BOT_API_TOKEN": "1:x", "TELEGRAM_WEBHOOK_URL": "None",
+                    "BOT_USERNAME": "bot", "GOOGLE_CLOUD_PROJECT": "project", "ADMIN_CHAT_ID": "1"}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,21 @@
+"""
+Runs the shared Redis pool of `core.redis_tools` against an in-memory server, which runs the Lua scripts as well.
+"""
+import unittest
+
+from fakeredis import FakeServer
+from fakeredis.aioredis import FakeAsyncRedisConnection
+
+from core import redis_tools
+
+
+class FakeRedisTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        redis_tools.redis_pool.connection_class = FakeAsyncRedisConnection
+        redis_tools.redis_pool.connection_kwargs["server"] = FakeServer()
+        redis_tools.redis_pool.reset()  # a fresh server per test
+        self.redis = redis_tools.redis_client
+
+    async def asyncTearDown(self):
+        await redis_tools.redis_pool.disconnect()  # the connections are bound to the event loop of the test
@@ -0,0 +1,91 @@
+"""
+The balance scripts: the reservation, the settlement, the release and the credit of the user balance.
+"""
+import asyncio
+import unittest
+
+from core.accounting import UserBalance
+from core.constants import ChatModel, RedisPrefixes
+from core.models import ModelTokenUsage, UserAccount
+from core.redis_tools import FLUSH_SCHEDULE_KEY, get_preload_marker_key, get_session_key, get_shadow_key
+from core.usage_stats import TOTAL_USAGE_KEY
+from tests.fake_redis import FakeRedisTestCase
+
+USER_SESSION_KEY = get_session_key(RedisPrefixes.USER_SESSION.value, 7)
+USAGE = {"prompt_tokens": 20, "completion_tokens": 10, "total_tokens": 30}
+
+
+def build_user_account(current_balance: float = 100) -> UserAccount:
+    return UserAccount(user_id=7, username="user", current_balance=current_balance,
+                       model_token_usage=ModelTokenUsage())
+
+
+class UserBalanceTest(FakeRedisTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.balance = UserBalance(USER_SESSION_KEY)
+        self.user_account = build_user_account()
+
+    async def get_user_account(self) -> UserAccount:
+        return await self.balance.get(self.user_account)
+
+    async def test_reserve_deducts_from_the_seeded_balance(self):
+        await self.redis.set(get_preload_marker_key(USER_SESSION_KEY), "")
+        self.assertEqual(await self.balance.reserve(self.user_account, 30), (True, 70))
+        self.assertEqual((await self.get_user_account()).current_balance, 70)
+        # The session is written, so it is not the preloaded copy anymore and its flush is scheduled
+        self.assertTrue(await self.redis.exists(get_shadow_key(USER_SESSION_KEY)))
+        self.assertFalse(await self.redis.exists(get_preload_marker_key(USER_SESSION_KEY)))
+        self.assertIsNotNone(await self.redis.zscore(FLUSH_SCHEDULE_KEY, USER_SESSION_KEY))
+
+    async def test_reserve_refuses_what_the_balance_does_not_cover(self):
+        self.assertEqual(await self.balance.reserve(self.user_account, 101), (False, 100))
+        self.assertEqual((await self.get_user_account()).current_balance, 100)
+        self.assertFalse(await self.redis.exists(get_shadow_key(USER_SESSION_KEY)))
+
+    async def test_concurrent_reserves_never_overdraw(self):
+        results = await asyncio.gather(*(self.balance.reserve(self.user_account, 30) for _ in range(5)))
+        self.assertEqual(sum(is_reserved for is_reserved, _ in results), 3)
+        self.assertEqual((await self.get_user_account()).current_balance, 10)
+
+    async def test_settle_charges_the_price_instead_of_the_reservation(self):
+        await self.balance.reserve(self.user_account, 30)
+        balance = await self.balance.settle(self.user_account, reserved_cents=30, price_cents=45,
+                                            model=ChatModel.CHAT_GPT_4, usage=USAGE)
+        self.assertEqual(balance, 55)
+        user_account = await self.get_user_account()
+        self.assertEqual(user_account.current_balance, 55)
+        self.assertEqual(user_account.model_token_usage.gpt_4.dict(), USAGE)
+        self.assertEqual(float(await self.redis.hget(TOTAL_USAGE_KEY, "gpt_4:spend_cents")), 45)
+        self.assertEqual(int(await self.redis.hget(TOTAL_USAGE_KEY, "gpt_4:total_tokens")), 30)
+
+    async def test_settle_without_usage_charges_only_the_price(self):
+        await self.balance.settle(self.user_account, reserved_cents=0, price_cents=45, model=ChatModel.CHAT_GPT_4,
+                                  usage=None)
+        user_account = await self.get_user_account()
+        self.assertEqual(user_account.current_balance, 55)
+        self.assertEqual(user_account.model_token_usage.gpt_4.total_tokens, 0)
+        self.assertIsNone(await self.redis.hget(TOTAL_USAGE_KEY, "gpt_4:total_tokens"))
+
+    async def test_release_returns_the_reservation(self):
+        await self.balance.reserve(self.user_account, 30)
+        self.assertEqual(await self.balance.release(self.user_account, reserved_cents=30), 100)
+        self.assertEqual((await self.get_user_account()).current_balance, 100)
+
+    async def test_the_seed_applies_only_to_the_missing_hash(self):
+        await self.balance.reserve(self.user_account, 30)
+        # A stale user account document does not reset the balance kept in Redis
+        await self.balance.reserve(build_user_account(current_balance=1_000), 30)
+        self.assertEqual((await self.get_user_account()).current_balance, 40)
+
+    async def test_credit_stores_the_missing_session(self):
+        self.assertEqual(await self.balance.credit(self.user_account, 200, payload=b"user account"), 300)
+        self.assertEqual(await self.redis.get(USER_SESSION_KEY), b"user account")
+        await self.balance.credit(self.user_account, 200, payload=b"another user account")
+        self.assertEqual(await self.redis.get(USER_SESSION_KEY), b"user account")
+        self.assertEqual((await self.get_user_account()).current_balance, 500)
+
+
+if __name__ == "__main__":
+    unittest.main()
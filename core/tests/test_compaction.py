@@ -0,0 +1,69 @@
+"""
+The compaction reserves the price of the summary and skips it if the balance does not cover it.
+"""
+import types
+import unittest
+from unittest import mock
+
+from core.accounting import UserBalance
+from core.compaction import compact_history
+from core.constants import ChatModel, RedisPrefixes
+from core.models import Chat, Message, ModelTokenUsage, OpenAIConfig, UserAccount, pydantic_model_per_gpt_model
+from core.open_ai import tokenizer
+from core.redis_tools import get_session_key
+from tests.fake_redis import FakeRedisTestCase
+
+USAGE = {"prompt_tokens": 200, "completion_tokens": 100, "total_tokens": 300}
+
+
+class OpenAIResponse(dict):
+    """Like the OpenAI object, the usage is an item and the choices are an attribute."""
+
+    def __init__(self, content: str):
+        super().__init__(usage=USAGE)
+        self.choices = [types.SimpleNamespace(message=types.SimpleNamespace(content=content))]
+
+
+class CompactionBillingTest(FakeRedisTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.chat = Chat(chat_id=1, open_ai_config=OpenAIConfig(current_model=ChatModel.CHAT_GPT_4),
+                         system_message=Message(content="You are a helpful assistant."), messages=[])
+        self.folded = [Message(role="user", content="Alice says:Hi!"), Message(role="assistant", content="Hello!")]
+        self.user_session = mock.Mock(balance=UserBalance(get_session_key(RedisPrefixes.USER_SESSION.value, 7)))
+        self.chat_session = mock.AsyncMock()
+        patchers = [mock.patch.object(tokenizer, "acount_messages", mock.AsyncMock(return_value=[100, 100])),
+                    mock.patch.object(tokenizer, "count_messages")]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def compact(self, current_balance: float) -> mock.AsyncMock:
+        user_account = UserAccount(user_id=7, username="alice", current_balance=current_balance,
+                                   model_token_usage=ModelTokenUsage())
+        with mock.patch("core.compaction.generate_response",
+                        mock.AsyncMock(return_value=OpenAIResponse("Alice greeted."))) as generate_response:
+            await compact_history(self.chat, self.folded, chat_session=self.chat_session,
+                                  user_session=self.user_session, user_account=user_account)
+        return generate_response
+
+    async def get_balance(self) -> float:
+        return float(await self.redis.hget(self.user_session.balance.redis_key, "current_balance"))
+
+    async def test_summary_is_charged_its_price(self):
+        generate_response = await self.compact(current_balance=100)
+        generate_response.assert_awaited_once()
+        price_cents = pydantic_model_per_gpt_model[ChatModel.CHAT_GPT_4](**USAGE).calculate_price() * 100
+        self.assertAlmostEqual(await self.get_balance(), 100 - price_cents)
+        self.chat_session.apply_summary.assert_awaited_once()
+
+    async def test_summary_is_skipped_if_the_balance_does_not_cover_it(self):
+        generate_response = await self.compact(current_balance=1)
+        generate_response.assert_not_awaited()
+        self.assertEqual(await self.get_balance(), 1)
+        self.chat_session.apply_summary.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+The completion cache keys, entries and the billing of the cache hits.
+"""
+import typing as t
+import unittest
+from unittest import mock
+
+from core.bot_core import post_ai_response_logic
+from core.completion_cache import CompletionCache, completion_cache
+from core.models import Chat, Message, pydantic_model_per_gpt_model
+from core.open_ai import tokenizer
+from core.settings import get_settings
+from tests.fake_redis import FakeRedisTestCase
+
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful assistant."}
+USAGE = {"prompt_tokens": 20, "completion_tokens": 10, "total_tokens": 30}
+
+
+def build_chat(summary: t.Optional[str] = None) -> Chat:
+    return Chat(chat_id=1, system_message=Message(**SYSTEM_MESSAGE), messages=[],
+                summary=Message(role="system", content=summary) if summary else None)
+
+
+def build_messages(*history: t.Tuple[str, str], summary: t.Optional[str] = None) -> t.List[dict]:
+    context = [SYSTEM_MESSAGE, {"role": "system", "content": summary}] if summary else [SYSTEM_MESSAGE]
+    return context + [{"role": role, "content": content} for role, content in history]
+
+
+class CompletionCacheKeyTest(unittest.TestCase):
+
+    def test_same_greeting_of_different_users_shares_key(self):
+        self.assertEqual(CompletionCache.get_key(build_chat(), build_messages(("user", "Alice Smith says:Hi!"))),
+                         CompletionCache.get_key(build_chat(), build_messages(("user", "Bob says:  hi! "))))
+
+    def test_different_histories_ending_in_same_message_do_not_collide(self):
+        first = build_messages(("user", "Alice says:Tell me about my diagnosis"), ("assistant", "It is benign."),
+                               ("user", "Alice says:why?"))
+        second = build_messages(("user", "Bob says:Is the sky blue?"), ("assistant", "Yes."), ("user", "Bob says:why?"))
+        self.assertNotEqual(CompletionCache.get_key(build_chat(), first), CompletionCache.get_key(build_chat(), second))
+
+    def test_different_summaries_do_not_collide(self):
+        first = build_messages(("user", "Alice says:continue"), summary="Alice asked about her taxes.")
+        second = build_messages(("user", "Alice says:continue"), summary="Alice asked about a recipe.")
+        self.assertNotEqual(CompletionCache.get_key(build_chat(summary="Alice asked about her taxes."), first),
+                            CompletionCache.get_key(build_chat(summary="Alice asked about a recipe."), second))
+
+
+class CompletionCacheEntryTest(FakeRedisTestCase):
+
+    async def test_response_is_reused_for_another_user(self):
+        await completion_cache.set(build_chat(), build_messages(("user", "Al says:Hi!")),
+                                   response="Hello! Also, how can I help?", usage=USAGE)
+        self.assertEqual(await completion_cache.get(build_chat(), build_messages(("user", "Max says:Hi!"))),
+                         ("Hello! Also, how can I help?", USAGE))
+
+    async def test_response_mentioning_author_is_not_cached(self):
+        for response in ("Hello, Al!", "Hello, Al Brown!"):
+            await completion_cache.set(build_chat(), build_messages(("user", "Al Brown says:Hi!")),
+                                       response=response, usage=USAGE)
+            self.assertIsNone(await completion_cache.get(build_chat(), build_messages(("user", "Max says:Hi!"))))
+
+
+class CacheHitBillingTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_hit_is_charged_without_tokens(self):
+        chat = build_chat()
+        user_manager, chat_session = mock.AsyncMock(), mock.AsyncMock()
+        cache_settings = get_settings().COMPLETION_CACHE_SETTINGS
+        with mock.patch.object(cache_settings, "HIT_PRICE_SHARE", 0.5), mock.patch.object(tokenizer, "count_messages"):
+            await post_ai_response_logic(usage=USAGE, response="Hello!", chat=chat, user_manager=user_manager,
+                                         chat_session=chat_session, user_session=mock.Mock(), is_cached=True)
+        price_cents = pydantic_model_per_gpt_model[chat.open_ai_config.current_model](**USAGE).calculate_price() * 100
+        user_manager.settle.assert_awaited_once_with(mock.ANY, usage=None, price_cents=price_cents * 0.5)
+        self.assertEqual(chat.messages[-1].content, "Hello!")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+"""
+The flush schedule claims of the listener.
+"""
+import unittest
+
+from core.listener import CLAIM_SCRIPT
+from core.redis_tools import FLUSH_CLAIMS_KEY, FLUSH_SCHEDULE_KEY
+from tests.fake_redis import FakeRedisTestCase
+
+NOW = 1_000
+CLAIM_DEADLINE = NOW + 60
+
+
+class ClaimScriptTest(FakeRedisTestCase):
+
+    async def claim(self, limit: int = 10) -> dict:
+        claimed = await self.redis.register_script(CLAIM_SCRIPT)(keys=[FLUSH_SCHEDULE_KEY, FLUSH_CLAIMS_KEY],
+                                                                 args=[NOW, CLAIM_DEADLINE, limit])
+        return {key.decode("utf-8"): float(due_at) for key, due_at in zip(claimed[::2], claimed[1::2])}
+
+    async def test_due_sessions_are_moved_to_the_claims(self):
+        await self.redis.zadd(FLUSH_SCHEDULE_KEY, {"due": NOW - 1, "later": NOW + 1})
+        self.assertEqual(await self.claim(), {"due": NOW - 1})
+        self.assertEqual(await self.redis.zrange(FLUSH_SCHEDULE_KEY, 0, -1), [b"later"])
+        self.assertEqual(await self.redis.zscore(FLUSH_CLAIMS_KEY, "due"), CLAIM_DEADLINE)
+
+    async def test_expired_claims_are_claimed_again_first(self):
+        await self.redis.zadd(FLUSH_CLAIMS_KEY, {"unsaved": NOW - 1, "being saved": NOW + 1})
+        await self.redis.zadd(FLUSH_SCHEDULE_KEY, {"due": NOW - 1})
+        self.assertEqual(await self.claim(limit=1), {"unsaved": NOW - 1})
+        self.assertEqual(await self.claim(limit=1), {"due": NOW - 1})
+        self.assertEqual(await self.redis.zscore(FLUSH_CLAIMS_KEY, "being saved"), NOW + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
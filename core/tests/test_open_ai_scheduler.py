@@ -0,0 +1,54 @@
+"""
+The OpenAI scheduler returns the grants of the requests cancelled before being sent.
+"""
+import asyncio
+import unittest
+
+from core.open_ai import OpenAIScheduler, scheduler_settings
+from tests.fake_redis import FakeRedisTestCase
+
+FAMILY = "gpt-4"
+LIMITS_KEY = f"openai_limits:{FAMILY}"
+TOKENS = 1_000
+
+
+class OpenAISchedulerTest(FakeRedisTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.scheduler = OpenAIScheduler()
+        request_rate, token_rate = self.scheduler.get_limits(FAMILY)
+        self.request_capacity = request_rate * scheduler_settings.BURST_SECONDS
+        self.token_capacity = token_rate * scheduler_settings.BURST_SECONDS
+
+    async def get_buckets(self) -> tuple:
+        requests, tokens = await self.redis.hmget(LIMITS_KEY, "requests", "tokens")
+        return float(requests), float(tokens)
+
+    async def test_granted_request_keeps_its_budget(self):
+        await self.scheduler.acquire(FAMILY, TOKENS)
+        requests, tokens = await self.get_buckets()
+        self.assertAlmostEqual(requests, self.request_capacity - 1, places=1)
+        self.assertAlmostEqual(tokens, self.token_capacity - TOKENS, delta=10)
+
+    async def test_request_cancelled_during_grant_returns_it(self):
+        acquire_script = self.scheduler._acquire
+
+        async def acquire_and_cancel(**kwargs):
+            wait = await acquire_script(**kwargs)
+            task.cancel()  # the waiter goes away while its budget is being taken
+            await asyncio.sleep(0)
+            return wait
+
+        self.scheduler._acquire = acquire_and_cancel
+        task = asyncio.create_task(self.scheduler.acquire(FAMILY, TOKENS))
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        await self.scheduler._pumps[FAMILY]
+        requests, tokens = await self.get_buckets()
+        self.assertAlmostEqual(requests, self.request_capacity, places=1)
+        self.assertAlmostEqual(tokens, self.token_capacity, delta=10)
+
+
+if __name__ == "__main__":
+    unittest.main()
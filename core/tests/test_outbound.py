@@ -0,0 +1,63 @@
+"""
+The outbound throttling through `ExtBot`, which is how the handlers reach `ChatRateLimiter`.
+"""
+import asyncio
+import json
+import time
+import typing as t
+import unittest
+
+from telegram.error import RetryAfter
+from telegram.ext import ExtBot
+from telegram.request import BaseRequest
+
+from core.outbound import ChatRateLimiter
+
+RETRY_AFTER = 1  # seconds, the least Telegram asks for
+EDITED_MESSAGE = {"message_id": 2, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "edited"}
+
+
+class FakeRequest(BaseRequest):
+    """Answers the first `rate_limited` requests with `RetryAfter` and the following ones with the edited message."""
+
+    def __init__(self, rate_limited: int):
+        self.rate_limited = rate_limited
+        self.urls: t.List[str] = []
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None) -> t.Tuple[int, bytes]:
+        self.urls.append(url)
+        if len(self.urls) <= self.rate_limited:
+            return 429, json.dumps({"ok": False, "error_code": 429, "description": "Too Many Requests",
+                                    "parameters": {"retry_after": RETRY_AFTER}}).encode("utf-8")
+        return 200, json.dumps({"ok": True, "result": EDITED_MESSAGE}).encode("utf-8")
+
+
+class ChatRateLimiterTest(unittest.IsolatedAsyncioTestCase):
+
+    async def edit(self, request: FakeRequest, rate_limit_args: t.Optional[dict] = None):
+        bot = ExtBot(token="1:x", request=request, rate_limiter=ChatRateLimiter(max_retries=1))
+        await bot.edit_message_text(chat_id=1, message_id=2, text="edited", rate_limit_args=rate_limit_args)
+
+    async def test_skippable_edit_is_not_retried(self):
+        request = FakeRequest(rate_limited=1)
+        started_at = time.monotonic()
+        with self.assertRaises(RetryAfter):
+            await self.edit(request, rate_limit_args={"max_retries": 0})
+        self.assertEqual(len(request.urls), 1)
+        self.assertLess(time.monotonic() - started_at, RETRY_AFTER)
+
+    async def test_edit_is_retried_by_default(self):
+        request = FakeRequest(rate_limited=1)
+        await asyncio.wait_for(self.edit(request), timeout=RETRY_AFTER + 5)
+        self.assertEqual(len(request.urls), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
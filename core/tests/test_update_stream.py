@@ -0,0 +1,58 @@
+"""
+The update stream partition takeover keeps the updates of a chat in order.
+"""
+import asyncio
+import json
+import time
+import typing as t
+import unittest
+
+from core.update_stream import CONSUMERS_KEY, StreamEntry, UpdateStreamConsumer, get_stream_key, stream_settings
+from tests.fake_redis import FakeRedisTestCase
+
+PARTITION = 0
+STREAM = get_stream_key(PARTITION)
+
+
+def build_update(update_id: int) -> dict:
+    return {"update_id": update_id,
+            "message": {"message_id": update_id, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "Hi!"}}
+
+
+class PartitionTakeoverTest(FakeRedisTestCase):
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        await self.redis.xgroup_create(STREAM, stream_settings.GROUP, id="0", mkstream=True)
+        for update_id in range(1, 4):
+            await self.redis.xadd(STREAM, {"update": json.dumps(build_update(update_id))})
+        # The previous holder has read the first update and has not acknowledged it
+        await self.redis.xreadgroup(stream_settings.GROUP, "previous", {STREAM: ">"}, count=1)
+        self.submitted: t.List[int] = []
+        self.consumer = UpdateStreamConsumer(bot=None, process=None)
+        self.consumer._submit = self.submit
+
+    async def submit(self, entry: StreamEntry):
+        self.submitted.append(entry.update.update_id)
+
+    async def consume(self, until: int):
+        task = asyncio.create_task(self.consumer._consume(PARTITION))
+        try:
+            while len(self.submitted) < until:
+                await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def test_entries_of_gone_holder_go_first(self):
+        await asyncio.wait_for(self.consume(until=3), timeout=5)
+        self.assertEqual(self.submitted, [1, 2, 3])
+
+    async def test_entries_of_live_holder_are_not_taken_over(self):
+        await self.redis.zadd(CONSUMERS_KEY, {"previous": time.time()})
+        self.assertEqual(await self.consumer._claim_stuck_entries(STREAM, min_idle_time=0), 1)
+        self.assertEqual(self.submitted, [])
+
+
+if __name__ == "__main__":
+    unittest.main()